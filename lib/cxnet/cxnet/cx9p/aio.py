@@ -0,0 +1,227 @@
+"""
+asyncio-based 9P server
+
+The server is created with ``loop.create_server()``. Each client
+connection is served by a ``p9protocol`` object that frames the 9P
+messages out of the ``data_received()`` chunks with the use of a
+``recordstream`` and parses them with the ``messages`` definitions,
+the same way the ``p9socket`` sessions do.
+
+A handler may be either a plain method returning the reply message
+or a coroutine. The coroutine handlers run as separate tasks, so a
+slow backend (a netlink call, a taskstats read) doesn't block the
+other requests of the same or other sessions. The replies are sent
+in order of completion. A Tflush message cancels the task of the
+flushed request.
+
+The module requires the ``trollius`` package, the Python 2 backport
+of ``asyncio``, so the coroutines are written in its style::
+
+    class myserver (p9asyncserver):
+        handlers = dict(p9asyncserver.handlers)
+        handlers[Tstat._type] = "stat"
+
+        @asyncio.coroutine
+        def stat (self, session, msg):
+            info = yield From(backend.stat(...))
+            raise Return(basereply(msg, ...))
+
+The requests of the ``p9client`` (see the ``client`` module) can be
+awaited in a coroutine with the use of ``p9future()``::
+
+    rmsg = yield From(p9future(client.send(Tstat, fid = fid)))
+"""
+
+#     Copyright (c) 2011 Peter V. Saveliev
+#     Copyright (c) 2011 Paul Wolneykien
+#
+#     This file is part of Connexion project.
+#
+#     Connexion is free software; you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation; either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     Connexion is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with Connexion; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from ctypes import string_at
+from socket import IPPROTO_TCP, TCP_NODELAY
+from time import time
+
+# The Python 2 backport of asyncio
+import trollius as asyncio
+from trollius import From, Return
+
+from messages import *
+from mempair import recordstream
+from core import p9dispatcher, p9server, p9channel, basereply, errorreply, buffers, MAXSESSIONS, MAXMSIZE
+
+__all__ = ["p9asyncserver", "p9protocol", "p9future", "From", "Return"]
+
+
+class p9protocol (p9channel, asyncio.Protocol):
+    """
+    Client-server connection via 9P served by an asyncio loop
+    """
+    def __init__ (self, p9server, p9msize = MAX_MSG_SIZE):
+        """
+        Initializes the protocol object bound to the specified
+        9P server instance
+        """
+        p9channel.__init__(self, p9server, None, p9msize)
+        self.transport = None
+        self.input = recordstream(p9msg, maxsize = MAX_MSG_SIZE)
+        self.tasks = {}
+
+    def connection_made (self, transport):
+        """
+        Registers the new session
+        """
+        self.transport = transport
+        if not self.server.register(self):
+            self.server.debug ("Too many sessions, the connection is refused")
+            self.closed = True
+            transport.close()
+            return
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.debug ("Start a new session")
+
+    def connection_lost (self, exc):
+        """
+        Cancels the pending requests of the closed session
+        """
+        self.closed = True
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+        self.server.unregister(self)
+        self.debug ("The session is closed")
+
+    def data_received (self, data):
+        """
+        Processes all the complete messages received so far
+        """
+        if self.closed:
+            return
+        self.bytesin += len(data)
+        self.debug ("%i bytes received", len(data))
+        data = memoryview(data)
+        while data:
+            view = self.input.view()
+            l = min(len(view), len(data))
+            view[:l] = data[:l]
+            self.input.feed(l)
+            data = data[l:]
+            try:
+                for msg in self.input:
+                    self.received(msg)
+            except ValueError as e:
+                self.debug (str(e))
+                self.transport.close()
+                return
+
+    def received (self, msg):
+        """
+        Dispatches the given T-message. The coroutine handlers
+        are scheduled as tasks and the replies are sent on their
+        completion
+        """
+        if msg.type == Tflush._type:
+            self.server.stats.current().count(msg.type)
+            task = self.tasks.pop(msg.oldtag, None)
+            if task is not None:
+                task.cancel()
+                self.debug ("Flush the %i tag", msg.oldtag)
+            self.reply (basereply(msg), False)
+            return
+        start = time()
+        result = self.server.handle(self, msg)
+        if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+            task = asyncio.ensure_future(result, loop = self.server.loop)
+            self.tasks[msg.tag] = task
+            task.add_done_callback(lambda task: self.completed(msg, task, start))
+        else:
+            self.server.stats.current().handled(msg.type, time() - start)
+            self.reply (result, False)
+
+    def completed (self, msg, task, start):
+        """
+        Sends the reply of the completed handler task. The time
+        the task has taken is counted as the handler time
+        """
+        self.server.stats.current().handled(msg.type, time() - start)
+        if self.tasks.get(msg.tag) is task:
+            del self.tasks[msg.tag]
+        if task.cancelled() or self.closed:
+            return
+        if task.exception() is not None:
+            self.debug ("Handler error: %s", task.exception())
+            rmsg = errorreply(msg, str(task.exception()))
+        else:
+            rmsg = task.result()
+        self.reply (rmsg, False)
+
+    def transmit (self, rmsg, baddr, blen):
+        """
+        Passes a copy of the message to the transport
+        """
+        self.transport.write(string_at(baddr, blen))
+        self.bytesout += blen
+        buffers.put(rmsg.data)
+        return blen
+
+
+class p9asyncserver (p9dispatcher, p9server):
+    """
+    9P server running in an asyncio loop
+    """
+    def __init__ (self, loop = None, maxsessions = MAXSESSIONS, maxmsize = MAXMSIZE):
+        """
+        Sets up the server in the given loop (the default loop
+        if not specified). No more than ``maxsessions``
+        sessions are served at a time. The clients may negotiate
+        the message size up to ``maxmsize`` bytes
+        """
+        p9server.__init__(self, self, maxsessions, maxmsize)
+        p9dispatcher.__init__(self, self)
+        self.loop = loop or asyncio.get_event_loop()
+
+    @asyncio.coroutine
+    def serve (self, address = '0.0.0.0', port = 10001):
+        """
+        Starts listening on the given address and port. Returns
+        the asyncio server object
+        """
+        server = yield From(self.loop.create_server(lambda: p9protocol(self), address, port, reuse_address = True))
+        self.closed = False
+        raise Return(server)
+
+
+def p9future (request, loop = None):
+    """
+    Returns the future of the given ``p9request`` object in the
+    given loop (the default loop if not specified). The future
+    is resolved with the reply or the ``p9error`` exception
+    """
+    loop = loop or asyncio.get_event_loop()
+    future = asyncio.Future(loop = loop)
+
+    def resolve ():
+        if future.cancelled():
+            return
+        if request.error is not None:
+            future.set_exception(request.error)
+        else:
+            future.set_result(request.reply)
+
+    request.notify(lambda request: loop.call_soon_threadsafe(resolve))
+    return future
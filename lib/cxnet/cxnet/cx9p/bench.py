@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the 9P message handling
+"""
+
+from __future__ import print_function
+
+from ctypes import c_ubyte
+from time import time
+import tempfile
+import shutil
+import sys
+import os
+import gc
+
+from cxnet.cx9p.messages import *
+from cxnet.cx9p import codec
+from cxnet.cx9p.metrics import p9stats
+from mempair import mempair, build
+
+# The number of path elements in a walk
+NWALK = 16
+
+def bench (name, func, rounds = 10000):
+    """
+    Runs the given function for the given number of rounds and
+    prints the average time per round
+    """
+    start = time()
+    for i in range(rounds):
+        func()
+    elapsed = time() - start
+    print ("%-32s %10.2f us" % (name, elapsed * 1e6 / rounds))
+
+def twalk (nwname = NWALK):
+    """
+    Returns a Twalk message with ``nwname`` path elements
+    """
+    msg = mempair(p9msg, (c_ubyte * NORM_MSG_SIZE)())
+    msg.type = Twalk._type
+    msg.nwname = nwname
+    for (i, wname) in enumerate(msg.wname):
+        name = "element%02d" % i
+        wname.len = len(name)
+        wname.raw = name
+    return msg
+
+def rwalk (nwqid = NWALK):
+    """
+    Returns a Rwalk message with ``nwqid`` qids
+    """
+    msg = mempair(p9msg, (c_ubyte * NORM_MSG_SIZE)())
+    msg.type = Rwalk._type
+    msg.nwqid = nwqid
+    for (i, qid) in enumerate(msg.qid):
+        qid.path = i
+    return msg
+
+def walks ():
+    """
+    Benchmarks the access to the elements of 16-element walks
+    """
+    tmsg = twalk()
+    rmsg = rwalk()
+
+    def iterate_wname ():
+        for wname in tmsg.wname:
+            wname.raw
+
+    def index_wname ():
+        for i in range(len(tmsg.wname)):
+            tmsg.wname[i].raw
+
+    def iterate_qid ():
+        for qid in rmsg.qid:
+            qid.path
+
+    def index_qid ():
+        for i in range(len(rmsg.qid)):
+            rmsg.qid[i].path
+
+    bench ("Twalk: iterate wname", iterate_wname)
+    bench ("Twalk: index wname", index_wname)
+    bench ("Rwalk: iterate qid", iterate_qid)
+    bench ("Rwalk: index qid", index_qid)
+
+class countingpair (mempair):
+    """
+    A mempair class counting the newly created pair objects
+    """
+    __slots__ = ()
+
+    created = 0
+
+    def __init__ (self, *args, **kwargs):
+        countingpair.created += 1
+        mempair.__init__(self, *args, **kwargs)
+
+def pairs (rounds = 10000):
+    """
+    Benchmarks the allocation of pair objects while parsing
+    a Twalk message with and without the free-list
+    """
+    data = bytearray(NORM_MSG_SIZE)
+    build(p9msg, {"type": Twalk._type, "tag": 1, "nwname": 4, "wname": ["usr", "local", "share", "doc"]}, data)
+
+    def parse ():
+        msg = countingpair(p9msg, data)
+        for wname in msg.wname:
+            wname.raw
+        msg.buf()
+        return msg
+
+    def allocs ():
+        # The objects (pairs, car objects, dicts) allocated by a
+        # parse and kept alive until the message is released
+        gc.collect()
+        gc.disable()
+        try:
+            before = set(id(obj) for obj in gc.get_objects())
+            msg = parse()
+            new = [obj for obj in gc.get_objects() if id(obj) not in before and obj is not before]
+            count = len(new)
+            size = sum(sys.getsizeof(obj) for obj in new)
+            del new
+            msg.release()
+        finally:
+            gc.enable()
+        return (count, size)
+
+    for maxfree in (0, 256):
+        mempair.maxfree = maxfree
+        parse().release()
+        countingpair.created = 0
+        start = time()
+        for i in range(rounds):
+            parse().release()
+        elapsed = time() - start
+        created = float(countingpair.created) / rounds
+        (count, size) = allocs()
+        print ("Twalk parse, maxfree=%-3d %10.2f us %6.2f new pairs %4d objects %6d bytes" % (maxfree, elapsed * 1e6 / rounds, created, count, size))
+    mempair.maxfree = 0
+
+def codecs ():
+    """
+    Compares the decoding of a 16-element Twalk with mempair and
+    with the precompiled codec
+    """
+    data = bytearray(NORM_MSG_SIZE)
+    codec.encode({"type": Twalk._type, "tag": 1, "wname": ["element%02d" % i for i in range(NWALK)]}, data)
+
+    def parse_mempair ():
+        msg = mempair(p9msg, data)
+        [wname.raw for wname in msg.wname]
+
+    bench ("Twalk decode: mempair", parse_mempair)
+    bench ("Twalk decode: codec", lambda: codec.decode(data))
+
+class nullsocket (object):
+    """
+    A stand-in for the p9socket object
+    """
+    closed = False
+    debugging = False
+    maxmsize = MAX_MSG_SIZE
+    stats = p9stats()
+
+    def release (self, fid):
+        pass
+
+class nullsession (object):
+    """
+    A stand-in for the p9session object
+    """
+    msize = MAX_MSG_SIZE
+
+    def setmsize (self, msize):
+        pass
+
+    def debug (self, fmt, *args):
+        pass
+
+def dispatch ():
+    """
+    Benchmarks the dispatching of the T-messages by type
+    """
+    from cxnet.cx9p.core import p9socketworker, buffers
+
+    worker = p9socketworker(nullsocket())
+    session = nullsession()
+
+    def dispatch ():
+        buffers.put(worker.dispatch(session, msg).data)
+
+    for msgclass in (Tversion, Tattach, Twalk, Topen, Tread, Twrite, Tclunk, Tstat):
+        data = bytearray(NORM_MSG_SIZE)
+        codec.encode({"type": msgclass._type, "tag": 1, "msize": MAX_MSG_SIZE, "version": VERSION9P}, data)
+        msg = mempair(p9msg, data)
+        bench ("dispatch %s" % msgclass.__name__, dispatch)
+
+def debugs ():
+    """
+    Compares the cost of a disabled debug message formatted by the
+    caller and of one formatted by the ``debug`` method
+    """
+    from cxnet.cx9p.core import p9channel
+
+    session = p9channel(nullsocket(), -1)
+    (version, msize) = (VERSION9P, MAX_MSG_SIZE)
+    bench ("debug disabled: eager format", lambda: session.debug ("Requested 9P version: %s, maximum size: %i bytes" % (version, msize)))
+    bench ("debug disabled: lazy format", lambda: session.debug ("Requested 9P version: %s, maximum size: %i bytes", version, msize))
+
+def replies ():
+    """
+    Benchmarks building and releasing the reply messages with and
+    without the buffer pool
+    """
+    from cxnet.cx9p import core
+
+    data = bytearray(NORM_MSG_SIZE)
+    codec.encode({"type": Tread._type, "tag": 1, "fid": 1, "count": 4000}, data)
+    msg = mempair(p9msg, data)
+    payload = "x" * 4000
+
+    def rclunk ():
+        rmsg = core.basereply(msg, Rclunk._type)
+        core.buffers.put(rmsg.data)
+
+    def rread ():
+        rmsg = core.basereply(msg, count = len(payload), data = payload)
+        core.buffers.put(rmsg.data)
+
+    maxmemory = core.buffers.maxmemory
+    for (name, memory) in (("no pool", 0), ("pool", maxmemory)):
+        core.buffers.maxmemory = memory
+        bench ("Rclunk reply: %s" % name, rclunk)
+        bench ("Rread 4000 reply: %s" % name, rread)
+    core.buffers.maxmemory = maxmemory
+    print (core.buffers.stats())
+
+def writes ():
+    """
+    Benchmarks the Twrite messages served by the file server with
+    a backend storing the data view right into the file and with
+    one copying it out of the receive buffer first
+    """
+    from cxnet.cx9p.fileserver import p9fileserver
+    from cxnet.cx9p.fids import p9fidtable, p9pathcache
+    from cxnet.cx9p.core import buffers
+
+    count = MAX_MSG_SIZE - 24
+    store = bytearray(count)
+
+    class fsworker (p9fileserver):
+        copy = False
+
+        def getroot (self, session, uname, aname):
+            return (p9qid(type = QTFILE, path = 1), store)
+
+        def writefile (self, session, fid, offset, data):
+            if self.copy:
+                data = data.tobytes()
+            fid.node[offset:offset + len(data)] = data
+            return len(data)
+
+    sock = nullsocket()
+    sock.paths = p9pathcache(0)
+    worker = fsworker(sock)
+    session = nullsession()
+    session.server = sock
+    session.fids = p9fidtable()
+    msgs = []
+    for msgvalues in ({"type": Tattach._type, "fid": 0, "afid": NOFID, "uname": "", "aname": ""},
+                      {"type": Topen._type, "fid": 0, "mode": 1},
+                      {"type": Twrite._type, "fid": 0, "offset": 0, "data": "x" * count}):
+        data = bytearray(MAX_MSG_SIZE)
+        msgvalues["tag"] = 1
+        codec.encode(msgvalues, data)
+        msgs.append(mempair(p9msg, data))
+    (tattach, topen, twrite) = msgs
+    worker.dispatch(session, tattach)
+    worker.dispatch(session, topen)
+
+    def write ():
+        rmsg = worker.dispatch(session, twrite)
+        assert rmsg.type == Rwrite._type and rmsg.count == count
+        buffers.put(rmsg.data)
+
+    for (name, copy) in (("copy", True), ("view", False)):
+        worker.copy = copy
+        bench ("Twrite %d bytes: %s" % (count, name), write, 100000)
+
+def deepwalks ():
+    """
+    Benchmarks the walks of ``NWALK`` elements deep into a directory
+    tree served by the file system with and without the path cache
+    """
+    from cxnet.cx9p.fileserver import p9fileserver
+    from cxnet.cx9p.fids import p9fidtable, p9pathcache
+
+    class fsworker (p9fileserver):
+        def getroot (self, session, uname, aname):
+            return (p9qid(type = QTDIR, path = os.stat(root).st_ino), root)
+
+        def lookup (self, session, qid, node, name):
+            path = os.path.normpath(os.path.join(node, name))
+            try:
+                st = os.lstat(path)
+            except OSError:
+                return None
+            return (p9qid(type = QTDIR if os.path.isdir(path) else QTFILE, path = st.st_ino), path)
+
+    root = tempfile.mkdtemp()
+    names = ["element%02d" % i for i in range(NWALK)]
+    os.makedirs(os.path.join(root, *names))
+    try:
+        sock = nullsocket()
+        worker = fsworker(sock)
+        session = nullsession()
+        session.server = sock
+        session.fids = p9fidtable()
+        msgs = []
+        for msgvalues in ({"type": Tattach._type, "fid": 0, "afid": NOFID, "uname": "", "aname": ""},
+                          {"type": Twalk._type, "fid": 0, "newfid": 1, "nwname": NWALK, "wname": names},
+                          {"type": Tclunk._type, "fid": 1}):
+            data = bytearray(NORM_MSG_SIZE)
+            msgvalues["tag"] = 1
+            build(p9msg, msgvalues, data)
+            msgs.append(mempair(p9msg, data))
+        (tattach, twalk, tclunk) = msgs
+
+        def walk ():
+            rmsg = worker.dispatch(session, twalk)
+            assert rmsg.type == Rwalk._type and rmsg.nwqid == NWALK
+            worker.dispatch(session, tclunk)
+
+        def resolve ():
+            fid = session.fids.get(0)
+            (qid, node) = (fid.qid, fid.node)
+            for name in names:
+                (qid, node) = worker.resolve(session, qid, node, name)
+
+        for maxpaths in (0, 1024):
+            sock.paths = p9pathcache(maxpaths)
+            session.fids.clear()
+            worker.dispatch(session, tattach)
+            bench ("resolve %d deep, maxpaths=%-4d" % (NWALK, maxpaths), resolve)
+            bench ("Twalk %d deep, maxpaths=%-4d" % (NWALK, maxpaths), walk)
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == "__main__":
+    walks()
+    pairs()
+    codecs()
+    dispatch()
+    debugs()
+    replies()
+    writes()
+    deepwalks()
@@ -0,0 +1,423 @@
+"""
+9P client
+
+A ``p9client`` object is a connection to a 9P server. The protocol
+version and the message size are negotiated with Tversion when the
+connection is made.
+
+Each request gets a tag from the free list and is sent at once
+without waiting for the replies to the previous ones, so many
+requests may be in flight on a single connection. The replies are
+received by a reader thread and are matched to the requests by their
+tags, thus they may come in any order.
+
+The ``send()`` method returns a ``p9request`` object right after the
+request is sent (the asynchronous API). Its ``wait()`` method waits
+for the reply and returns it, and the callback, if given, is called
+from the reader thread as soon as the reply is received. The
+``rpc()`` method and the helpers like ``walk()`` or ``clunk()`` wait
+for the reply (the blocking API). The ``read()`` and ``write()``
+methods transfer a region of a file keeping a number of requests in
+flight.
+
+The replies are the ``mempair`` objects placed right in the receive
+buffer (see the ``recordstream`` class). An Rerror reply is raised
+as a ``p9error`` exception.
+"""
+
+#     Copyright (c) 2011 Peter V. Saveliev
+#     Copyright (c) 2011 Paul Wolneykien
+#
+#     This file is part of Connexion project.
+#
+#     Connexion is free software; you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation; either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     Connexion is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with Connexion; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from socket import create_connection, error as socketerror, IPPROTO_TCP, TCP_NODELAY, SHUT_RDWR
+from errno import EINTR, ETIMEDOUT
+from collections import deque
+import threading
+
+from messages import *
+from mempair import recordstream
+from core import buildmsg, payloadview, buffers, MAXMSIZE
+
+__all__ = ["p9client", "p9request", "p9error"]
+
+# The number of the tags in the free list: the maximum number of
+# requests in flight
+MAXTAGS = 256
+
+# The default number of requests in flight of a file transfer
+DEPTH = 16
+
+
+class p9error (IOError):
+    """
+    An error reported by the server with Rerror or a failure of
+    the connection
+    """
+    pass
+
+
+class p9request (object):
+    """
+    A request sent to the server and waiting for the reply
+    """
+    def __init__ (self, client, tag, msgtype, callback = None):
+        self.client = client
+        self.tag = tag
+        self.type = msgtype
+        self.callback = callback
+        self.reply = None
+        self.error = None
+        self.flushing = False
+        self.__done = threading.Event()
+        self.__lock = threading.Lock()
+
+    def done (self):
+        """
+        Indicates if the reply is received or the request
+        is failed
+        """
+        return self.__done.is_set()
+
+    def complete (self, reply = None, error = None):
+        """
+        Sets the reply or the error of the request and calls
+        the callback
+        """
+        self.__lock.acquire()
+        self.reply = reply
+        self.error = error
+        self.__done.set()
+        callback = self.callback
+        self.__lock.release()
+        if callback is not None:
+            callback(self)
+
+    def notify (self, callback):
+        """
+        Sets the function to call with the request when it's
+        completed. The function is called at once if the request
+        is completed already
+        """
+        self.__lock.acquire()
+        done = self.__done.is_set()
+        if not done:
+            self.callback = callback
+        self.__lock.release()
+        if done:
+            callback(self)
+
+    def wait (self, timeout = None):
+        """
+        Waits for the reply and returns it. Raises ``p9error``
+        if the request is failed or isn't completed in the
+        given number of seconds
+        """
+        if not self.__done.wait(timeout):
+            raise p9error (ETIMEDOUT, "The request is timed out")
+        if self.error is not None:
+            raise self.error
+        return self.reply
+
+    def flush (self):
+        """
+        Aborts the request (see ``p9client.flush``)
+        """
+        return self.client.flush(self)
+
+
+class p9client (object):
+    """
+    Client-server connection via 9P
+    """
+    def __init__ (self, address, port, msize = MAXMSIZE, maxtags = MAXTAGS):
+        """
+        Connects to the 9P server at the given address and port
+        and negotiates the given maximum message size. No more
+        than ``maxtags`` requests are in flight at a time
+        """
+        self.msize = MAX_MSG_SIZE
+        self.version = None
+        self.closed = False
+        self.sock = create_connection((address, port))
+        self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        self.input = recordstream(p9msg, maxsize = msize)
+        self.__pending = {}
+        self.__tags = range(maxtags - 1, -1, -1)
+        self.__lock = threading.Condition(threading.Lock())
+        self.__wlock = threading.Lock()
+        self.__reader = threading.Thread(target = self.run)
+        self.__reader.daemon = True
+        self.__reader.start()
+        try:
+            rmsg = self.__send(NOTAG, Tversion, None, {"msize": msize, "version": VERSION9P}).wait()
+        except:
+            self.close()
+            raise
+        if rmsg.version.raw != VERSION9P:
+            self.close()
+            raise p9error ("Unsupported 9P version: %s" % rmsg.version.raw)
+        self.version = rmsg.version.raw
+        self.msize = rmsg.msize
+        self.input.maxsize = rmsg.msize
+
+    def iounit (self):
+        """
+        Returns the maximum amount of data that a single Tread or
+        Twrite request may carry
+        """
+        return self.msize - IOHDRSZ
+
+    def send (self, msgclass, callback = None, **values):
+        """
+        Sends the T-message of the given class with the fields set
+        from the given keyword arguments. Returns the ``p9request``
+        object. The callback, if given, is called with that object
+        from the reader thread when the reply is received. Waits
+        for a free tag if too many requests are in flight
+        """
+        self.__lock.acquire()
+        try:
+            while not self.__tags and not self.closed:
+                self.__lock.wait()
+            if self.closed:
+                raise p9error ("The connection is closed")
+            tag = self.__tags.pop()
+        finally:
+            self.__lock.release()
+        return self.__send(tag, msgclass, callback, values)
+
+    def __send (self, tag, msgclass, callback, values):
+        values["type"] = msgclass._type
+        values["tag"] = tag
+        request = p9request(self, tag, msgclass._type, callback)
+        msg = buildmsg(values)
+        try:
+            if msg.size > self.msize:
+                raise ValueError ("The message is too long")
+            self.__lock.acquire()
+            self.__pending[tag] = request
+            self.__lock.release()
+            self.__wlock.acquire()
+            try:
+                self.sock.sendall(buffer(msg.data, 0, msg.size))
+            finally:
+                self.__wlock.release()
+        except socketerror as e:
+            self.__fail(tag, p9error(*e.args))
+            raise p9error (*e.args)
+        except:
+            self.__fail(tag, None)
+            raise
+        finally:
+            buffers.put(msg.data)
+        return request
+
+    def __fail (self, tag, error):
+        self.__lock.acquire()
+        request = self.__pending.pop(tag, None)
+        self.__lock.release()
+        self.release(tag)
+        if request is not None and error is not None:
+            request.complete(error = error)
+
+    def release (self, tag):
+        """
+        Returns the given tag to the free list
+        """
+        if tag == NOTAG:
+            return
+        self.__lock.acquire()
+        self.__tags.append(tag)
+        self.__lock.notify()
+        self.__lock.release()
+
+    def rpc (self, msgclass, **values):
+        """
+        Sends the T-message of the given class and returns the
+        reply (see ``send``)
+        """
+        return self.send(msgclass, **values).wait()
+
+    def flush (self, request):
+        """
+        Aborts the given request sending Tflush. The request is
+        failed unless its reply is received before Rflush. The tag
+        of the request is not reused until Rflush is received.
+        Returns the Tflush ``p9request`` object or ``None`` if the
+        request is completed or is being flushed already
+        """
+        self.__lock.acquire()
+        try:
+            if request.flushing or self.__pending.get(request.tag) is not request:
+                return None
+            request.flushing = True
+        finally:
+            self.__lock.release()
+        return self.send(Tflush, oldtag = request.tag, callback = lambda flush: self.__flushed(request))
+
+    def __flushed (self, request):
+        if not request.done():
+            self.__lock.acquire()
+            self.__pending.pop(request.tag, None)
+            self.__lock.release()
+            request.complete(error = p9error(EINTR, "The request is flushed"))
+        self.release(request.tag)
+
+    def run (self):
+        """
+        Receives the replies and completes the corresponding
+        requests until the connection is closed
+        """
+        error = p9error ("The connection is closed")
+        try:
+            while True:
+                l = self.sock.recv_into(self.input.view())
+                if l == 0:
+                    break
+                self.input.feed(l)
+                for msg in self.input:
+                    self.received(msg)
+        except (socketerror, ValueError) as e:
+            if not self.closed:
+                error = p9error (*e.args)
+        finally:
+            self.__lock.acquire()
+            self.closed = True
+            pending = self.__pending.values()
+            self.__pending.clear()
+            self.__lock.notify_all()
+            self.__lock.release()
+            for request in pending:
+                request.complete(error = error)
+
+    def received (self, msg):
+        """
+        Completes the request the given reply is for
+        """
+        self.__lock.acquire()
+        request = self.__pending.pop(msg.tag, None)
+        flushing = request is not None and request.flushing
+        self.__lock.release()
+        if request is None:
+            return
+        if msg.type == Rerror._type:
+            request.complete(error = p9error(msg.ename.raw))
+        elif msg.type != request.type + 1:
+            request.complete(error = p9error("Unexpected reply type: %i" % msg.type))
+        else:
+            request.complete(msg)
+        if not flushing:
+            self.release(msg.tag)
+
+    def close (self):
+        """
+        Closes the connection failing the requests in flight
+        """
+        self.closed = True
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except socketerror:
+            pass
+        if threading.current_thread() is not self.__reader:
+            self.__reader.join()
+        self.sock.close()
+
+    def attach (self, fid, uname = "", aname = "", afid = NOFID):
+        """
+        Attaches the given fid to the root of the file tree.
+        Returns the qid of the root
+        """
+        return self.rpc(Tattach, fid = fid, afid = afid, uname = uname, aname = aname).qid
+
+    def walk (self, fid, newfid, names):
+        """
+        Walks the given fid along the given path names setting
+        ``newfid`` to the result. Returns the list of the qids of
+        the path elements
+        """
+        return list(self.rpc(Twalk, fid = fid, newfid = newfid, nwname = len(names), wname = names).qid)
+
+    def open (self, fid, mode = 0):
+        """
+        Opens the given fid. Returns the (qid, iounit) tuple
+        """
+        rmsg = self.rpc(Topen, fid = fid, mode = mode)
+        return (rmsg.qid, rmsg.iounit)
+
+    def clunk (self, fid):
+        """
+        Releases the given fid
+        """
+        self.rpc(Tclunk, fid = fid)
+
+    def read (self, fid, offset, length, depth = DEPTH):
+        """
+        Reads ``length`` bytes of the given open fid starting at
+        the given offset with up to ``depth`` Tread requests in
+        flight. Returns the data read, which is shorter than
+        requested if the end of the file is reached: a short reply
+        is taken for the end of the file
+        """
+        data = bytearray(length)
+        iounit = self.iounit()
+        requests = deque()
+        (pos, size, eof) = (0, 0, False)
+        try:
+            while requests or (pos < length and not eof):
+                while pos < length and not eof and len(requests) < depth:
+                    count = min(iounit, length - pos)
+                    requests.append((pos, count, self.send(Tread, fid = fid, offset = offset + pos, count = count)))
+                    pos += count
+                (start, count, request) = requests.popleft()
+                rmsg = request.wait()
+                if not eof:
+                    data[start:start + rmsg.count] = payloadview(rmsg)
+                    size = start + rmsg.count
+                    eof = rmsg.count < count
+        finally:
+            for (start, count, request) in requests:
+                try:
+                    request.wait()
+                except p9error:
+                    pass
+        del data[size:]
+        return bytes(data)
+
+    def write (self, fid, offset, data, depth = DEPTH):
+        """
+        Writes the given data to the given open fid starting at
+        the given offset with up to ``depth`` Twrite requests in
+        flight. Returns the number of bytes written
+        """
+        iounit = self.iounit()
+        requests = deque()
+        (pos, written) = (0, 0)
+        try:
+            while pos < len(data) or requests:
+                while pos < len(data) and len(requests) < depth:
+                    chunk = data[pos:pos + iounit]
+                    requests.append(self.send(Twrite, fid = fid, offset = offset + pos, count = len(chunk), data = chunk))
+                    pos += len(chunk)
+                written += requests.popleft().wait().count
+        finally:
+            for request in requests:
+                try:
+                    request.wait()
+                except p9error:
+                    pass
+        return written
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Loopback benchmark of the 9P client reading a file.
+
+The file is read with one Tread request at a time and with a number
+of requests in flight, with and without a delay of the server
+handler that stands for the latency of the storage or the network.
+The server processes the requests of the session in parallel
+(``maxactive``), so the delays overlap.
+"""
+
+from __future__ import print_function
+
+from multiprocessing import Process
+from time import time, sleep
+import tempfile
+import os
+
+from cxnet.cx9p.messages import *
+from cxnet.cx9p.core import p9socket, p9socketworker, p9payload, basereply
+from cxnet.cx9p.client import p9client
+from cxnet.cx9p.serverbench import run
+
+PORT = 10904
+
+# The size of the file read
+FILESIZE = 16 * 1024 * 1024
+
+# The message sizes to compare
+MSIZES = (MAX_MSG_SIZE, 128 * 1024)
+
+# The numbers of the requests in flight to compare
+DEPTHS = (1, 16)
+
+# The delay (seconds) of the read handler: the fid 0 is read
+# without a delay, the fid 1 with it
+LATENCY = 0.001
+
+class worker (p9socketworker):
+    handlers = dict(p9socketworker.handlers)
+    handlers[Tread._type] = "read"
+
+    datafile = None
+
+    def read (self, session, msg):
+        if msg.fid == 1:
+            sleep(LATENCY)
+        count = max(0, min(msg.count, FILESIZE - msg.offset))
+        return p9payload(msg, (worker.datafile, msg.offset, count))
+
+class server (p9socket):
+    workerclass = worker
+
+def serve ():
+    datafile = tempfile.TemporaryFile()
+    datafile.write(os.urandom(FILESIZE))
+    datafile.flush()
+    worker.datafile = datafile.fileno()
+    server('127.0.0.1', PORT, workers = max(DEPTHS), maxworkers = max(DEPTHS), maxactive = max(DEPTHS)).serve()
+
+def bench (client, name, fid, depth):
+    start = time()
+    data = client.read(fid, 0, FILESIZE, depth)
+    elapsed = time() - start
+    assert len(data) == FILESIZE, "Wrong data received"
+    print ("read %-8s msize %6d depth %2d %8.1f MB/s" % (name, client.msize, depth, len(data) / elapsed / 1e6))
+
+if __name__ == "__main__":
+    proc = Process(target = run, args = (serve,))
+    proc.daemon = True
+    proc.start()
+    sleep(0.5)
+    try:
+        for msize in MSIZES:
+            client = p9client('127.0.0.1', PORT, msize)
+            for (name, fid) in (("local", 0), ("latency", 1)):
+                for depth in DEPTHS:
+                    bench (client, name, fid, depth)
+            client.close()
+    finally:
+        proc.terminate()
+        proc.join()
@@ -0,0 +1,298 @@
+"""
+Precompiled 9P message codecs
+
+The encode and decode functions for each message type are generated
+at import time from the message classes defined in the ``messages``
+module. The static parts of a message are packed and unpacked with
+one precompiled ``struct.Struct`` object, while the strings and the
+arrays are handled by a few specialized lines of code, so no ctypes
+objects or mempair reflection are involved.
+
+The decoded message is a dictionary mapping the field names to their
+values: integers, strings (for 9P strings and data), tuples (for
+qids) and lists (for arrays). The same dictionary can be passed to
+the encode function. The count fields of the arrays (``nwname``,
+``nwqid``, ``count`` of Tread/Rwrite data) are always derived from
+the lengths of the corresponding values when encoding.
+
+The mempair-based parsing remains the reference implementation; see
+``codectest.py`` for the differential test.
+"""
+
+#     Copyright (c) 2011 Peter V. Saveliev
+#     Copyright (c) 2011 Paul Wolneykien
+#
+#     This file is part of Connexion project.
+#
+#     Connexion is free software; you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation; either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     Connexion is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with Connexion; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from ctypes import Structure, Array, c_ubyte, c_char, c_uint16, c_uint32, c_uint64
+from struct import Struct, pack_into
+
+from messages import *
+
+__all__ = ["encode", "decode", "codecs"]
+
+# struct format characters of the ctypes simple types
+FORMATS = {
+    c_ubyte: "B",
+    c_char: "c",
+    c_uint16: "H",
+    c_uint32: "I",
+    c_uint64: "Q",
+}
+
+# The value used to find out which car field defines the
+# number of elements of a tail field
+PROBE = 3
+
+def fieldformat (ftype):
+    """
+    Returns the struct format of the given static ctypes type
+    and the number of values it is unpacked to
+    """
+    if ftype in FORMATS:
+        return (FORMATS[ftype], 1)
+    elif issubclass(ftype, Array) and ftype._type_ in (c_ubyte, c_char):
+        return ("%ds" % ftype._length_, 1)
+    elif issubclass(ftype, Structure):
+        fmt = "".join([fieldformat(field[1])[0] for field in ftype._fields_])
+        return (fmt, len(ftype._fields_))
+    else:
+        raise TypeError("Unsupported field type: %s" % ftype.__name__)
+
+def countfield (msgclass, pos, fcount, ftype):
+    """
+    Returns the name of the car field of the given message class
+    that defines the number of elements (or the length of the
+    byte array) of the tail field at the given position of the
+    map or ``None`` if the number is constant
+    """
+    for field in getattr(msgclass, "_fields_", []):
+        if field[1] not in FORMATS:
+            continue
+        probe = msgclass()
+        setattr(probe, field[0], PROBE)
+        (pname, ptype, pcount) = probe.cdrmap()[pos]
+        if pcount != fcount and pcount == PROBE:
+            return field[0]
+        if ptype is not ftype and issubclass(ptype, Array) and ptype._length_ == PROBE:
+            return field[0]
+    return None
+
+def plan (msgclass):
+    """
+    Returns the list of the parts of the given message class in
+    order. Each part is one of the following tuples:
+
+    * ("fixed", [(name, format, nvalues), ...]) -- static fields;
+    * ("string", name) -- a 9P string or a 9P byte array;
+    * ("strings", name, count) -- an array of 9P strings;
+    * ("structs", name, count, format, nvalues) -- an array of
+      static structures;
+    * ("data", name, count) -- an array of bytes.
+
+    The ``count`` is the name of the car field holding the
+    number of elements
+    """
+    parts = [("fixed", [(field[0],) + fieldformat(field[1]) for field in getattr(msgclass, "_fields_", [])])]
+    counts = {}
+    if not hasattr(msgclass, "cdrmap"):
+        return (parts, counts)
+    for (pos, (fname, ftype, fcount)) in enumerate(msgclass().cdrmap()):
+        count = countfield(msgclass, pos, fcount, ftype)
+        if count is not None:
+            counts[count] = fname
+        if fname == "_tail":
+            parts.append(("fixed", [(field[0],) + fieldformat(field[1]) for field in ftype._fields_]))
+        elif ftype in (p9msgstring, p9msgarray):
+            if count is None:
+                parts.append(("string", fname))
+            else:
+                parts.append(("strings", fname, count))
+        elif issubclass(ftype, Array) and count is not None:
+            parts.append(("data", fname, count))
+        elif count is not None:
+            parts.append(("structs", fname, count) + fieldformat(ftype))
+        else:
+            parts.append(("fixed", [(fname,) + fieldformat(ftype)]))
+    return (parts, counts)
+
+def generate (msgclass, namespace):
+    """
+    Generates the source code of the encode and decode functions
+    for the given message class. The precompiled Struct objects
+    referenced by the code are added to the given namespace
+    """
+    name = msgclass.__name__
+    (parts, counts) = plan(msgclass)
+    enc = [
+        "def encode_%s (values, buf, offset = 0):" % name,
+        "    start = offset",
+        "    offset += 7",
+    ]
+    dec = [
+        "def decode_%s (buf, offset = 0):" % name,
+        "    (v_size, v_type, v_tag) = header.unpack_from(buf, offset)",
+        "    offset += 7",
+    ]
+    names = ["size", "type", "tag"]
+    if [part for part in parts if part[0] in ("string", "strings", "data")]:
+        dec.append("    view = memoryview(buf)")
+
+    for (count, fname) in counts.items():
+        enc.append("    v_%s = len(values.get(%r) or ())" % (count, fname))
+
+    for (i, part) in enumerate(parts):
+        kind = part[0]
+        if kind == "fixed":
+            fields = part[1]
+            if not fields:
+                continue
+            sname = "s_%s_%d" % (name, i)
+            namespace[sname] = Struct("<" + "".join([field[1] for field in fields]))
+            args = []
+            targets = []
+            for (fname, fmt, nvalues) in fields:
+                names.append(fname)
+                if fname in counts:
+                    args.append("v_%s" % fname)
+                elif nvalues == 1:
+                    default = "''" if fmt.endswith("s") or fmt == "c" else "0"
+                    args.append("values.get(%r, %s)" % (fname, default))
+                else:
+                    enc.append("    v_%s = values.get(%r, (0,) * %d)" % (fname, fname, nvalues))
+                    args.extend(["v_%s[%d]" % (fname, j) for j in range(nvalues)])
+                if nvalues == 1:
+                    targets.append("v_%s" % fname)
+                else:
+                    targets.extend(["v_%s_%d" % (fname, j) for j in range(nvalues)])
+            enc.append("    %s.pack_into(buf, offset, %s)" % (sname, ", ".join(args)))
+            enc.append("    offset += %d" % namespace[sname].size)
+            dec.append("    (%s,) = %s.unpack_from(buf, offset)" % (", ".join(targets), sname))
+            dec.append("    offset += %d" % namespace[sname].size)
+            for (fname, fmt, nvalues) in fields:
+                if nvalues > 1:
+                    dec.append("    v_%s = (%s)" % (fname, ", ".join(["v_%s_%d" % (fname, j) for j in range(nvalues)])))
+        elif kind == "string":
+            fname = part[1]
+            names.append(fname)
+            enc.extend([
+                "    v = values.get(%r, '')" % fname,
+                "    u16.pack_into(buf, offset, len(v))",
+                "    pack_into('%ds' % len(v), buf, offset + 2, v)",
+                "    offset += 2 + len(v)",
+            ])
+            dec.extend([
+                "    (n,) = u16.unpack_from(buf, offset)",
+                "    v_%s = view[offset + 2:offset + 2 + n].tobytes()" % fname,
+                "    offset += 2 + n",
+            ])
+        elif kind == "strings":
+            (fname, count) = part[1:]
+            names.append(fname)
+            enc.extend([
+                "    for v in values.get(%r) or ():" % fname,
+                "        u16.pack_into(buf, offset, len(v))",
+                "        pack_into('%ds' % len(v), buf, offset + 2, v)",
+                "        offset += 2 + len(v)",
+            ])
+            dec.extend([
+                "    v_%s = []" % fname,
+                "    for i in range(v_%s):" % count,
+                "        (n,) = u16.unpack_from(buf, offset)",
+                "        v_%s.append(view[offset + 2:offset + 2 + n].tobytes())" % fname,
+                "        offset += 2 + n",
+            ])
+        elif kind == "structs":
+            (fname, count, fmt, nvalues) = part[1:]
+            names.append(fname)
+            sname = "s_%s_%d" % (name, i)
+            namespace[sname] = Struct("<" + fmt)
+            enc.extend([
+                "    for v in values.get(%r) or ():" % fname,
+                "        %s.pack_into(buf, offset, *v)" % sname,
+                "        offset += %d" % namespace[sname].size,
+            ])
+            dec.extend([
+                "    v_%s = []" % fname,
+                "    for i in range(v_%s):" % count,
+                "        v_%s.append(%s.unpack_from(buf, offset))" % (fname, sname),
+                "        offset += %d" % namespace[sname].size,
+            ])
+        elif kind == "data":
+            (fname, count) = part[1:]
+            names.append(fname)
+            enc.extend([
+                "    v = values.get(%r) or ''" % fname,
+                "    pack_into('%ds' % len(v), buf, offset, v)",
+                "    offset += len(v)",
+            ])
+            dec.extend([
+                "    v_%s = view[offset:offset + v_%s].tobytes()" % (fname, count),
+                "    offset += v_%s" % count,
+            ])
+
+    enc.extend([
+        "    header.pack_into(buf, start, offset - start, %d, values.get('tag', 0))" % msgclass._type,
+        "    return offset - start",
+    ])
+    dec.append("    return {%s}" % ", ".join(["%r: v_%s" % (fname, fname) for fname in names]))
+    return "\n".join(enc) + "\n\n" + "\n".join(dec) + "\n"
+
+def compile_codecs ():
+    """
+    Generates and compiles the codecs for all the defined message
+    classes. Returns a dictionary mapping the message type to the
+    (encode, decode) tuple of functions
+    """
+    namespace = {
+        "header": Struct("<IBH"),
+        "u16": Struct("<H"),
+        "pack_into": pack_into,
+    }
+    result = {}
+    for msgclass in p9msgclasses:
+        if msgclass is None:
+            continue
+        source = generate(msgclass, namespace)
+        exec(compile(source, "<codec %s>" % msgclass.__name__, "exec"), namespace)
+        result[msgclass._type] = (namespace["encode_%s" % msgclass.__name__], namespace["decode_%s" % msgclass.__name__])
+    return result
+
+# The codecs of all the defined message types
+codecs = compile_codecs()
+
+# The message type field
+typefield = Struct("<B")
+
+def encode (values, buf, offset = 0):
+    """
+    Encodes the message defined by the given values (including the
+    ``type`` and ``tag``) into the given buffer at the given offset.
+    Returns the length of the message
+    """
+    return codecs[values["type"]][0](values, buf, offset)
+
+def decode (buf, offset = 0):
+    """
+    Decodes the message at the given offset of the given buffer.
+    Returns the dictionary of the message field values
+    """
+    (msgtype,) = typefield.unpack_from(buf, offset + 4)
+    try:
+        return codecs[msgtype][1](buf, offset)
+    except KeyError:
+        raise ValueError("Unknown message type: %d" % msgtype)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Differential test of the precompiled codecs against mempair
+"""
+
+from __future__ import print_function
+
+from cxnet.cx9p.messages import *
+from cxnet.cx9p.codec import codecs, plan, encode, decode
+from mempair import build
+
+def sample (msgclass, tag):
+    """
+    Returns the sample field values for the given message class
+    """
+    values = {"type": msgclass._type, "tag": tag}
+    (parts, counts) = plan(msgclass)
+    n = 0
+    for part in parts:
+        if part[0] == "fixed":
+            for (fname, fmt, nvalues) in part[1]:
+                n += 1
+                if nvalues > 1:
+                    values[fname] = tuple([n + j for j in range(nvalues)])
+                else:
+                    values[fname] = n
+        elif part[0] == "string":
+            values[part[1]] = "%s-%d" % (part[1], tag)
+        elif part[0] == "strings":
+            values[part[1]] = ["%s%d" % (part[1], i) * (i + 1) for i in range(3)]
+        elif part[0] == "structs":
+            values[part[1]] = [tuple([i + j for j in range(part[4])]) for i in range(3)]
+        elif part[0] == "data":
+            values[part[1]] = "".join([chr(i % 256) for i in range(300)])
+    for (count, fname) in counts.items():
+        values[count] = len(values[fname])
+    return values
+
+def check ():
+    """
+    Checks that both implementations produce identical bytes
+    and that the decoded values are the encoded ones
+    """
+    failed = 0
+    for (msgtype, (encoder, decoder)) in sorted(codecs.items()):
+        name = p9msgclasses[msgtype].__name__
+        values = sample(p9msgclasses[msgtype], msgtype)
+        reference = bytearray(NORM_MSG_SIZE)
+        (msg, length) = build(p9msg, values, reference)
+        msg.size = length
+        values["size"] = length
+        compiled = bytearray(NORM_MSG_SIZE)
+        if encode(values, compiled) != length or compiled[:length] != reference[:length]:
+            print ("%s: the encoded bytes differ" % name)
+            failed += 1
+        elif decode(reference) != values:
+            print ("%s: the decoded values differ" % name)
+            failed += 1
+    print ("%d message types checked, %d failed" % (len(codecs), failed))
+    return failed
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(check() and 1 or 0)
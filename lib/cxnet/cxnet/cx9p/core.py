@@ -26,61 +26,330 @@ from __future__ import print_function
 # ctypes structures
 from ctypes import Structure, Union
 # ctypes functions
-from ctypes import byref, sizeof, create_string_buffer, resize
+from ctypes import byref, sizeof, create_string_buffer, get_errno
 # ctypes simple types
 from ctypes import c_short, c_ushort, c_byte, c_ulong, c_uint32, c_uint16, c_ubyte, c_uint64, c_uint8
 
 from cxnet.utils import dqn_to_int, hprint, hline
 from cxnet.common import libc
-from socket import htons, htonl, ntohs, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+from socket import htons, htonl, ntohs, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, MSG_DONTWAIT, IPPROTO_TCP, TCP_NODELAY, SHUT_RD, SHUT_RDWR
+from errno import EINTR, ECONNABORTED, EPROTO, EMFILE, ENFILE, ENOBUFS, ENOMEM
+try:
+    from socket import SO_REUSEPORT
+except ImportError:
+    SO_REUSEPORT = 15 # Linux
 
 from messages import *
 from mempair import *
+from output import p9outqueue
+
+# The C library with the access to errno
+from output import libc as errnolibc
+
+from struct import Struct
+from time import time, sleep
+import os
 
 # Modules for asynchronous queue processing
 import threading
-import Queue
+from workqueue import p9workqueue
+
+# Fid tables of the sessions and the path cache of the server
+from fids import p9fidtable, p9pathcache
+
+# Message counters and latency histograms
+from metrics import p9stats
 
 # Limit the size of the message queue
 MAXWAITING = 1024
 
-# The number of threads per queue
+# The initial number of the queue worker threads
 QTHREADS = 2
 
-def basereply (tmsg, rtype = -1):
+# The maximum number of the queue worker threads
+MAXTHREADS = 16
+
+# The default limit of the number of simultaneous sessions
+MAXSESSIONS = 1024
+
+# The default number of the messages of a session processed at a time
+MAXACTIVE = 1
+
+# The default limit of the message size negotiated with Tversion
+MAXMSIZE = 1024 * 1024
+
+# The default time (seconds) the queued messages are given to be
+# processed on shutdown
+DRAINTIMEOUT = 5.0
+
+# The delay (seconds) before the next accept when out of descriptors
+ACCEPTDELAY = 0.1
+
+# The size classes of the message buffers
+BUFSIZES = (128, NORM_MSG_SIZE, MAX_MSG_SIZE)
+
+# The pool of the reply message buffers
+buffers = bufferpool(BUFSIZES)
+
+def buildmsg (values):
+    """
+    Returns the mempair object of the 9P message with the fields
+    set from the given dictionary. The message is built in the
+    smallest pooled buffer it fits, which should be returned to
+    the pool when the message is sent. The messages longer than
+    the largest size class (the large Rread or Twrite messages)
+    are built in the buffers of their own
+    """
+    bufsize = sizeof(p9msg) + sum([len(value) for value in values.values() if isinstance(value, (basestring, bytearray))])
+    while True:
+        msgdata = buffers.get(bufsize)
+        try:
+            (msg, size) = build(p9msg, values, msgdata)
+            break
+        except OverflowError:
+            buffers.put(msgdata)
+            bufsize = len(msgdata) * 2
+    msg.size = size
+
+    return msg
+
+def basereply (tmsg, rtype = -1, **values):
     """
     Returns the corresponding R-message mempair object for
-    a given T-message mempair object
+    a given T-message mempair object. The fields of the
+    reply message are set from the given keyword arguments.
+    The message is built in a pooled buffer (see ``buildmsg``),
+    which is returned to the pool when the message is sent
     """
     if rtype < 0:
         rtype = tmsg.type + 1
-    msgdata = (c_ubyte * NORM_MSG_SIZE)()
-    replymsg = mempair(p9msg, msgdata)
-    replymsg.type = rtype
-    replymsg.tag = tmsg.tag
-    (baddr, bsize) = replymsg.carbuf()
-    replymsg.size = bsize
-    
-    return replymsg
+    values["type"] = rtype
+    values["tag"] = tmsg.tag
+    return buildmsg(values)
 
 def errorreply (tmsg, emsg):
     """
     Returns the Rerror message mempair object with a given
     error message for a given T-message
     """
-    replymsg = basereply(tmsg, Rerror._type)
-    replymsg.ename.len = len(emsg)
-    replymsg.ename.raw = emsg
-    return replymsg
+    return basereply(tmsg, Rerror._type, ename = emsg)
+
+# The header of the messages with a data payload:
+# size[4] type[1] tag[2] count[4]
+payloadheader = Struct("<IBHI")
 
+# The header of the Twrite message:
+# size[4] type[1] tag[2] fid[4] offset[8] count[4]
+writeheader = Struct("<IBHIQI")
 
-class p9socketworker(threading.Thread):
+def payloadview (msg):
     """
-    Processes the T-message queue running a thread
+    Returns a ``memoryview`` of the data of the given Twrite (or
+    Rread) message mempair object. The view refers right to the
+    buffer the message is received into, so no data is copied.
+    It keeps the whole receive buffer from being released, so the
+    backend should copy the data (``view.tobytes()``) if it keeps
+    it after the request is processed. Raises ``ValueError`` if
+    the count of the message doesn't match its size
     """
+    if msg.type == Twrite._type:
+        hsize = writeheader.size
+    else:
+        hsize = payloadheader.size
+    if msg.count != msg.size - hsize:
+        raise ValueError ("Invalid data count: %i" % msg.count)
+    return msg.view(msg.size)[hsize:]
+
+class prebuiltreply (object):
+    """
+    A preallocated reply message. Only the tag is set when
+    a copy of the message is made for a particular T-message.
+    The copies are made in the pooled buffers
+    """
+    def __init__ (self, rtype, **values):
+        """
+        Builds the reply message of the given type with the
+        fields set from the given keyword arguments
+        """
+        values["type"] = rtype
+        values["tag"] = 0
+        msgdata = bytearray(NORM_MSG_SIZE)
+        (msg, size) = build(p9msg, values, msgdata)
+        msg.size = size
+        self.__data = bytes(msgdata[:size])
+
+    def reply (self, tmsg):
+        """
+        Returns a copy of the reply message for the given
+        T-message mempair object
+        """
+        msgdata = buffers.get(len(self.__data))
+        msgdata[:len(self.__data)] = self.__data
+        replymsg = mempair(p9msg, msgdata)
+        replymsg.tag = tmsg.tag
+        return replymsg
+
+class p9payload (object):
+    """
+    A reply message with a data payload (Rread), the data of which
+    is sent right from the given object without copying it into the
+    message buffer. The payload is either an object supporting the
+    buffer interface (a string, a bytearray, an mmap object, a
+    contiguous memoryview) or a (fd, offset, length) tuple defining
+    a region of a file. The ``release`` function, if given, is
+    called with the payload object or the file descriptor when the
+    data is sent
+    """
+    def __init__ (self, tmsg, payload, rtype = -1, release = None):
+        """
+        Makes the reply with the given payload for the given
+        T-message mempair object
+        """
+        if rtype < 0:
+            rtype = tmsg.type + 1
+        if isinstance(payload, tuple):
+            length = payload[2]
+        elif isinstance(payload, memoryview):
+            length = len(payload) * payload.itemsize
+        else:
+            length = len(buffer(payload))
+        self.type = rtype
+        self.tag = tmsg.tag
+        self.payload = payload
+        self.length = length
+        self.release = release
+        self.size = payloadheader.size + length
+        self.header = buffers.get(payloadheader.size)
+        payloadheader.pack_into(self.header, 0, self.size, rtype, self.tag, length)
+
+    def queue (self, output):
+        """
+        Queues the header and the payload to the given
+        ``p9outqueue`` object
+        """
+        output.lock()
+        try:
+            output.put(self.header, 0, payloadheader.size)
+            if not self.length:
+                self.discard(False)
+            elif isinstance(self.payload, tuple):
+                (fd, offset, length) = self.payload
+                output.putfile(fd, offset, length, self.release)
+            else:
+                output.put(self.payload, 0, self.length, self.release)
+        finally:
+            output.unlock()
+
+    def copy (self):
+        """
+        Returns the reply as an ordinary message built in a
+        pooled buffer
+        """
+        if isinstance(self.payload, tuple):
+            (fd, offset, length) = self.payload
+            chunks = []
+            while length > 0:
+                chunk = preadfile(fd, offset, length)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+                length -= len(chunk)
+            data = "".join(chunks)
+        elif isinstance(self.payload, memoryview):
+            data = self.payload.tobytes()
+        else:
+            data = buffer(self.payload)[:]
+        self.discard()
+        return basereply(self, self.type, count = len(data), data = data)
+
+    def discard (self, header = True):
+        """
+        Releases the payload and the header buffer
+        """
+        if header:
+            buffers.put(self.header)
+        if self.release is not None:
+            if isinstance(self.payload, tuple):
+                self.release(self.payload[0])
+            else:
+                self.release(self.payload)
+
+def preadfile (fd, offset, length):
+    """
+    Reads the given number of bytes of the file with the given
+    descriptor starting at the given offset
+    """
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, length)
+
+# The error replies for the messages that are not supported
+unsupported = dict([(msgclass._type, prebuiltreply(Rerror._type, ename = "Currently the message %s is not supported. Sorry!" % msgclass.__name__)) for msgclass in p9msgclasses if msgclass is not None])
+
+# The error reply for the messages received after the server is closed
+closederror = prebuiltreply(Rerror._type, ename = "The server is closed")
+
+# The error reply for the messages not processed because the server
+# is shutting down
+shutdownerror = prebuiltreply(Rerror._type, ename = "The server is shutting down")
+
+# The error reply for the messages of an unknown type
+unknownerror = prebuiltreply(Rerror._type, ename = "Unknown message type")
+
+
+class p9flushed (Exception):
+    """
+    Raised by a handler to abort the processing of a flushed
+    request
+    """
+    pass
+
+class p9token (object):
+    """
+    The cancellation token of a queued request. The token is
+    cancelled when the request is flushed by the client; the
+    Rflush replies are kept in the token till the request is
+    finished. A request answered with Rerror by the server
+    shutdown is marked ``aborted``, unless its reply is being
+    sent already (``completed``)
+    """
+    def __init__ (self, tag):
+        self.tag = tag
+        self.cancelled = False
+        self.aborted = False
+        self.completed = False
+        self.flushes = []
+
+    def cancel (self):
+        self.cancelled = True
+
+
+class p9dispatcher (object):
+    """
+    Dispatches the T-messages to their handlers.
+
+    The messages are dispatched with the use of the ``handlers``
+    table that maps a T-message type to the name of the method
+    handling it. Each handler takes the session and the T-message
+    and returns the reply message. The table is resolved to the
+    bound methods once, so adding a handler doesn't affect the
+    cost of dispatching the other messages. The ``blocking`` set
+    lists the types of the messages which handlers may block and
+    thus should be processed by the queue workers.
+
+    The handlers are timed and counted by the message type in the
+    ``stats`` registry of the server (see the ``metrics`` module)
+    """
+
+    handlers = {
+        Tversion._type: "version",
+    }
+
+    blocking = frozenset()
+
     def __init__ (self, sock):
         self.__sock = sock
-        threading.Thread.__init__(self)
+        self.__dispatch = dict([(msgtype, getattr(self, name)) for (msgtype, name) in self.handlers.items()])
 
     def getversion (self, verstr, msize):
         """
@@ -91,12 +360,68 @@ class p9socketworker(threading.Thread):
         send equal or less than the size given in ``msize``
         """
 
-        if msize <= MAX_MSG_SIZE:
+        if msize <= self.__sock.maxmsize:
             rmsize = msize
         else:
-            rmsize = MAX_MSG_SIZE
+            rmsize = self.__sock.maxmsize
         return (VERSION9P, rmsize)
 
+    def dispatch (self, session, msg):
+        """
+        Returns the reply message for the given T-message
+        """
+        start = time()
+        try:
+            return self.handle(session, msg)
+        finally:
+            self.__sock.stats.current().handled(msg.type, time() - start)
+
+    def handle (self, session, msg):
+        """
+        Calls the handler of the given T-message and returns its
+        result, not counting the call
+        """
+        if self.__sock.closed:
+            return closederror.reply(msg)
+        try:
+            handler = self.__dispatch[msg.type]
+        except KeyError:
+            try:
+                return unsupported[msg.type].reply(msg)
+            except KeyError:
+                return unknownerror.reply(msg)
+        return handler(session, msg)
+
+    def release (self, fid):
+        """
+        Releases the given ``p9fid`` entry removed from the fid
+        table of a session. Called by the fid tables of all the
+        sessions of the server (see ``p9server.release``)
+        """
+        pass
+
+    def version (self, session, msg):
+        """
+        Handles the Tversion message
+        """
+        session.debug ("Requested 9P version: %s, maximum size: %i bytes", msg.version.raw, msg.msize)
+        (rver, rmsize) = self.getversion(msg.version.raw, msg.msize)
+        session.setmsize(rmsize)
+        rmsg = basereply(msg, msize = rmsize, version = rver)
+        session.debug ("Supported 9P version: %s, maximum size: %i bytes", rver, rmsize)
+        return rmsg
+
+
+class p9socketworker (p9dispatcher, threading.Thread):
+    """
+    Processes the T-message queue running a thread. A handler
+    failure is answered with Rerror, so the worker keeps running
+    """
+    def __init__ (self, sock):
+        self.__sock = sock
+        p9dispatcher.__init__(self, sock)
+        threading.Thread.__init__(self)
+
     def run (self):
         while True:
             (session, msg) = self.__sock.nextmsg()
@@ -104,28 +429,33 @@ class p9socketworker(threading.Thread):
                 self.__sock.debug ("Worker finished")
                 break # reached the end of the queue
 
-            if self.__sock.closed:
-                self.__sock.reply (errorreply (msg, "The server is closed"))
-            
-            if msg.type == Tversion._type:
-                session.debug ("Requested 9P version: %s, maximum size: %i bytes" % (msg.version.raw, msg.msize))
-                (rver, rmsize) = self.getversion(msg.version.raw, msg.msize)
-                session.msize = rmsize
-                rmsg = basereply(msg)
-                rmsg.msize = rmsize;
-                rmsg.version.len = len(rver)
-                rmsg.version.raw = rver
-                session.debug ("Supported 9P version: %s, maximum size: %i bytes" % (rmsg.version.raw, rmsg.msize))
-            else:
-                session.debug ("An unknown case! Message type: %i" % msg.type)
-                emsg = "Currently the message %s is not supported. Sorry!" % p9msgclasses[msg.type].__name__
-                rmsg = errorreply(msg, emsg)
-                session.debug (emsg)
-
-            session.reply(rmsg)
+            token = session.token(msg)
+            try:
+                try:
+                    rmsg = self.dispatch(session, msg)
+                except p9flushed:
+                    session.debug ("The processing of the %i tag is aborted", msg.tag)
+                    if session.complete(token):
+                        session.finish(msg.tag, token)
+                    continue
+                except Exception as e:
+                    session.debug ("Unable to process the %i tag: %s", msg.tag, e)
+                    rmsg = errorreply(msg, str(e))
+                if not session.complete(token):
+                    session.debug ("The %i tag is answered on shutdown, the reply is dropped", msg.tag)
+                    if isinstance(rmsg, p9payload):
+                        rmsg.discard()
+                    else:
+                        buffers.put(rmsg.data)
+                    continue
+                session.reply(rmsg, False)
+            except (IOError, ValueError) as e:
+                session.debug ("Unable to send the reply: %s", e)
+            finally:
+                self.__sock.msgdone(session)
 
 
-__all__ = [ "p9socket" ]
+__all__ = [ "p9socket", "p9payload", "payloadview" ]
 
 class sockaddr_in (Structure):
     _pack_ = 2
@@ -136,25 +466,160 @@ class sockaddr_in (Structure):
         ("sin_zero", (c_uint8 * 8)),
     ]
 
-class p9socket (object):
+class p9server (object):
+    """
+    The state of a 9P server common to the socket server and the
+    asyncio server: the sessions, the path cache, the metrics and
+    the ``dispatcher`` handling the messages
+    """
+
+    # Print the debug messages
+    debugging = False
+
+    closed = True
+
+    def __init__ (self, dispatcher, maxsessions = MAXSESSIONS, maxmsize = MAXMSIZE):
+        """
+        Sets up the server handling the messages with the given
+        ``p9dispatcher`` object and serving no more than
+        ``maxsessions`` sessions at a time. The clients may
+        negotiate the message size up to ``maxmsize`` bytes
+        """
+        self.dispatcher = dispatcher
+        self.maxsessions = maxsessions
+        self.maxmsize = maxmsize
+        self.paths = p9pathcache()
+        self.stats = p9stats()
+        self.sessions = set()
+        self.__slock = threading.Lock()
+
+    def register (self, session):
+        """
+        Registers the given session. Returns ``False`` if the
+        limit of the number of sessions is reached
+        """
+        self.__slock.acquire()
+        try:
+            if len(self.sessions) >= self.maxsessions:
+                return False
+            self.sessions.add(session)
+            return True
+        finally:
+            self.__slock.release()
+
+    def release (self, fid):
+        """
+        Releases the given ``p9fid`` entry removed from the fid
+        table of a session with the use of the dispatcher (see
+        ``p9dispatcher.release``)
+        """
+        self.dispatcher.release(fid)
+
+    def unregister (self, session):
+        """
+        Unregisters the given session
+        """
+        self.__slock.acquire()
+        self.sessions.discard(session)
+        self.__slock.release()
+        session.fids.clear()
+
+    def traffic (self):
+        """
+        Returns the list of the traffic statistics of the sessions
+        (see ``p9channel.traffic``)
+        """
+        return [session.traffic() for session in list(self.sessions)]
+
+    def snapshot (self):
+        """
+        Returns the dictionary of the server metrics: the message
+        counters and the handler and send time histograms (see
+        ``p9metrics.snapshot``), the traffic of each session
+        (``sessions``) and the path cache and the buffer pool
+        statistics. The times are given in microseconds
+        """
+        result = self.stats.collect().snapshot()
+        result.update({
+            "sessions": self.traffic(),
+            "paths": self.paths.stats(),
+            "buffers": buffers.stats(),
+        })
+        return result
+
+    def debug (self, fmt, *args):
+        """
+        Outputs the given debug message if in debug mode. The
+        message is formatted with the given arguments only then
+        """
+        if self.debugging:
+            print (fmt % args if args else fmt)
+
+
+class p9socket (p9server):
     """
     9P core
     """
     fd = None    # socket file descriptor
 
-    # The message queue
-    __msgq = Queue.Queue(MAXWAITING)
-
-    __debug = True
+    # Set when the graceful shutdown is started
+    draining = False
 
-    closed = True
+    # The class of the queue workers
+    workerclass = p9socketworker
 
-    def __init__(self, address='0.0.0.0',port=10001):
+    def __init__(self, address='0.0.0.0',port=10001, reactor=False, maxsessions=MAXSESSIONS, workers=QTHREADS, maxworkers=MAXTHREADS, maxwaiting=MAXWAITING, maxmsize=MAXMSIZE, maxactive=MAXACTIVE, reuseport=False):
         """
-        Create and bind socket structure
+        Create and bind socket structure.
+
+        If ``reactor`` is set the server multiplexes all the
+        client connections in a single event loop (see the
+        ``reactor`` module) instead of running a thread per
+        session. No more than ``maxsessions`` sessions are
+        served at a time.
+
+        The queued messages are processed by ``workers`` threads.
+        More threads are started, up to ``maxworkers``, when a
+        message is queued while all the workers are busy. No
+        more than ``maxwaiting`` messages are queued at a time.
+        No more than ``maxactive`` messages of a session are
+        processed at a time: the default of one message keeps the
+        replies in the order of the requests.
+
+        The clients may negotiate the message size up to
+        ``maxmsize`` bytes. The receive buffer of a session grows
+        to the negotiated size only.
+
+        If ``reuseport`` is set the port may be bound by several
+        sockets at once (SO_REUSEPORT), so the connections are
+        balanced among the server processes bound to it (see the
+        ``prefork`` module).
+
+        The path cache shared by the sessions is kept in ``paths``
+        (see the ``fids`` module), the message counters and the
+        latency histograms in ``stats`` (see the ``metrics``
+        module). The messages handled in the reactor loop and the
+        fids released by the sessions are passed to an instance
+        of the ``workerclass`` that is not run (``dispatcher``)
         """
+        p9server.__init__(self, self.workerclass(self), maxsessions, maxmsize)
+        self.reactor = reactor
+        self.maxworkers = maxworkers
+        self.workers = []
+        self.queue = p9workqueue(maxwaiting, self.grow, maxactive)
+        self.deadline = None
+        self.report = None
+        self.rejected = 0
+        self.aborted = 0
+        self.__pending = 0
+        self.__finished = threading.Event()
+        self.__slock = threading.Lock()
+        self.__wlock = threading.Lock()
+
         self.fd = libc.socket(AF_INET,SOCK_STREAM,0)
         libc.setsockopt(self.fd, SOL_SOCKET, SO_REUSEADDR, byref(c_uint32(1)), sizeof(c_uint32))
+        if reuseport:
+            libc.setsockopt(self.fd, SOL_SOCKET, SO_REUSEPORT, byref(c_uint32(1)), sizeof(c_uint32))
 
         sa = sockaddr_in()
         sa.sin_family = AF_INET
@@ -168,205 +633,519 @@ class p9socket (object):
             self.close()
             raise Exception("libc.bind(): errcode %i" % (l))
 
-        for i in range(QTHREADS):
-            p9socketworker(self).start()
+        for i in range(workers):
+            self.grow()
+
+    def grow (self):
+        """
+        Starts one more queue worker unless the maximum number
+        of workers is reached
+        """
+        self.__wlock.acquire()
+        try:
+            if self.workers and len(self.workers) >= self.maxworkers:
+                return
+            worker = self.workerclass(self)
+            self.workers.append(worker)
+        finally:
+            self.__wlock.release()
+        worker.start()
+        self.debug ("Started the queue worker #%i", len(self.workers))
 
     def close(self):
         """
-        Close the socket
+        Closes the server at once: the waiting messages are answered
+        with Rerror, the connections are shut down and the queue
+        workers finish as soon as they process their current
+        messages. Doesn't wait for them (see ``shutdown`` for the
+        graceful shutdown)
         """
-        for i in range(QTHREADS):
-            self.enqueue (None, None)
-        self.debug ("Waiting for queue workers to finish...")
-        self.__msgq.join()
-        libc.close(self.fd)
         self.closed = True
+        self.abort()
+        for session in list(self.sessions):
+            session.shutdown()
+        self.queue.stop()
+        if self.fd is not None:
+            errnolibc.shutdown(self.fd, SHUT_RDWR)
+            libc.close(self.fd)
+            self.fd = None
+
+    def shutdown (self, timeout = DRAINTIMEOUT, wait = False):
+        """
+        Starts the graceful shutdown of the server. The new
+        connections are not accepted and the new messages of the
+        sessions are answered with Rerror, while the queued ones
+        are given ``timeout`` seconds to be processed. Then the
+        rest of them are answered with Rerror, the connections
+        are closed and ``serve()`` returns the report (see
+        ``finish``). May be called from any thread or from a
+        signal handler. If ``wait`` is set, waits for the
+        shutdown to complete and returns the report
+        """
+        if not self.draining and not self.closed:
+            self.deadline = time() + timeout
+            self.__pending = self.queue.unfinished
+            self.draining = True
+            errnolibc.shutdown(self.fd, SHUT_RD)
+            self.debug ("Shutting down, %i messages to process", self.__pending)
+        if wait:
+            self.__finished.wait()
+        return self.report
+
+    def drained (self):
+        """
+        Indicates if the shutdown can be completed: all the queued
+        messages are processed or the time is out
+        """
+        return self.draining and (not self.queue.unfinished or time() >= self.deadline)
+
+    def reject (self, session, msg):
+        """
+        Answers the given message of the given session received
+        while the server is shutting down with Rerror
+        """
+        self.__slock.acquire()
+        self.rejected += 1
+        self.__slock.release()
+        session.reply (shutdownerror.reply(msg), False)
+
+    def abort (self):
+        """
+        Answers the waiting messages and the messages being
+        processed with Rerror. The latter are cancelled (see
+        ``p9channel.check``) and the late replies to them are
+        dropped. Returns the number of the messages answered
+        """
+        msgs = self.queue.abort()
+        for (session, msg) in msgs:
+            try:
+                session.reply (shutdownerror.reply(msg), False)
+            except (IOError, ValueError) as e:
+                session.debug ("Unable to send the reply: %s", e)
+        count = len(msgs)
+        for session in list(self.sessions):
+            count += session.abortall()
+        self.__slock.acquire()
+        self.aborted += count
+        self.__slock.release()
+        return count
+
+    def finish (self):
+        """
+        Completes the shutdown: aborts the messages left and closes
+        the server. Returns the report: the numbers of the messages
+        processed after the shutdown is started (``drained``),
+        aborted (``aborted``) and received after the shutdown is
+        started (``rejected``)
+        """
+        self.abort()
+        self.close()
+        self.report = {
+            "drained": max(0, self.__pending - self.aborted),
+            "aborted": self.aborted,
+            "rejected": self.rejected,
+        }
+        self.debug ("The server is shut down: %i messages drained, %i aborted, %i rejected", self.report["drained"], self.report["aborted"], self.report["rejected"])
+        self.__finished.set()
+        return self.report
 
     def dial(self,target):
         """
-        Client connection
+        Client connection: connects to the 9P server at the given
+        (address, port) and returns the ``p9client`` object
+        (see the ``client`` module)
         """
-        pass
+        from client import p9client
+        return p9client(target[0], target[1], self.maxmsize)
 
-    def enqueue (self, session, msg):
+    def enqueue (self, session, msg, block = True):
         """
-        Enqueue the given reply message for later processing
+        Enqueue the given message of the given session for later
+        processing. Returns ``False`` if the queue is full (see
+        ``p9workqueue.put``)
         """
-        self.__msgq.put((session, msg))
+        return self.queue.put(session, msg, block)
+
+    def unregister (self, session):
+        """
+        Unregisters the given session and discards its waiting
+        messages
+        """
+        self.queue.forget(session)
+        p9server.unregister(self, session)
+
+    def queuestats (self):
+        """
+        Returns the dictionary mapping each session to the
+        statistics of its message queue (see ``p9workqueue.stats``)
+        """
+        return self.queue.stats()
+
+    def snapshot (self):
+        """
+        Returns the dictionary of the server metrics (see
+        ``p9server.snapshot``) with the queue wait time histogram
+        (``queue``) and the number of the queue workers
+        """
+        result = p9server.snapshot(self)
+        result.update({
+            "queue": self.queue.waits.snapshot(),
+            "workers": len(self.workers),
+        })
+        return result
+
+    def traffic (self):
+        """
+        Returns the list of the traffic statistics of the sessions
+        with the statistics of their message queues (``queue``)
+        """
+        queues = self.queue.stats()
+        sessions = []
+        for session in list(self.sessions):
+            traffic = session.traffic()
+            if session in queues:
+                traffic["queue"] = queues[session]
+            sessions.append(traffic)
+        return sessions
 
     def serve(self):
         """
-        9p server
+        9p server. Runs until the server is shut down and returns
+        the shutdown report (see ``shutdown``). In the threaded
+        mode the SIGINT signal starts the shutdown. On an error
+        the server is closed at once and the error is raised
         """
         libc.listen(self.fd,10)
         self.closed = False
-        while True:
-            sa = sockaddr_in()
-            try:
-                s = libc.accept(self.fd, byref(sa), byref(c_uint32(sizeof(sa))))
-                p9session(self, s).start()
-            except:
-                self.close()
-                raise
+        try:
+            if self.reactor:
+                from reactor import p9reactor
+                p9reactor(self).run()
+            else:
+                self.accept()
+                if not self.closed:
+                    self.queue.join(max(0, self.deadline - time()))
+        except BaseException:
+            self.close()
+            self.__finished.set()
+            raise
+        return self.finish()
 
-    def debug (self, dmsg):
+    def accept (self):
         """
-        Outputs the given debug message if in debug mode
+        Accepts the client connections and starts their sessions
+        until the server is shutting down
         """
-        if self.__debug:
-            print (dmsg)
+        try:
+            while not self.draining and not self.closed:
+                sa = sockaddr_in()
+                s = errnolibc.accept(self.fd, byref(sa), byref(c_uint32(sizeof(sa))))
+                if s < 0:
+                    errno = get_errno()
+                    if self.draining or self.closed:
+                        break
+                    if errno in (EINTR, ECONNABORTED, EPROTO):
+                        continue
+                    if errno in (EMFILE, ENFILE, ENOBUFS, ENOMEM):
+                        self.debug ("Unable to accept a connection: %s", os.strerror(errno))
+                        sleep(ACCEPTDELAY)
+                        continue
+                    raise IOError (errno, os.strerror(errno))
+                libc.setsockopt(s, IPPROTO_TCP, TCP_NODELAY, byref(c_uint32(1)), sizeof(c_uint32))
+                session = p9session(self, s)
+                if self.register(session):
+                    session.start()
+                else:
+                    self.debug ("Too many sessions, the connection is refused")
+                    libc.close(s)
+        except KeyboardInterrupt:
+            self.shutdown()
 
     def nextmsg (self):
         """
-        Returns the next message from the queue
+        Returns the next message from the queue as the (session,
+        msg) tuple. The messages of the closed sessions and the
+        flushed ones are skipped. Returns (None, None) when the
+        queue is stopped
         """
-        msg = None
-        next = True
-        while next:
-            next = False
-            (session, msg) = self.__msgq.get()
+        while True:
+            (session, msg) = self.queue.get()
             if msg is None:
-                self.__msgq.task_done()
+                return (None, None)
+            if session.closed:
+                self.queue.done(session)
+            elif session.isflushed(msg):
+                session.finish(msg.tag)
+                self.queue.done(session)
             else:
-                next = (session.closed or session.clearflushed(msg))
-        return (session, msg)
+                return (session, msg)
 
-    def msgdone (self):
+    def msgdone (self, session):
         """
-        Tels the server that a message taken from the queue
-        is successfully processed
+        Tels the server that a message of the given session taken
+        from the queue is successfully processed
         """
-        self.__msgq.task_done()
+        self.queue.done(session)
 
 
-class p9session (threading.Thread):
+class p9channel (object):
     """
-    Client-server connection via 9P
+    The state of a client-server connection via 9P common to
+    the threaded sessions and the reactor connections
     """
-    def __init__(self, p9sock, clsock, p9msize = MAX_MSG_SIZE):
+    def __init__(self, p9sock, fd, p9msize = MAX_MSG_SIZE):
         """
-        Initializes the session object bound to the specified
-        9P socket instance
+        Initializes the channel object bound to the specified
+        9P socket instance and the given client socket
         """
-        self.__sock = p9sock
-        self.__clsock = clsock
+        self.server = p9sock
+        self.fd = fd
         self.msize = p9msize
+        self.input = None
+        self.output = None
+        self.bytesin = 0
+        self.bytesout = 0
+        self.fids = p9fidtable(release = p9sock.release)
         self.__lock = threading.Lock()
-        self.__flushed = {}
+        self.__tokens = {}
         self.closed = False
-        threading.Thread.__init__(self)
 
-    def markflushed (self, oldtag):
+    def setmsize (self, msize):
         """
-        Mark the given tag as flushed (aborted)
+        Sets the maximum message size negotiated with the client.
+        The longer messages are rejected by the input stream
         """
-        self.__lock.acquire()
-        self.__flushed[oldtag] = True
-        self.__lock.release()
+        self.msize = msize
+        if self.input is not None:
+            self.input.maxsize = msize
+
+    def iounit (self):
+        """
+        Returns the maximum amount of data that a single Tread or
+        Twrite request of the session may carry
+        """
+        return self.msize - IOHDRSZ
+
+    def traffic (self):
+        """
+        Returns the dictionary of the traffic of the session: the
+        numbers of the bytes received and sent, the number of the
+        bytes waiting to be sent, the number of the fids and the
+        histogram of the sizes of the socket writes as the [upper
+        bound, count] pairs of the power-of-two buckets (``writes``)
+        """
+        if self.output is not None:
+            (bytesout, queued) = (self.output.written, self.output.queued)
+            writes = [[size, n] for (size, n) in sorted(self.output.histogram.items())]
+        else:
+            (bytesout, queued, writes) = (self.bytesout, 0, [])
+        return {
+            "fd": self.fd,
+            "bytesin": self.bytesin,
+            "bytesout": bytesout,
+            "queued": queued,
+            "fids": len(self.fids),
+            "writes": writes,
+        }
+
+    def token (self, msg):
+        """
+        Returns the cancellation token of the given queued
+        T-message or ``None`` if the message isn't queued
+        """
+        return self.__tokens.get(msg.tag)
 
     def isflushed (self, msg):
         """
         Indicates if the given message is flushed (aborted)
-        """        
-        return msg.tag in self.__flushed
+        """
+        token = self.__tokens.get(msg.tag)
+        return token is not None and token.cancelled
 
-    def clearflushed (self, arg):
+    def check (self, msg):
         """
-        Unmark the given message or tag from the set of
-        flushed (aborted) messages/tags
+        Raises ``p9flushed`` if the given message is flushed.
+        Long running handlers should call it from time to time
         """
-        if isinstance (arg, mempair):
-            tag = arg.tag
-        else:
-            tag = arg
+        token = self.__tokens.get(msg.tag)
+        if token is not None and token.cancelled:
+            raise p9flushed (msg.tag)
+
+    def cancel (self, msg):
+        """
+        Handles the given Tflush message. If the flushed request
+        is being processed, its token is cancelled and the Rflush
+        reply is deferred till the request is finished. Otherwise
+        Rflush is sent at once
+        """
+        self.server.stats.current().count(msg.type)
         self.__lock.acquire()
-        if tag in self.__flushed:
-            del self.__flushed[tag]
-            ret = True
-        else:
-            ret = False
+        token = self.__tokens.get(msg.oldtag)
+        if token is not None:
+            token.cancel()
+            token.flushes.append(basereply(msg))
         self.__lock.release()
-        return ret
+        self.debug ("Flush the %i tag", msg.oldtag)
+        if token is None:
+            self.reply (basereply(msg), False)
 
-    def run (self):
+    def abortall (self):
         """
-        Receive and transmit messages
+        Answers the messages being processed with Rerror and
+        cancels their tokens, so the replies of the handlers are
+        dropped (see ``complete``). Returns the number of the
+        messages answered
         """
-        self.debug ("Start a new session")
+        self.__lock.acquire()
+        tokens = [token for token in self.__tokens.values() if not token.completed and not token.aborted]
+        for token in tokens:
+            token.cancel()
+            token.aborted = True
+        self.__lock.release()
+        for token in tokens:
+            try:
+                self.reply (shutdownerror.reply(token), False)
+            except (IOError, ValueError) as e:
+                self.debug ("Unable to send the reply: %s", e)
+        return len(tokens)
+
+    def complete (self, token):
+        """
+        Marks the request with the given token as completed by
+        its handler. Returns ``False`` if the request is answered
+        already by the server shutdown (or the token is ``None``,
+        which means it's discarded by the time the handler takes
+        the request), so the reply should be dropped
+        """
+        if token is None:
+            return False
+        self.__lock.acquire()
         try:
-            while not self.__sock.closed:
-                try:
-                    (l, msg) = self.recv()
-                    self.debug ("%i bytes received" % l)
-                except IOError:
-                    break
-                if msg.type == Tflush._type:
-                    self.markflushed (msg.oldtag)
-                    self.debug ("Flush the %i tag" % msg.oldtag)
-                    self.reply (basereply(msg), False)
-                else:
-                    self.__sock.enqueue (self, msg)
-            libc.close(self.__clsock)
-            self.closed = True
-            self.debug ("The session is closed")
-        except:
-            libc.close(self.__clsock)
-            self.closed = True
-            self.debug ("The session is closed on an error")
-            raise
+            token.completed = not token.aborted
+            return token.completed
+        finally:
+            self.__lock.release()
+
+    def finish (self, tag, token = None):
+        """
+        Discards the token of the request with the given tag and
+        sends the Rflush replies deferred till its completion.
+        If the token is given, it's discarded only if it's still
+        the token of the tag: the client may reuse the tag as
+        soon as the reply is sent
+        """
+        self.__lock.acquire()
+        if token is None:
+            token = self.__tokens.pop(tag, None)
+        elif self.__tokens.get(tag) is token:
+            del self.__tokens[tag]
+        self.__lock.release()
+        if token is not None:
+            for rmsg in token.flushes:
+                self.reply (rmsg, False)
+
+    def received (self, msg):
+        """
+        Processes the given T-message received from the client:
+        flushes are handled at once, the other messages are
+        enqueued for the queue workers or rejected if the server
+        is shutting down
+        """
+        if msg.type == Tflush._type:
+            self.cancel (msg)
+        elif self.server.draining:
+            self.server.reject (self, msg)
+        else:
+            self.__lock.acquire()
+            self.__tokens[msg.tag] = p9token(msg.tag)
+            self.__lock.release()
+            self.enqueue (msg)
+
+    def enqueue (self, msg):
+        """
+        Passes the given message to the queue workers. Waits
+        while the queue of the server is full
+        """
+        self.server.enqueue (self, msg)
 
     def nextmsg (self):
         """
         A proxy method to the parent socket ``nextmsg`` proc
         """
-        return self.__sock.nextmsg()
+        return self.server.nextmsg()
 
-    def debug (self, dmsg):
+    def debug (self, fmt, *args):
         """
         A proxy method to the parent socket ``debug`` proc
         """
-        self.__sock.debug("[session] " + dmsg)
+        if self.server.debugging:
+            self.server.debug("[session] " + fmt, *args)
 
-    def recv(self):
+    def shutdown (self):
         """
-        Receive a request message from the client
-        """
-        msgdata = (c_ubyte * NORM_MSG_SIZE)()
-        msg = mempair(p9msg, msgdata)
-        (baddr, blen) = msg.databuf()
-        l = libc.recv(self.__clsock, baddr, blen, 0)
-        hdr = msg.car()
-        if l > sizeof(hdr):
-            if hdr.size > l:
-                if hdr.size > MAX_MSG_SIZE:
-                    raise IOError ("The message is too large: %d bytes" % hdr.size)
-                resize(msgdata, hdr.size)
-                (baddr, blen) = msg.databuf()
-                l2 = libc.recv(self.__clsock, baddr + hdr.size - l, blen - l, 0)
-                if l2 > 0:
-                    l += l2
-                else:
-                    raise IOError ("Unable to read the %d remaining bytes" % blen - l)
-        else:
-            raise IOError ("Unable to read the message")
+        Shuts the connection down, so the session finishes
+        """
+        errnolibc.shutdown(self.fd, SHUT_RDWR)
+
+    def transmit (self, rmsg, baddr, blen):
+        """
+        Sends the ``blen`` bytes of the given message at the
+        given address to the client. Returns the number of
+        bytes sent or queued to be sent. The channel takes the
+        ownership of the message buffer and should return it
+        to the pool when the data is sent. By default the
+        message is queued to the outbound queue, which is
+        flushed then. The replies queued by the other workers
+        while the queue is being written are sent with the same
+        call
+        """
+        self.output.put(rmsg.data, rmsg.dataoffset(), blen)
+        self.output.flush()
+        return blen
 
-        return (l, msg)
+    def transmitpayload (self, rmsg):
+        """
+        Sends the given ``p9payload`` reply to the client. Returns
+        the number of bytes sent or queued to be sent. By default
+        the header and the payload are queued to the outbound queue,
+        which is flushed then. A channel without an outbound queue
+        gets the reply copied into an ordinary message
+        """
+        if self.output is None:
+            msg = rmsg.copy()
+            (baddr, blen) = msg.buf()
+            return self.transmit(msg, baddr, blen)
+        rmsg.queue(self.output)
+        self.output.flush()
+        return rmsg.size
 
     def reply (self, rmsg, task_done = True):
         """
-        Send the given reply message to the client.
+        Send the given reply message (a mempair object or
+        a ``p9payload`` object) to the client.
         The size of the message is checked not to exceed the
         maximum message size, configured for this session.
         According to the 9P spec, the maximum message size is
         specified by the client with the T-version request.
         If the message is longer than a message client is ready
         to handle, then the Rerror message is sent and a
-        ValueError is raised
+        ValueError is raised. The buffer of the message is
+        returned to the pool once it's sent. The Rflush replies
+        deferred till the completion of the request are sent
+        after the reply. The I/O unit of the session is reported
+        in the Ropen and Rcreate replies unless set by the handler.
+        The send time is counted in the ``stats`` of the server
         """
-        (baddr, blen) = rmsg.buf()
-        rmsg.size = blen
+        if isinstance(rmsg, p9payload):
+            blen = rmsg.size
+        else:
+            (baddr, blen) = rmsg.buf()
+            if rmsg.size != blen:
+                rmsg.size = blen
+            if rmsg.type in (Ropen._type, Rcreate._type) and rmsg.iounit == 0:
+                rmsg.iounit = self.iounit()
         emsg = None
-        if rmsg.size > self.msize:
+        if blen > self.msize:
             emsg = errorreply (rmsg, "The reply message is too long")
             extra = emsg.size - self.msize
             if extra > emsg.ename.len:
@@ -374,12 +1153,103 @@ class p9session (threading.Thread):
             if extra > 0:
                 emsg.ename.len -= extra
                 emsg.size -= extra
+            if isinstance(rmsg, p9payload):
+                rmsg.discard()
+            else:
+                buffers.put(rmsg.data)
+            rmsg = emsg
             (baddr, blen) = emsg.buf()
-        l = libc.send(self.__clsock, baddr, blen, 0)
-        self.debug ("%i bytes sent" % l)
+        token = self.__tokens.get(rmsg.tag)
+        start = time()
+        if isinstance(rmsg, p9payload):
+            l = self.transmitpayload(rmsg)
+        else:
+            l = self.transmit(rmsg, baddr, blen)
+        self.server.stats.current().sent(time() - start, rmsg.type == Rerror._type)
+        if token is not None:
+            self.finish(rmsg.tag, token)
+        self.debug ("%i bytes sent", l)
         if l < blen:
             raise IOError ("Unable to send the message")
         if task_done:
-            self.__sock.msgdone()
+            self.server.msgdone(self)
         if emsg is not None:
             raise ValueError ("The message is too long")
+
+
+class p9session (p9channel, threading.Thread):
+    """
+    Client-server connection via 9P served by a thread
+    """
+    def __init__(self, p9sock, clsock, p9msize = MAX_MSG_SIZE):
+        """
+        Initializes the session object bound to the specified
+        9P socket instance
+        """
+        p9channel.__init__(self, p9sock, clsock, p9msize)
+        self.input = recordstream(p9msg, maxsize = MAX_MSG_SIZE)
+        self.output = p9outqueue(clsock, buffers.put)
+        threading.Thread.__init__(self)
+
+    def run (self):
+        """
+        Receive and transmit messages
+        """
+        self.debug ("Start a new session")
+        try:
+            while not self.server.closed:
+                try:
+                    msgs = self.recv()
+                except IOError:
+                    break
+                for msg in msgs:
+                    self.received (msg)
+            self.closed = True
+            self.output.clear()
+            libc.close(self.fd)
+            self.server.unregister(self)
+            self.debug ("The session is closed, write sizes: %s", sorted(self.output.histogram.items()))
+        except:
+            self.closed = True
+            self.output.clear()
+            libc.close(self.fd)
+            self.server.unregister(self)
+            self.debug ("The session is closed on an error")
+            raise
+
+    def recv(self):
+        """
+        Receive the request messages from the client.
+
+        The data is read into the session input stream: the
+        call blocks until some data is available and then reads
+        the data that is ready without blocking, up to the size
+        of the stream buffer. The complete messages are taken
+        from the stream after each read, so only the remainder
+        of an incomplete message is moved when the stream buffer
+        is renewed. Returns the list of the complete messages
+        received, which may be empty if the data received so far
+        is only a part of a message. The remainder is kept till
+        the next call
+        """
+        msgs = []
+        (flags, total) = (0, 0)
+        while True:
+            (baddr, blen) = self.input.space()
+            l = libc.recv(self.fd, baddr, blen, flags)
+            if l <= 0:
+                if flags:
+                    break
+                raise IOError ("Unable to read the message")
+            self.input.feed(l)
+            self.bytesin += l
+            total += l
+            self.debug ("%i bytes received", l)
+            try:
+                msgs.extend(self.input)
+            except ValueError as e:
+                raise IOError (str(e))
+            if l < blen or total >= self.input.bufsize:
+                break
+            flags = MSG_DONTWAIT
+        return msgs
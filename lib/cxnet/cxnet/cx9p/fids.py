@@ -0,0 +1,243 @@
+"""
+Fid tables and the path-component cache
+
+Each session keeps its fids in a ``p9fidtable``: a dictionary
+mapping the fid numbers to the ``p9fid`` entries, which hold the qid
+of the file, the backend object (node) the fid refers to and the
+mode the fid is opened in. The number of the fids of a session is
+limited, so a client can't make the server allocate the memory
+without bounds. The entries removed from the table, by Tclunk or
+Tremove or when the session is closed, are passed to the release
+function, so the backend can close the open files.
+
+The ``p9pathcache`` is shared by all the sessions of a server. It
+maps the (parent qid path, name) pairs to the (qid, node) pairs of
+the files looked up so far, so a walk is resolved with one
+dictionary lookup per path element while the elements are cached,
+not touching the backend. The parent of a cached file is cached
+under the ``..`` name. The least recently used entries are dropped
+when the cache is full.
+"""
+
+#     Copyright (c) 2011 Peter V. Saveliev
+#     Copyright (c) 2011 Paul Wolneykien
+#
+#     This file is part of Connexion project.
+#
+#     Connexion is free software; you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation; either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     Connexion is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with Connexion; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from collections import OrderedDict
+import threading
+
+__all__ = ["p9fid", "p9fidtable", "p9pathcache"]
+
+# The default limit of the number of the fids of a session
+MAXFIDS = 4096
+
+# The default limit of the number of the cached path components
+MAXPATHS = 65536
+
+class p9fid (object):
+    """
+    A fid entry: the qid and the backend object of the file and
+    the open mode (``None`` if the fid isn't open)
+    """
+    __slots__ = ("fid", "qid", "node", "mode")
+
+    def __init__ (self, fid, qid, node):
+        self.fid = fid
+        self.qid = qid
+        self.node = node
+        self.mode = None
+
+class p9fidtable (object):
+    """
+    The fids of a session
+    """
+    def __init__ (self, maxfids = MAXFIDS, release = None):
+        """
+        Sets up the table of no more than ``maxfids`` fids. The
+        ``release`` function is called with each entry removed
+        from the table
+        """
+        self.maxfids = maxfids
+        self.release = release
+        self.__fids = {}
+        self.__lock = threading.Lock()
+
+    def __len__ (self):
+        return len(self.__fids)
+
+    def get (self, fid):
+        """
+        Returns the entry of the given fid. Raises ValueError if
+        the fid is unknown
+        """
+        try:
+            return self.__fids[fid]
+        except KeyError:
+            raise ValueError ("Unknown fid: %i" % fid)
+
+    def add (self, fid, qid, node, replace = False):
+        """
+        Adds the entry of the given fid referring to the given
+        file and returns it. Raises ValueError if the fid is in use
+        (unless ``replace`` is set) or there are too many fids
+        """
+        entry = p9fid(fid, qid, node)
+        self.__lock.acquire()
+        try:
+            old = self.__fids.get(fid)
+            if old is not None and not replace:
+                raise ValueError ("The fid %i is in use" % fid)
+            if old is None and len(self.__fids) >= self.maxfids:
+                raise ValueError ("Too many fids")
+            self.__fids[fid] = entry
+        finally:
+            self.__lock.release()
+        if old is not None and self.release is not None:
+            self.release(old)
+        return entry
+
+    def remove (self, fid):
+        """
+        Removes the entry of the given fid and returns it. Raises
+        ValueError if the fid is unknown
+        """
+        self.__lock.acquire()
+        entry = self.__fids.pop(fid, None)
+        self.__lock.release()
+        if entry is None:
+            raise ValueError ("Unknown fid: %i" % fid)
+        if self.release is not None:
+            self.release(entry)
+        return entry
+
+    def clear (self):
+        """
+        Removes all the entries
+        """
+        self.__lock.acquire()
+        entries = self.__fids.values()
+        self.__fids.clear()
+        self.__lock.release()
+        if self.release is not None:
+            for entry in entries:
+                self.release(entry)
+
+class p9pathcache (object):
+    """
+    The cache of the path components shared by the sessions
+    """
+    def __init__ (self, maxpaths = MAXPATHS):
+        """
+        Sets up the cache of no more than ``maxpaths`` entries
+        """
+        self.maxpaths = maxpaths
+        self.hits = 0
+        self.misses = 0
+        self.__paths = OrderedDict()
+        self.__names = {}
+        self.__lock = threading.Lock()
+
+    def __len__ (self):
+        return len(self.__paths)
+
+    def get (self, parent, name):
+        """
+        Returns the (qid, node) pair of the file with the given
+        name in the directory with the given qid or ``None`` if
+        it isn't cached
+        """
+        key = (parent.path, name)
+        self.__lock.acquire()
+        try:
+            value = self.__paths.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__paths[key] = value
+            return value
+        finally:
+            self.__lock.release()
+
+    def put (self, parent, pnode, name, qid, node):
+        """
+        Caches the file with the given qid and node found under
+        the given name in the directory with the given qid and
+        node. The directory is cached as the ``..`` of the file
+        """
+        self.__lock.acquire()
+        try:
+            self.__put((parent.path, name), (qid, node))
+            if name != "..":
+                self.__put((qid.path, ".."), (parent, pnode))
+        finally:
+            self.__lock.release()
+
+    def __put (self, key, value):
+        old = self.__paths.pop(key, None)
+        if old is not None:
+            self.__unname(key, old[0].path)
+        self.__paths[key] = value
+        self.__names.setdefault(value[0].path, set()).add(key)
+        while len(self.__paths) > self.maxpaths:
+            (oldkey, oldvalue) = self.__paths.popitem(False)
+            self.__unname(oldkey, oldvalue[0].path)
+
+    def __unname (self, key, path):
+        keys = self.__names.get(path)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.__names[path]
+
+    def forget (self, qid):
+        """
+        Drops the entries of the file with the given qid, like
+        when the file is removed or renamed
+        """
+        self.__lock.acquire()
+        try:
+            for key in self.__names.pop(qid.path, ()):
+                self.__paths.pop(key, None)
+            key = (qid.path, "..")
+            value = self.__paths.pop(key, None)
+            if value is not None:
+                self.__unname(key, value[0].path)
+        finally:
+            self.__lock.release()
+
+    def clear (self):
+        """
+        Drops all the entries
+        """
+        self.__lock.acquire()
+        self.__paths.clear()
+        self.__names.clear()
+        self.__lock.release()
+
+    def stats (self):
+        """
+        Returns the dictionary of the cache statistics: the number
+        of the entries and the numbers of the hits and the misses
+        """
+        return {
+            "entries": len(self.__paths),
+            "maxpaths": self.maxpaths,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,307 @@
+"""
+The fid handling of a 9P file server
+
+The ``p9fileserver`` dispatcher serves the Tattach, Twalk, Topen,
+Tread, Twrite, Tclunk and Tremove messages with the use of the fid table of
+the session and the path cache of the server (see the ``fids`` module).
+The backend is plugged in by overriding a few methods working with
+the backend objects (nodes) the fids refer to::
+
+    class worker (p9fileserver, p9socketworker):
+        def getroot (self, session, uname, aname):
+            return (p9qid(type = QTDIR, path = 1), tree)
+
+        def lookup (self, session, qid, node, name):
+            ...
+
+The walks are resolved with the path cache, so the backend is asked
+to look up a path element only the first time it's walked or when
+it is dropped from the cache.
+
+The data of a Twrite is passed to the ``writefile`` method as a
+``memoryview`` of the buffer the message is received into (see
+``payloadview``), so it's copied only once: right into the storage
+of the backend, or with ``data.tobytes()`` if the backend keeps the
+data object itself after the request.
+
+If the ``statsname`` is set, a Tattach with that name attaches to
+a synthetic read-only file holding the metrics of the server (see
+``p9socket.snapshot``) as a JSON object. The snapshot is taken when
+the file is opened, so the metrics can be watched with any 9P
+client::
+
+    class worker (p9fileserver, p9socketworker):
+        statsname = "stats"
+"""
+
+#     Copyright (c) 2011 Peter V. Saveliev
+#     Copyright (c) 2011 Paul Wolneykien
+#
+#     This file is part of Connexion project.
+#
+#     Connexion is free software; you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation; either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     Connexion is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with Connexion; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import json
+
+from messages import *
+from core import p9dispatcher, basereply, errorreply, payloadview
+
+__all__ = ["p9fileserver"]
+
+# The qid path of the metrics file
+STATSPATH = 0xffffffffffffffff
+
+# The open modes allowing writes (OWRITE, ORDWR)
+WRITEMODES = (1, 2)
+
+class statsfile (object):
+    """
+    The node of the metrics file: the JSON text of the snapshot
+    taken when the file is opened
+    """
+    __slots__ = ("data",)
+
+    def __init__ (self):
+        self.data = None
+
+class p9fileserver (p9dispatcher):
+    """
+    A dispatcher serving the fids of the sessions
+    """
+
+    handlers = dict(p9dispatcher.handlers)
+    handlers.update({
+        Tattach._type: "attach",
+        Twalk._type: "walk",
+        Topen._type: "open",
+        Tread._type: "read",
+        Twrite._type: "write",
+        Tclunk._type: "clunk",
+        Tremove._type: "remove",
+    })
+
+    # The attach name of the metrics file (``None`` for no file)
+    statsname = None
+
+    def getroot (self, session, uname, aname):
+        """
+        Returns the (qid, node) pair of the root of the file tree
+        with the given name for the given user. Raises IOError if
+        there is no such tree
+        """
+        raise IOError ("No such file tree: %s" % aname)
+
+    def lookup (self, session, qid, node, name):
+        """
+        Returns the (qid, node) pair of the file with the given
+        name (possibly ``..``) in the given directory or ``None``
+        if there is no such file. Raises IOError if the directory
+        can't be read
+        """
+        raise IOError ("Permission denied")
+
+    def openfile (self, session, fid, mode):
+        """
+        Prepares the file of the given ``p9fid`` entry for I/O in
+        the given mode. Raises IOError if the file can't be opened
+        """
+        pass
+
+    def readfile (self, session, fid, msg):
+        """
+        Returns the reply to the given Tread message reading the
+        file of the given open ``p9fid`` entry. Raises IOError if
+        the file can't be read
+        """
+        raise IOError ("Permission denied")
+
+    def writefile (self, session, fid, offset, data):
+        """
+        Writes the given data to the file of the given open
+        ``p9fid`` entry at the given offset and returns the number
+        of bytes written. The data is a ``memoryview`` of the
+        receive buffer valid only until the method returns, so the
+        backend should copy it if it keeps the data. Raises IOError
+        if the file can't be written
+        """
+        raise IOError ("Permission denied")
+
+    def closefile (self, fid):
+        """
+        Releases the file of the given ``p9fid`` entry when the
+        fid is clunked or the session is closed
+        """
+        pass
+
+    def removefile (self, session, fid):
+        """
+        Removes the file of the given ``p9fid`` entry. Raises
+        IOError if the file can't be removed
+        """
+        raise IOError ("Permission denied")
+
+    def resolve (self, session, qid, node, name):
+        """
+        Returns the (qid, node) pair of the file with the given
+        name in the given directory taken from the path cache or
+        looked up by the backend, or ``None`` if there is no such
+        file
+        """
+        paths = session.server.paths
+        found = paths.get(qid, name)
+        if found is None:
+            found = self.lookup(session, qid, node, name)
+            if found is not None:
+                paths.put(qid, node, name, found[0], found[1])
+        return found
+
+    def release (self, fid):
+        """
+        Releases the given ``p9fid`` entry removed from the fid
+        table of a session (see ``p9dispatcher.release``)
+        """
+        if not isinstance(fid.node, statsfile):
+            self.closefile(fid)
+
+    def attach (self, session, msg):
+        """
+        Handles the Tattach message
+        """
+        if msg.afid != NOFID:
+            return errorreply(msg, "Authentication is not required")
+        if self.statsname is not None and msg.aname.raw == self.statsname:
+            (qid, node) = (p9qid(type = QTFILE, path = STATSPATH), statsfile())
+        else:
+            try:
+                (qid, node) = self.getroot(session, msg.uname.raw, msg.aname.raw)
+            except (ValueError, IOError) as e:
+                return errorreply(msg, str(e))
+            session.server.paths.put(qid, node, "..", qid, node)
+        try:
+            session.fids.add(msg.fid, qid, node)
+        except ValueError as e:
+            return errorreply(msg, str(e))
+        return basereply(msg, qid = qid)
+
+    def walk (self, session, msg):
+        """
+        Handles the Twalk message. The new fid is set only if all
+        the path elements are found
+        """
+        try:
+            fid = session.fids.get(msg.fid)
+            if fid.mode is not None:
+                raise ValueError ("The fid %i is open" % msg.fid)
+            if msg.nwname > MAXWELEM:
+                raise ValueError ("Too many path elements")
+            (qid, node) = (fid.qid, fid.node)
+            qids = []
+            for wname in msg.wname:
+                name = wname.raw
+                found = None
+                if qid.type & QTDIR:
+                    found = self.resolve(session, qid, node, name)
+                if found is None:
+                    if not qids:
+                        raise IOError ("No such file: %s" % name)
+                    break
+                (qid, node) = found
+                qids.append(qid)
+            if isinstance(node, statsfile):
+                node = statsfile()
+            if len(qids) == msg.nwname:
+                session.fids.add(msg.newfid, qid, node, msg.newfid == msg.fid)
+        except (ValueError, IOError) as e:
+            return errorreply(msg, str(e))
+        return basereply(msg, nwqid = len(qids), qid = qids)
+
+    def open (self, session, msg):
+        """
+        Handles the Topen message
+        """
+        try:
+            fid = session.fids.get(msg.fid)
+            if fid.mode is not None:
+                raise ValueError ("The fid %i is open" % msg.fid)
+            if not isinstance(fid.node, statsfile):
+                self.openfile(session, fid, msg.mode)
+            elif msg.mode & 3:
+                raise IOError ("Permission denied")
+            else:
+                fid.node.data = json.dumps(session.server.snapshot(), sort_keys = True) + "\n"
+        except (ValueError, IOError) as e:
+            return errorreply(msg, str(e))
+        fid.mode = msg.mode
+        return basereply(msg, qid = fid.qid)
+
+    def read (self, session, msg):
+        """
+        Handles the Tread message
+        """
+        try:
+            fid = session.fids.get(msg.fid)
+            if fid.mode is None:
+                raise ValueError ("The fid %i is not open" % msg.fid)
+            if not isinstance(fid.node, statsfile):
+                return self.readfile(session, fid, msg)
+        except (ValueError, IOError) as e:
+            return errorreply(msg, str(e))
+        data = fid.node.data[msg.offset:msg.offset + min(msg.count, session.iounit())]
+        return basereply(msg, count = len(data), data = data)
+
+    def write (self, session, msg):
+        """
+        Handles the Twrite message
+        """
+        try:
+            fid = session.fids.get(msg.fid)
+            if fid.mode is None:
+                raise ValueError ("The fid %i is not open" % msg.fid)
+            if fid.mode & 3 not in WRITEMODES:
+                raise IOError ("The fid %i is not open for writing" % msg.fid)
+            count = self.writefile(session, fid, msg.offset, payloadview(msg))
+        except (ValueError, IOError) as e:
+            return errorreply(msg, str(e))
+        return basereply(msg, count = count)
+
+    def clunk (self, session, msg):
+        """
+        Handles the Tclunk message
+        """
+        try:
+            session.fids.remove(msg.fid)
+        except ValueError as e:
+            return errorreply(msg, str(e))
+        return basereply(msg)
+
+    def remove (self, session, msg):
+        """
+        Handles the Tremove message. The fid is clunked even if
+        the file isn't removed
+        """
+        try:
+            fid = session.fids.get(msg.fid)
+        except ValueError as e:
+            return errorreply(msg, str(e))
+        try:
+            if isinstance(fid.node, statsfile):
+                raise IOError ("Permission denied")
+            self.removefile(session, fid)
+            session.server.paths.forget(fid.qid)
+        except (ValueError, IOError) as e:
+            return errorreply(msg, str(e))
+        finally:
+            session.fids.remove(msg.fid)
+        return basereply(msg)
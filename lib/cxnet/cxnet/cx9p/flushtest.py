@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Checks that a Tflush message aborts the processing of the flushed
+request.
+
+The server handles Tread with a busy loop that checks the
+cancellation of the request on every round. The client sends a
+Tread, then a Tflush for it. The loop should stop shortly after the
+flush, and the Rflush reply should be the only reply received
+(or follow the Rread one)
+"""
+
+from __future__ import print_function
+
+from time import time, sleep
+import threading
+import socket
+import struct
+import sys
+
+from cxnet.cx9p.messages import *
+from cxnet.cx9p.core import p9socket, p9socketworker, basereply
+from cxnet.cx9p import codec
+
+PORT = 10902
+
+# The time (seconds) the read handler works unless flushed
+WORKTIME = 5.0
+
+# The delay (seconds) before the Tflush is sent
+FLUSHDELAY = 0.2
+
+class worker (p9socketworker):
+    handlers = dict(p9socketworker.handlers)
+    handlers[Tread._type] = "read"
+
+    rounds = 0
+    finished = None
+
+    def read (self, session, msg):
+        start = time()
+        try:
+            while time() - start < WORKTIME:
+                worker.rounds += 1
+                session.check(msg)
+            return basereply(msg, count = 0)
+        finally:
+            worker.finished = time()
+
+class server (p9socket):
+    workerclass = worker
+
+def recvmsg (sock):
+    """
+    Receives a message and decodes it
+    """
+    data = b""
+    while len(data) < 4 or len(data) < struct.unpack("<I", data[:4])[0]:
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise IOError("The connection is closed")
+        data += chunk
+    return codec.decode(data)
+
+def check ():
+    p9 = server('127.0.0.1', PORT)
+    thread = threading.Thread(target = p9.serve)
+    thread.daemon = True
+    thread.start()
+    sleep(0.2)
+
+    sock = socket.create_connection(('127.0.0.1', PORT))
+    buf = bytearray(NORM_MSG_SIZE)
+    l = codec.encode({"type": Tread._type, "tag": 1, "fid": 1, "count": 4096}, buf)
+    sock.sendall(bytes(buf[:l]))
+    sleep(FLUSHDELAY)
+    rounds = worker.rounds
+    flushed = time()
+    l = codec.encode({"type": Tflush._type, "tag": 2, "oldtag": 1}, buf)
+    sock.sendall(bytes(buf[:l]))
+
+    replies = [recvmsg(sock)]
+    if replies[0]["type"] != Rflush._type:
+        replies.append(recvmsg(sock))
+    elapsed = worker.finished - flushed
+    sock.close()
+    p9.close()
+
+    print ("Rounds before the flush: %d, total: %d" % (rounds, worker.rounds))
+    print ("Work stopped %.1f ms after the flush" % (elapsed * 1e3))
+    print ("Replies: %s" % ", ".join(["%s(tag %d)" % (p9msgclasses[reply["type"]].__name__, reply["tag"]) for reply in replies]))
+    ok = elapsed < WORKTIME / 2 and replies[-1]["type"] == Rflush._type and replies[-1]["tag"] == 2
+    print ("OK" if ok else "FAILED")
+    return ok
+
+if __name__ == "__main__":
+    sys.exit(0 if check() else 1)
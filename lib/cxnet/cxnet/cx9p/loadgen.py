@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""
+Load generator for the 9P servers
+
+Runs a server (the threaded ``p9socket``, the ``p9socket`` reactor,
+the asyncio server or a number of pre-forked reactor processes) in a
+separate process and loads it from a number
+of client processes, each making a single connection. A client keeps
+the given number of requests in flight: every reply is followed by a
+new request. The requests are picked at random, with a fixed seed,
+from the given mix of:
+
+* ``version`` -- Tversion, the cost of the dispatching alone;
+* ``walk`` -- Twalk of a fid down a synthetic directory tree and back
+  up, which exercises the fid table and the path cache;
+* ``read`` -- Tread of the given number of bytes.
+
+The results are printed as a JSON object: the run parameters, the
+throughput (requests and read bytes per second), the number of the
+Rerror replies and the latency percentiles (p50, p99, p999 and the
+maximum, in microseconds) of all the requests and of each request
+type. Thus the results of two runs can be compared by a script.
+The metrics of the server read from its 9P metrics file at the end
+of the run are reported as well (``metrics``).
+
+Usage: loadgen.py [options]
+
+    -S mode      server mode: threaded (default), reactor, asyncio or prefork
+    -P number    the number of the prefork server processes (2)
+    -c number    the number of connections (4)
+    -d number    the number of requests in flight per connection (1)
+    -n number    the number of requests per connection (5000)
+    -m mix       the request mix (version=1,walk=1,read=1)
+    -s size      the message size negotiated (8192)
+    -r size      the size of the reads (4096)
+    -w number    the number of the path elements in a walk (8)
+    -p port      the port the server listens on (10905)
+    -o file      write the results to the file instead of stdout
+"""
+
+from __future__ import print_function
+
+from multiprocessing import Process, Pool
+from time import time, sleep
+import random
+import getopt
+import socket
+import struct
+import json
+import sys
+
+from cxnet.cx9p.messages import *
+from cxnet.cx9p import codec
+from cxnet.cx9p.serverbench import run, recvall
+from cxnet.cx9p.prefork import PUBLISHINTERVAL
+
+# The default run parameters
+DEFAULTS = {
+    "server": "threaded",
+    "connections": 4,
+    "depth": 1,
+    "requests": 5000,
+    "mix": {"version": 1, "walk": 1, "read": 1},
+    "msize": MAX_MSG_SIZE,
+    "readsize": 4096,
+    "walk": 8,
+    "port": 10905,
+    "processes": 2,
+    "seed": 1,
+}
+
+# The data served by the reads
+DATA = "\0" * (1024 * 1024)
+
+# The qid path of the data file (the directories are numbered by
+# their depth)
+DATAPATH = 1 << 32
+
+# The fids of the root, the data file and the first of the walked
+# ones (one per a request in flight)
+(ROOTFID, DATAFID, WALKFID) = (0, 1, 2)
+
+# The headers of the replies: size, type, tag
+replyheader = struct.Struct("<IBH")
+
+def servers ():
+    """
+    Returns the dictionary of the server functions by the mode
+    """
+    from cxnet.cx9p.core import p9socket, p9socketworker, p9payload
+    from cxnet.cx9p.fileserver import p9fileserver
+
+    class loadfs (p9fileserver):
+        """
+        The synthetic file tree: an endless chain of the ``d``
+        directories and the ``data`` file at the root
+        """
+        statsname = "stats"
+        def getroot (self, session, uname, aname):
+            return (p9qid(type = QTDIR, path = 0), 0)
+
+        def lookup (self, session, qid, node, name):
+            if name == "d":
+                return (p9qid(type = QTDIR, path = node + 1), node + 1)
+            elif name == "..":
+                return (p9qid(type = QTDIR, path = max(node - 1, 0)), max(node - 1, 0))
+            elif name == "data" and node == 0:
+                return (p9qid(type = QTFILE, path = DATAPATH), None)
+            return None
+
+        def readfile (self, session, fid, msg):
+            return p9payload(msg, buffer(DATA, 0, min(msg.count, len(DATA))))
+
+    class worker (loadfs, p9socketworker):
+        pass
+
+    class server (p9socket):
+        workerclass = worker
+
+    def threaded (config):
+        server('127.0.0.1', config["port"]).serve()
+
+    def reactor (config):
+        server('127.0.0.1', config["port"], reactor = True).serve()
+
+    def prefork (config):
+        from cxnet.cx9p.prefork import p9prefork
+
+        class shard (server):
+            def snapshot (self):
+                return cluster.snapshot()
+
+        cluster = p9prefork(lambda index: shard('127.0.0.1', config["port"], reactor = True, reuseport = True), config["processes"])
+        cluster.run()
+
+    def asyncio (config):
+        from cxnet.cx9p.aio import p9asyncserver
+
+        class aioserver (loadfs, p9asyncserver):
+            pass
+
+        p9 = aioserver()
+        p9.loop.run_until_complete(p9.serve('127.0.0.1', config["port"]))
+        p9.loop.run_forever()
+
+    return {"threaded": threaded, "reactor": reactor, "asyncio": asyncio, "prefork": prefork}
+
+def serve (config):
+    servers()[config["server"]](config)
+
+def encode (values, buf = None):
+    """
+    Returns the encoded message with the given fields
+    """
+    if buf is None:
+        buf = bytearray(NORM_MSG_SIZE)
+    length = codec.encode(values, buf)
+    return bytes(buf[:length])
+
+def rpc (sock, values):
+    """
+    Sends the given message and returns the decoded reply
+    """
+    sock.sendall(encode(values))
+    header = recvall(sock, 4)
+    rmsg = codec.decode(header + recvall(sock, struct.unpack("<I", header)[0] - 4))
+    if rmsg["type"] == Rerror._type:
+        raise IOError (rmsg["ename"])
+    return rmsg
+
+def requests (config):
+    """
+    Returns the dictionary of the lists of the encoded requests
+    of each type in the mix: one per tag
+    """
+    names = ["d"] * (config["walk"] // 2)
+    names += [".."] * len(names)
+    templates = {
+        "version": lambda tag: {"type": Tversion._type, "tag": tag, "msize": config["msize"], "version": VERSION9P},
+        "walk": lambda tag: {"type": Twalk._type, "tag": tag, "fid": WALKFID + tag, "newfid": WALKFID + tag, "nwname": len(names), "wname": names},
+        "read": lambda tag: {"type": Tread._type, "tag": tag, "fid": DATAFID, "offset": 0, "count": config["readsize"]},
+    }
+    return dict([(op, [encode(templates[op](tag)) for tag in range(config["depth"])]) for op in config["mix"]])
+
+def client (args):
+    """
+    Makes the given number of requests over a single connection.
+    Returns the (latencies, errors, bytes read) tuple, where the
+    latencies are listed by the request type
+    """
+    (config, index) = args
+    sock = socket.create_connection(('127.0.0.1', config["port"]))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    rpc(sock, {"type": Tversion._type, "tag": NOTAG, "msize": config["msize"], "version": VERSION9P})
+    rpc(sock, {"type": Tattach._type, "tag": 0, "fid": ROOTFID, "afid": NOFID, "uname": "", "aname": ""})
+    rpc(sock, {"type": Twalk._type, "tag": 0, "fid": ROOTFID, "newfid": DATAFID, "nwname": 1, "wname": ["data"]})
+    rpc(sock, {"type": Topen._type, "tag": 0, "fid": DATAFID, "mode": 0})
+    for tag in range(config["depth"]):
+        rpc(sock, {"type": Twalk._type, "tag": 0, "fid": ROOTFID, "newfid": WALKFID + tag, "nwname": 0, "wname": []})
+
+    encoded = requests(config)
+    choices = sum([[op] * weight for (op, weight) in sorted(config["mix"].items())], [])
+    rng = random.Random(config["seed"] + index)
+    latencies = dict([(op, []) for op in config["mix"]])
+    (errors, received) = (0, 0)
+    sent = {}
+    remaining = config["requests"]
+
+    def issue (tag, batch):
+        op = rng.choice(choices)
+        batch.append(encoded[op][tag])
+        sent[tag] = (op, time())
+
+    batch = []
+    for tag in range(min(config["depth"], remaining)):
+        issue (tag, batch)
+    remaining -= len(batch)
+    sock.sendall(b"".join(batch))
+    data = b""
+    while sent:
+        chunk = sock.recv(1024 * 1024)
+        if not chunk:
+            raise IOError ("The connection is closed")
+        data += chunk
+        (pos, batch) = (0, [])
+        while len(data) - pos >= replyheader.size:
+            (size, rtype, tag) = replyheader.unpack_from(data, pos)
+            if len(data) - pos < size:
+                break
+            now = time()
+            (op, start) = sent.pop(tag)
+            latencies[op].append(now - start)
+            if rtype == Rerror._type:
+                errors += 1
+            elif rtype == Rread._type:
+                received += size - 11
+            pos += size
+            if remaining > 0:
+                issue (tag, batch)
+                remaining -= 1
+        data = data[pos:]
+        if batch:
+            sock.sendall(b"".join(batch))
+    sock.close()
+    return (latencies, errors, received)
+
+def metrics (config):
+    """
+    Returns the server metrics read from the metrics file
+    """
+    sock = socket.create_connection(('127.0.0.1', config["port"]))
+    try:
+        rmsg = rpc(sock, {"type": Tversion._type, "tag": NOTAG, "msize": config["msize"], "version": VERSION9P})
+        count = rmsg["msize"] - IOHDRSZ
+        rpc(sock, {"type": Tattach._type, "tag": 0, "fid": ROOTFID, "afid": NOFID, "uname": "", "aname": "stats"})
+        rpc(sock, {"type": Topen._type, "tag": 0, "fid": ROOTFID, "mode": 0})
+        chunks = []
+        while True:
+            rmsg = rpc(sock, {"type": Tread._type, "tag": 0, "fid": ROOTFID, "offset": sum(map(len, chunks)), "count": count})
+            if not rmsg["count"]:
+                break
+            chunks.append(rmsg["data"])
+    finally:
+        sock.close()
+    return json.loads(b"".join(chunks))
+
+def percentiles (values):
+    """
+    Returns the latency percentiles (microseconds) of the given
+    sorted list of latencies (seconds)
+    """
+    if not values:
+        return {}
+    result = {"max": values[-1] * 1e6}
+    for (name, p) in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+        result[name] = values[min(len(values) - 1, int(len(values) * p))] * 1e6
+    return result
+
+def loadgen (config):
+    """
+    Runs the server and loads it with the clients according to
+    the given parameters. Returns the results dictionary
+    """
+    proc = Process(target = run, args = (lambda: serve(config),))
+    proc.daemon = True
+    proc.start()
+    sleep(0.5)
+    pool = Pool(config["connections"])
+    try:
+        start = time()
+        results = pool.map(client, [(config, i) for i in range(config["connections"])])
+        elapsed = time() - start
+        if config["server"] == "prefork":
+            sleep(PUBLISHINTERVAL)
+        stats = metrics(config)
+    finally:
+        pool.terminate()
+        proc.terminate()
+        proc.join()
+    latencies = dict([(op, sorted(sum([result[0][op] for result in results], []))) for op in config["mix"]])
+    total = sorted(sum(latencies.values(), []))
+    received = sum([result[2] for result in results])
+    report = dict(config)
+    report.update({
+        "elapsed": elapsed,
+        "total": len(total),
+        "throughput": len(total) / elapsed,
+        "readbytes": received / elapsed,
+        "errors": sum([result[1] for result in results]),
+        "latency": dict([(op, percentiles(values)) for (op, values) in latencies.items()]),
+        "metrics": stats,
+    })
+    report["latency"]["all"] = percentiles(total)
+    return report
+
+def parsemix (mix):
+    """
+    Parses the request mix given as ``type=weight,...``
+    """
+    result = {}
+    for item in mix.split(","):
+        (op, weight) = item.split("=")
+        if op not in DEFAULTS["mix"]:
+            raise ValueError ("Unknown request type: %s" % op)
+        if int(weight) > 0:
+            result[op] = int(weight)
+    if not result:
+        raise ValueError ("The request mix is empty")
+    return result
+
+if __name__ == "__main__":
+    config = dict(DEFAULTS)
+    output = None
+    try:
+        opt, args = getopt.getopt(sys.argv[1:], "S:P:c:d:n:m:s:r:w:p:o:")
+        for (o, a) in opt:
+            if o == "-S":
+                if a not in ("threaded", "reactor", "asyncio", "prefork"):
+                    raise ValueError ("Unknown server mode: %s" % a)
+                config["server"] = a
+            elif o == "-m":
+                config["mix"] = parsemix(a)
+            elif o == "-o":
+                output = a
+            else:
+                key = {"-c": "connections", "-d": "depth", "-n": "requests", "-s": "msize", "-r": "readsize", "-w": "walk", "-p": "port", "-P": "processes"}[o]
+                config[key] = int(a)
+        if config["readsize"] > config["msize"] - IOHDRSZ:
+            raise ValueError ("The read size exceeds the I/O unit (%d)" % (config["msize"] - IOHDRSZ))
+        if config["walk"] > MAXWELEM:
+            raise ValueError ("Too many path elements in a walk")
+    except (getopt.GetoptError, ValueError) as e:
+        print (e, file = sys.stderr)
+        print (__doc__.split("Usage:")[1], file = sys.stderr)
+        sys.exit(1)
+    report = json.dumps(loadgen(config), sort_keys = True, indent = 2)
+    if output:
+        with open(output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print (report)
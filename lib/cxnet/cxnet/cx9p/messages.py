@@ -32,7 +32,8 @@ from ctypes import c_ubyte, c_char, c_uint16, c_uint32, c_uint64
 # 9P uses little-endian meta data
 from ctypes import LittleEndianStructure as Structure
 
-# The maximum message size is 8192 bytes
+# The default maximum message size is 8192 bytes: it is used until
+# a larger size is negotiated with Tversion
 MAX_MSG_SIZE = 8192
 __all__ = ["MAX_MSG_SIZE"]
 
@@ -40,6 +41,28 @@ __all__ = ["MAX_MSG_SIZE"]
 NORM_MSG_SIZE = 4096
 __all__ += ["NORM_MSG_SIZE"]
 
+# The room for the Twrite/Rread headers: the I/O unit is msize less it
+IOHDRSZ = 24
+__all__ += ["IOHDRSZ"]
+
+# The tag of Tversion and the "no fid" value of Tauth/Tattach
+NOTAG = 0xffff
+NOFID = 0xffffffff
+__all__ += ["NOTAG", "NOFID"]
+
+# The maximum number of path elements in a walk
+MAXWELEM = 16
+__all__ += ["MAXWELEM"]
+
+# The qid type bits
+QTDIR = 0x80
+QTAPPEND = 0x40
+QTEXCL = 0x20
+QTAUTH = 0x08
+QTTMP = 0x04
+QTFILE = 0x00
+__all__ += ["QTDIR", "QTAPPEND", "QTEXCL", "QTAUTH", "QTTMP", "QTFILE"]
+
 class p9msg (Structure):
     """
     A 9P message head.
@@ -368,7 +391,7 @@ class Rread (Structure):
         """
         Returns the ``(c_ubyte * count)`` as the type of the message tail ``data``
         """
-        return [("data", (c_ubyte * count), 1)]
+        return [("data", (c_ubyte * self.count), 1)]
 
 
 class Terror (Structure):
@@ -411,7 +434,7 @@ class Twalk (Structure):
         Returns the map of the message tail:
           * wname ```p9msgstring``` * nwname.
         """
-        return [("wname", p9msgstring, nwname)]
+        return [("wname", p9msgstring, self.nwname)]
 
 class Rwalk (Structure):
     """
@@ -429,7 +452,7 @@ class Rwalk (Structure):
         Returns the map of the message tail:
           * qid ```p9qid``` * nwqid.
         """
-        return [("qid", p9qid, nwqid)]
+        return [("qid", p9qid, self.nwqid)]
 
 
 class Tattach (Structure):
@@ -506,7 +529,7 @@ class Twrite (Structure):
         """
         Returns the ``(c_ubyte * count)`` as the type of the message tail ``data``
         """
-        return [("data", (c_ubyte * count), 1)]
+        return [("data", (c_ubyte * self.count), 1)]
 
 class Rwrite (Structure):
     """
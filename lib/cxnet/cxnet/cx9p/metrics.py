@@ -0,0 +1,239 @@
+"""
+Server metrics
+
+The metrics are counted by each thread on its own, in the
+``p9metrics`` object returned by the ``current()`` method of the
+``p9stats`` registry of the server, so no lock is taken on the path
+of a message. The objects of all the threads are summed up when a
+snapshot is taken. The objects of the finished threads are added to
+the running total and dropped, so a server starting a thread per
+connection keeps no more objects than it has threads.
+
+The times are counted in the ``histogram`` objects with power-of-two
+buckets of microseconds, so the percentiles are known to within a
+factor of two.
+"""
+
+#     Copyright (c) 2011 Peter V. Saveliev
+#     Copyright (c) 2011 Paul Wolneykien
+#
+#     This file is part of Connexion project.
+#
+#     Connexion is free software; you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation; either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     Connexion is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with Connexion; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import threading
+import weakref
+
+from messages import p9msgclasses
+
+__all__ = ["histogram", "p9metrics", "p9stats"]
+
+# The number of the histogram buckets: up to 2^31 us (about 36 min)
+NBUCKETS = 32
+
+class histogram (object):
+    """
+    A histogram of the times with power-of-two buckets of
+    microseconds: the bucket ``i`` counts the times less than
+    ``2^i`` us and not less than ``2^(i-1)`` us
+    """
+    __slots__ = ("buckets", "count", "total")
+
+    def __init__ (self):
+        self.buckets = [0] * NBUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def add (self, seconds):
+        """
+        Counts the given time
+        """
+        i = int(seconds * 1e6).bit_length()
+        if i >= NBUCKETS:
+            i = NBUCKETS - 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+
+    def merge (self, other):
+        """
+        Adds the counts of the other histogram
+        """
+        for (i, n) in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+
+    def percentile (self, p):
+        """
+        Returns the upper bound (microseconds) of the bucket the
+        given percentile (0..1) falls into
+        """
+        if not self.count:
+            return 0
+        limit = self.count * p
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= limit:
+                return 1 << i
+        return 1 << (NBUCKETS - 1)
+
+    def snapshot (self):
+        """
+        Returns the dictionary of the count, the mean time and the
+        percentiles (microseconds) and the non-empty buckets as the
+        [upper bound, count] pairs
+        """
+        return {
+            "count": self.count,
+            "mean": self.total * 1e6 / self.count if self.count else 0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            "buckets": [[1 << i, n] for (i, n) in enumerate(self.buckets) if n],
+        }
+
+class p9metrics (object):
+    """
+    The metrics counted by a thread: the numbers of the messages
+    and the handler times by the message type, the number of the
+    Rerror replies and the reply send times
+    """
+    def __init__ (self):
+        self.counts = {}
+        self.handlers = {}
+        self.errors = 0
+        self.send = histogram()
+
+    def count (self, msgtype):
+        """
+        Counts a message of the given type
+        """
+        self.counts[msgtype] = self.counts.get(msgtype, 0) + 1
+
+    def handled (self, msgtype, seconds):
+        """
+        Counts a message of the given type processed by a handler
+        in the given time
+        """
+        self.counts[msgtype] = self.counts.get(msgtype, 0) + 1
+        try:
+            h = self.handlers[msgtype]
+        except KeyError:
+            h = self.handlers[msgtype] = histogram()
+        h.add(seconds)
+
+    def sent (self, seconds, error = False):
+        """
+        Counts a reply sent in the given time
+        """
+        self.send.add(seconds)
+        if error:
+            self.errors += 1
+
+    def merge (self, other):
+        """
+        Adds the counts of the other metrics object
+        """
+        for (msgtype, n) in other.counts.items():
+            self.counts[msgtype] = self.counts.get(msgtype, 0) + n
+        for (msgtype, h) in other.handlers.items():
+            if msgtype not in self.handlers:
+                self.handlers[msgtype] = histogram()
+            self.handlers[msgtype].merge(h)
+        self.errors += other.errors
+        self.send.merge(other.send)
+
+    def snapshot (self):
+        """
+        Returns the dictionary of the metrics: the number of the
+        messages and the handler time histogram by the message
+        type name (``messages``), the handler time histogram of
+        all the messages (``handler``), the reply send time
+        histogram (``send``) and the number of the errors
+        """
+        handler = histogram()
+        messages = {}
+        for (msgtype, n) in self.counts.items():
+            msgclass = p9msgclasses[msgtype]
+            messages[msgclass.__name__ if msgclass else str(msgtype)] = entry = {"count": n}
+            if msgtype in self.handlers:
+                handler.merge(self.handlers[msgtype])
+                entry["handler"] = self.handlers[msgtype].snapshot()
+        return {
+            "messages": messages,
+            "handler": handler.snapshot(),
+            "send": self.send.snapshot(),
+            "errors": self.errors,
+        }
+
+class p9stats (object):
+    """
+    The registry of the metrics of the threads of a server
+    """
+    def __init__ (self):
+        self.__local = threading.local()
+        self.__metrics = []
+        self.__retired = p9metrics()
+        self.__lock = threading.Lock()
+
+    def current (self):
+        """
+        Returns the metrics object of the calling thread
+        """
+        try:
+            return self.__local.metrics
+        except AttributeError:
+            metrics = self.__local.metrics = p9metrics()
+            thread = weakref.ref(threading.current_thread())
+            self.__lock.acquire()
+            try:
+                self.__prune()
+                self.__metrics.append((thread, metrics))
+            finally:
+                self.__lock.release()
+            return metrics
+
+    def __prune (self):
+        """
+        Adds the metrics of the finished threads to the total of
+        the retired ones and drops them. Should be called with the
+        lock held
+        """
+        live = []
+        for (thread, metrics) in self.__metrics:
+            t = thread()
+            if t is not None and t.is_alive():
+                live.append((thread, metrics))
+            else:
+                self.__retired.merge(metrics)
+        self.__metrics = live
+
+    def collect (self):
+        """
+        Returns the sum of the metrics of all the threads
+        """
+        total = p9metrics()
+        self.__lock.acquire()
+        try:
+            self.__prune()
+            total.merge(self.__retired)
+            metrics = [m for (thread, m) in self.__metrics]
+        finally:
+            self.__lock.release()
+        for m in metrics:
+            total.merge(m)
+        return total
@@ -0,0 +1,287 @@
+"""
+Outbound message queue
+
+The reply messages of a session are queued as they are produced by
+the handlers and are sent with a single ``writev()`` call per as many
+messages as are waiting, up to ``IOV_MAX``. The messages are sent
+right from their buffers without copying; the buffers are returned to
+the pool when the messages are fully written.
+
+Besides the message buffers, any object supporting the buffer
+interface can be queued, like a string, an ``mmap`` object or a
+``memoryview``, as well as a region of a file, which is sent with
+``sendfile()``.
+Thus the payload of a reply is sent right from where the backend
+keeps it.
+
+A partial write leaves the rest of the first unsent message at the
+head of the queue. On a non-blocking socket the ``flush()`` method
+returns on EAGAIN, telling the caller to wait for the socket to
+become writable. The number of the queued bytes is available to
+throttle the producers.
+
+The sizes of the writes are counted in a power-of-two histogram to
+show how many replies are coalesced (it's reported in the traffic
+statistics of the session), and the total number of the bytes
+written is kept in ``written``.
+"""
+
+#     Copyright (c) 2011 Peter V. Saveliev
+#     Copyright (c) 2011 Paul Wolneykien
+#
+#     This file is part of Connexion project.
+#
+#     Connexion is free software; you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation; either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     Connexion is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with Connexion; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from ctypes import CDLL, Structure, addressof, get_errno, pythonapi, byref, py_object, c_void_p, c_char_p, c_size_t, c_int, c_ssize_t, c_int64, c_ubyte, POINTER
+from ctypes.util import find_library
+from errno import EAGAIN, EWOULDBLOCK, EINTR
+from collections import deque
+import threading
+import os
+
+__all__ = ["p9outqueue"]
+
+# The maximum number of buffers passed to a single writev() call
+IOV_MAX = 64
+
+# The C library with the access to errno
+libc = CDLL(find_library("c"), use_errno = True)
+
+class iovec (Structure):
+    _fields_ = [
+        ("iov_base", c_void_p),
+        ("iov_len", c_size_t),
+    ]
+
+libc.writev.argtypes = [c_int, POINTER(iovec), c_int]
+libc.writev.restype = c_ssize_t
+
+libc.sendfile.argtypes = [c_int, c_int, POINTER(c_int64), c_size_t]
+libc.sendfile.restype = c_ssize_t
+
+class pybuffer (Structure):
+    """
+    The Py_buffer structure of the new-style buffer interface
+    """
+    _fields_ = [
+        ("buf", c_void_p),
+        ("obj", c_void_p),
+        ("len", c_ssize_t),
+        ("itemsize", c_ssize_t),
+        ("readonly", c_int),
+        ("ndim", c_int),
+        ("format", c_char_p),
+        ("shape", c_void_p),
+        ("strides", c_void_p),
+        ("suboffsets", c_void_p),
+        ("smalltable", c_ssize_t * 2),
+        ("internal", c_void_p),
+    ]
+
+# Request a contiguous buffer, read-only or writable
+PyBUF_SIMPLE = 0
+
+pythonapi.PyObject_AsReadBuffer.argtypes = [py_object, POINTER(c_void_p), POINTER(c_ssize_t)]
+pythonapi.PyObject_GetBuffer.argtypes = [py_object, POINTER(pybuffer), c_int]
+pythonapi.PyBuffer_Release.argtypes = [POINTER(pybuffer)]
+
+def bufaddr (data, offset):
+    """
+    Returns the address of the given offset of the given
+    memory block. The block should be kept referenced while
+    the address is in use
+    """
+    try:
+        return addressof(c_ubyte.from_buffer(data, offset))
+    except TypeError:
+        pass
+    if isinstance(data, memoryview):
+        view = pybuffer()
+        pythonapi.PyObject_GetBuffer(data, byref(view), PyBUF_SIMPLE)
+        (addr, length) = (view.buf, view.len)
+        pythonapi.PyBuffer_Release(byref(view))
+    else:
+        addr = c_void_p()
+        length = c_ssize_t()
+        pythonapi.PyObject_AsReadBuffer(data, byref(addr), byref(length))
+        (addr, length) = (addr.value, length.value)
+    if offset > length:
+        raise ValueError ("The offset %d is out of the buffer" % offset)
+    return (addr or 0) + offset
+
+class p9outqueue (object):
+    """
+    A queue of the outbound messages of a session
+    """
+    def __init__ (self, fd, release = None, maxiov = IOV_MAX):
+        """
+        Sets up the queue of the messages to be written to the
+        given file descriptor. The ``release`` function is called
+        with the memory block of each message once it is written
+        unless another function is given to ``put()``
+        """
+        self.fd = fd
+        self.release = release
+        self.maxiov = maxiov
+        self.queued = 0
+        self.written = 0
+        self.histogram = {}
+        self.__iov = (iovec * maxiov)()
+        self.__items = deque()
+        self.__lock = threading.RLock()
+        self.__flushlock = threading.Lock()
+
+    def put (self, data, offset, length, release = True):
+        """
+        Queues the ``length`` bytes at the given offset of the given
+        memory block. The block should not be modified until it is
+        released. The ``release`` argument is either the function
+        to call with the block when it's written or ``True`` for
+        the queue default function
+        """
+        if release is True:
+            release = self.release
+        self.__append([data, bufaddr(data, offset), length, None, release])
+
+    def putfile (self, fd, offset, length, release = None):
+        """
+        Queues the ``length`` bytes of the file with the given
+        descriptor starting at the given offset. The ``release``
+        function is called with the file descriptor when the data
+        is written
+        """
+        self.__append([fd, offset, length, fd, release])
+
+    def lock (self):
+        """
+        Locks the queue, so the parts of a message queued with
+        several calls are not mixed with the messages queued by
+        the other threads meanwhile
+        """
+        self.__lock.acquire()
+
+    def unlock (self):
+        """
+        Unlocks the queue locked with ``lock()``
+        """
+        self.__lock.release()
+
+    def __append (self, item):
+        self.__lock.acquire()
+        self.__items.append(item)
+        self.queued += item[2]
+        self.__lock.release()
+
+    def __len__ (self):
+        return len(self.__items)
+
+    def flush (self):
+        """
+        Writes the queued messages. Returns ``True`` if some data
+        is left in the queue because the socket isn't ready to
+        accept it. If another thread is flushing the queue at the
+        moment, the messages are left to it. Raises IOError on a
+        write error
+        """
+        while self.__items:
+            if not self.__flushlock.acquire(False):
+                return False
+            try:
+                if self.__write():
+                    return True
+            finally:
+                self.__flushlock.release()
+        return False
+
+    def __write (self):
+        """
+        Writes the queued messages until the queue is empty or the
+        write would block. Returns ``True`` in the latter case
+        """
+        iov = self.__iov
+        while True:
+            self.__lock.acquire()
+            items = []
+            for item in self.__items:
+                if len(items) == self.maxiov or (items and item[3] is not None):
+                    break
+                items.append(item)
+                if item[3] is not None:
+                    break
+            self.__lock.release()
+            if not items:
+                return False
+            if items[0][3] is not None:
+                offset = c_int64(items[0][1])
+                l = libc.sendfile(self.fd, items[0][3], byref(offset), items[0][2])
+                if l == 0:
+                    raise IOError ("Unexpected end of file")
+            else:
+                for (i, item) in enumerate(items):
+                    iov[i].iov_base = item[1]
+                    iov[i].iov_len = item[2]
+                l = libc.writev(self.fd, iov, len(items))
+            if l < 0:
+                errno = get_errno()
+                if errno in (EAGAIN, EWOULDBLOCK):
+                    return True
+                if errno == EINTR:
+                    continue
+                raise IOError (errno, os.strerror(errno))
+            bucket = 1
+            while bucket < l:
+                bucket <<= 1
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+            self.__consume(l)
+
+    def __consume (self, l):
+        """
+        Removes the given number of written bytes from the head of
+        the queue
+        """
+        self.__lock.acquire()
+        self.queued -= l
+        self.written += l
+        released = []
+        while l > 0:
+            item = self.__items[0]
+            if l < item[2]:
+                item[1] += l
+                item[2] -= l
+                break
+            l -= item[2]
+            released.append(self.__items.popleft())
+        self.__lock.release()
+        self.__release(released)
+
+    def __release (self, items):
+        for item in items:
+            if item[4] is not None:
+                item[4](item[0])
+
+    def clear (self):
+        """
+        Discards the queued messages waiting for the current
+        write to complete
+        """
+        self.__flushlock.acquire()
+        self.__lock.acquire()
+        released = list(self.__items)
+        self.__items.clear()
+        self.queued = 0
+        self.__lock.release()
+        self.__flushlock.release()
+        self.__release(released)
@@ -0,0 +1,349 @@
+"""
+Pre-forked 9P server processes
+
+A single server process is bound by the GIL, so it uses one core at
+most. The ``p9prefork`` supervisor forks a number of worker
+processes, each running its own server. The servers bind the same
+port with SO_REUSEPORT (the ``reuseport`` option of ``p9socket``)
+and the kernel balances the connections among them. The servers are
+best run in the reactor mode, so a process handles all its
+connections in a single event loop::
+
+    def server (index):
+        return p9socket('0.0.0.0', 564, reactor = True, reuseport = True)
+
+    p9prefork(server, 4).run()
+
+The supervisor restarts the workers which exit. The delay before a
+restart grows when a worker exits right after it's started, so a
+server that can't start doesn't make the supervisor fork it over and
+over. On SIGTERM or SIGINT the supervisor sends SIGTERM to the
+workers and returns when they exit. A worker shuts its server down
+gracefully on SIGTERM (see ``p9socket.shutdown``), while SIGINT is
+ignored by the workers, so the supervisor alone handles Ctrl-C.
+
+The metrics of the workers are shared via an anonymous memory map
+created before the workers are forked. Each worker has a slot there
+which it publishes the metrics of its server into every
+``PUBLISHINTERVAL`` seconds. The metrics of a finished worker are
+added to a separate slot, so the sums survive the restarts. The
+``snapshot()`` method, called by the supervisor or by any worker,
+returns the metrics of all the workers summed up. A slot is guarded
+with a sequence counter that is odd while the slot is written, so
+a reader never sees a half-written slot. A worker killed while
+writing its slot leaves it half-written: such a slot is read as is
+once ``LOADTIMEOUT`` is out, and at once when the worker is retired.
+"""
+
+#     Copyright (c) 2011 Peter V. Saveliev
+#     Copyright (c) 2011 Paul Wolneykien
+#
+#     This file is part of Connexion project.
+#
+#     Connexion is free software; you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation; either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     Connexion is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with Connexion; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from __future__ import print_function
+
+from ctypes import Structure, sizeof, addressof, memmove, memset
+from ctypes import c_int32, c_uint32, c_uint64, c_double
+from errno import EINTR, ECHILD
+from time import time, sleep
+import threading
+import traceback
+import signal
+import mmap
+import os
+
+from metrics import NBUCKETS, histogram, p9metrics
+
+__all__ = ["p9prefork"]
+
+# The interval (seconds) the workers publish their metrics at
+PUBLISHINTERVAL = 1.0
+
+# A worker exiting sooner than that (seconds) is restarted with
+# a delay
+MINUPTIME = 1.0
+
+# The maximum delay (seconds) of a restart
+MAXDELAY = 30.0
+
+# The number of the message types
+NTYPES = 256
+
+# The time (seconds) a reader waits for a slot being written before
+# it takes the slot for torn by a killed worker
+LOADTIMEOUT = 0.1
+
+class slotdata (Structure):
+    """
+    The metrics of a worker in the shared memory
+    """
+    _fields_ = [
+        ("sequence", c_uint64),         # odd while the slot is written
+        ("pid", c_int32),               # the worker process
+        ("restarts", c_uint32),         # the number of the restarts
+        ("sessions", c_uint32),         # the number of the sessions
+        ("errors", c_uint64),           # the number of the Rerror replies
+        ("counts", c_uint64 * NTYPES),  # the messages by the type
+        ("handlers", (c_uint64 * NBUCKETS) * NTYPES),
+        ("handlertimes", c_double * NTYPES),
+        ("send", c_uint64 * NBUCKETS),
+        ("sendtime", c_double),
+        ("queue", c_uint64 * NBUCKETS),
+        ("queuetime", c_double),
+    ]
+
+def storehist (h, buckets):
+    """
+    Copies the given histogram into the given array of buckets.
+    Returns the total time
+    """
+    buckets[:] = h.buckets
+    return h.total
+
+def loadhist (buckets, total):
+    """
+    Returns the histogram with the given buckets and total time
+    """
+    h = histogram()
+    h.buckets = list(buckets)
+    h.count = sum(h.buckets)
+    h.total = total
+    return h
+
+class p9prefork (object):
+    """
+    Supervises the worker processes running the servers
+    """
+    def __init__ (self, factory, processes):
+        """
+        Sets up the given number of the workers. The ``factory``
+        function is called in a worker with the index of the
+        worker and returns the server object to run (see
+        ``p9socket``)
+        """
+        self.factory = factory
+        self.processes = processes
+        self.children = {}
+        self.stopping = False
+        self.server = None
+        self.__slot = None
+        self.__lock = threading.Lock()
+        self.__memory = mmap.mmap(-1, sizeof(slotdata) * (processes + 1))
+        self.__slots = (slotdata * (processes + 1)).from_buffer(self.__memory)
+
+    def run (self):
+        """
+        Starts the workers and restarts them when they exit until
+        a SIGTERM or SIGINT signal is received
+        """
+        handlers = [(signum, signal.signal(signum, self.stop)) for signum in (signal.SIGTERM, signal.SIGINT)]
+        try:
+            for index in range(self.processes):
+                self.spawn(index)
+            while self.children:
+                try:
+                    (pid, status) = os.wait()
+                except OSError as e:
+                    if e.errno == EINTR:
+                        continue
+                    if e.errno == ECHILD:
+                        break
+                    raise
+                (index, started) = self.children.pop(pid, (None, None))
+                if index is None:
+                    continue
+                self.retire(index)
+                if self.stopping:
+                    continue
+                delay = 0
+                if time() - started < MINUPTIME:
+                    delay = min(MAXDELAY, MINUPTIME * (1 << min(self.__slots[index].restarts, 5)))
+                print ("The worker #%i (%i) has exited with the status %i, restarting in %.1f s" % (index, pid, status, delay))
+                if delay:
+                    sleep(delay)
+                if not self.stopping:
+                    self.__slots[index].restarts += 1
+                    self.spawn(index)
+        finally:
+            for (signum, handler) in handlers:
+                signal.signal(signum, handler)
+
+    def stop (self, signum = None, frame = None):
+        """
+        Stops the workers. Called on SIGTERM and SIGINT
+        """
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def spawn (self, index):
+        """
+        Starts the worker with the given index
+        """
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (index, time())
+            self.__slots[index].pid = pid
+            return
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.children.clear()
+            self.__slot = self.__slots[index]
+            self.server = self.factory(index)
+            signal.signal(signal.SIGTERM, self.drain)
+            publisher = threading.Thread(target = self.publisher)
+            publisher.daemon = True
+            publisher.start()
+            self.server.serve()
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            try:
+                if self.server is not None:
+                    self.publish()
+            finally:
+                os._exit(status)
+
+    def drain (self, signum = None, frame = None):
+        """
+        Shuts the server of the worker down. Called on SIGTERM
+        """
+        self.server.shutdown()
+
+    def publisher (self):
+        """
+        Publishes the metrics of the worker periodically
+        """
+        while True:
+            sleep(PUBLISHINTERVAL)
+            self.publish()
+
+    def publish (self):
+        """
+        Publishes the metrics of the server of the worker into its
+        slot
+        """
+        server = self.server
+        self.__lock.acquire()
+        try:
+            self.store(self.__slot, server.stats.collect(), server.queue.waits, len(server.sessions))
+        finally:
+            self.__lock.release()
+
+    def store (self, slot, metrics, waits, sessions):
+        """
+        Writes the given metrics, queue wait histogram and number
+        of the sessions into the given slot
+        """
+        slot.sequence += 1
+        slot.sessions = sessions
+        slot.errors = metrics.errors
+        for (msgtype, count) in metrics.counts.items():
+            slot.counts[msgtype] = count
+        for (msgtype, h) in metrics.handlers.items():
+            slot.handlertimes[msgtype] = storehist(h, slot.handlers[msgtype])
+        slot.sendtime = storehist(metrics.send, slot.send)
+        slot.queuetime = storehist(waits, slot.queue)
+        slot.sequence += 1
+
+    def load (self, slot, timeout = LOADTIMEOUT):
+        """
+        Returns a consistent copy of the given slot. If the slot
+        is still being written when the given number of seconds
+        is out, it's taken for torn and its copy is returned as is
+        """
+        copy = slotdata()
+        deadline = time() + timeout
+        while True:
+            sequence = slot.sequence
+            memmove(addressof(copy), addressof(slot), sizeof(slotdata))
+            if not sequence & 1 and slot.sequence == sequence:
+                return copy
+            if time() >= deadline:
+                return copy
+            sleep(0)
+
+    def metrics (self, slot, timeout = LOADTIMEOUT):
+        """
+        Returns the (metrics, queue wait histogram) pair of the
+        given slot (see ``load``)
+        """
+        copy = self.load(slot, timeout)
+        metrics = p9metrics()
+        metrics.errors = copy.errors
+        for msgtype in range(NTYPES):
+            if copy.counts[msgtype]:
+                metrics.counts[msgtype] = copy.counts[msgtype]
+            if copy.handlertimes[msgtype] or any(copy.handlers[msgtype]):
+                metrics.handlers[msgtype] = loadhist(copy.handlers[msgtype], copy.handlertimes[msgtype])
+        metrics.send = loadhist(copy.send, copy.sendtime)
+        return (metrics, loadhist(copy.queue, copy.queuetime))
+
+    def retire (self, index):
+        """
+        Adds the metrics of the finished worker with the given
+        index to the metrics of the finished workers and clears
+        its slot. The slot is read at once: a worker killed while
+        writing it won't complete it
+        """
+        (slot, retired) = (self.__slots[index], self.__slots[self.processes])
+        (metrics, waits) = self.metrics(slot, 0)
+        (total, totalwaits) = self.metrics(retired)
+        total.merge(metrics)
+        totalwaits.merge(waits)
+        self.store(retired, total, totalwaits, 0)
+        restarts = slot.restarts
+        memset(addressof(slot), 0, sizeof(slotdata))
+        slot.restarts = restarts
+
+    def snapshot (self):
+        """
+        Returns the dictionary of the metrics summed over the
+        workers (see ``p9metrics.snapshot``) with the queue wait
+        time histogram (``queue``), the total number of the
+        sessions and the state of each worker (``processes``).
+        A worker publishes its own metrics first
+        """
+        if self.server is not None:
+            self.publish()
+        (total, waits) = (p9metrics(), histogram())
+        processes = []
+        for index in range(self.processes + 1):
+            slot = self.__slots[index]
+            (metrics, slotwaits) = self.metrics(slot)
+            total.merge(metrics)
+            waits.merge(slotwaits)
+            if index < self.processes:
+                processes.append({
+                    "pid": slot.pid,
+                    "restarts": slot.restarts,
+                    "sessions": slot.sessions,
+                    "messages": sum(metrics.counts.values()),
+                })
+        result = total.snapshot()
+        result.update({
+            "queue": waits.snapshot(),
+            "sessions": sum([process["sessions"] for process in processes]),
+            "processes": processes,
+        })
+        return result
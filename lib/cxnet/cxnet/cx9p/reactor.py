@@ -0,0 +1,417 @@
+"""
+Event-driven 9P server loop
+
+All the client connections of a ``p9socket`` are multiplexed in a
+single thread with the use of ``epoll``. The sockets are switched to
+the non-blocking mode. The incoming data of each connection is read
+into a ``recordstream`` buffer, so any number of pipelined messages
+received at once are split without copying. The replies are queued
+in the outbound queue of the connection and are sent as soon as the
+socket becomes writable. A connection which queue grows over
+``MAXQUEUED`` bytes is not read until the client receives the
+replies.
+
+The messages which handlers don't block are dispatched right in the
+loop. The messages listed in the ``blocking`` set of the worker class
+are passed to the queue workers; the replies of the workers are
+queued the same way and the loop is woken up through a pipe to send
+them. The loop doesn't wait for room in the queue: a connection which
+message fills the queue up is not read until the workers take some
+messages off the queue.
+
+When the server is shutting down (see ``p9socket.shutdown``) the
+loop stops accepting the connections and runs until the queued
+messages are processed or the time is out. The Rerror replies to
+the messages left are sent before the connections are closed.
+"""
+
+#     Copyright (c) 2011 Peter V. Saveliev
+#     Copyright (c) 2011 Paul Wolneykien
+#
+#     This file is part of Connexion project.
+#
+#     Connexion is free software; you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation; either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     Connexion is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with Connexion; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from ctypes import byref, sizeof, c_uint32, get_errno
+from socket import fromfd, error as socketerror, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY
+from errno import EAGAIN, EWOULDBLOCK, EINTR, ECONNABORTED, EPROTO, EMFILE, ENFILE, ENOBUFS, ENOMEM
+from time import time
+import select
+import fcntl
+import os
+import threading
+
+from cxnet.common import libc
+from messages import *
+from mempair import recordstream
+from core import p9channel, sockaddr_in, buffers, errorreply, ACCEPTDELAY
+from output import p9outqueue, libc as errnolibc
+
+__all__ = ["p9reactor", "p9connection"]
+
+# The maximum number of events handled per a single poll
+MAXEVENTS = 256
+
+# The poll timeout (seconds) used to check if the server is closed
+POLLTIMEOUT = 1.0
+
+# The poll timeout (seconds) used while the server is shutting down
+DRAINTIMEOUT = 0.05
+
+# The number of queued outbound bytes the connection is not read at
+MAXQUEUED = 256 * 1024
+
+def nonblocking (fd):
+    """
+    Switches the given file descriptor to the non-blocking mode
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class p9connection (p9channel):
+    """
+    Client-server connection via 9P served by the reactor
+    """
+    def __init__ (self, reactor, p9sock, clsock, p9msize = MAX_MSG_SIZE):
+        """
+        Initializes the connection object bound to the specified
+        reactor and 9P socket instance. The ``clsock`` is a
+        non-blocking socket object
+        """
+        p9channel.__init__(self, p9sock, clsock.fileno(), p9msize)
+        self.reactor = reactor
+        self.sock = clsock
+        self.input = recordstream(p9msg, maxsize = MAX_MSG_SIZE)
+        self.output = p9outqueue(self.fd, buffers.put)
+
+    def readable (self):
+        """
+        Reads the data available from the socket and processes
+        the complete messages after each read, so only the
+        remainder of an incomplete message is moved when the
+        input buffer is renewed. Stops reading when too much
+        data is queued to be sent or the connection is throttled
+        (see ``enqueue``). Returns ``False`` if the connection is
+        closed by the client
+        """
+        while self.output.queued < MAXQUEUED and self not in self.reactor.throttled:
+            try:
+                l = self.sock.recv_into(self.input.view())
+            except socketerror as e:
+                if e.args[0] in (EAGAIN, EWOULDBLOCK):
+                    break
+                if e.args[0] == EINTR:
+                    continue
+                return False
+            if l == 0:
+                return False
+            self.input.feed(l)
+            self.bytesin += l
+            self.debug ("%i bytes received", l)
+            try:
+                for msg in self.input:
+                    self.received(msg)
+            except ValueError as e:
+                self.debug (str(e))
+                return False
+        return True
+
+    def received (self, msg):
+        """
+        Processes the given T-message: the non-blocking handlers
+        are called at once while the others are left to the
+        queue workers. A handler failure is answered with Rerror,
+        so the loop keeps running
+        """
+        if msg.type == Tflush._type or msg.type in self.reactor.blocking:
+            p9channel.received(self, msg)
+        elif self.server.draining:
+            self.server.reject(self, msg)
+        else:
+            try:
+                rmsg = self.reactor.dispatch(self, msg)
+            except Exception as e:
+                self.debug ("Unable to process the %i tag: %s", msg.tag, e)
+                rmsg = errorreply(msg, str(e))
+            try:
+                self.reply(rmsg, False)
+            except ValueError as e:
+                self.debug ("Unable to send the reply: %s", e)
+
+    def enqueue (self, msg):
+        """
+        Passes the given message to the queue workers without
+        waiting for room in the queue. The connection is throttled
+        (not read) if the queue is full
+        """
+        if not self.server.enqueue(self, msg, False):
+            self.reactor.throttled.add(self)
+
+    def transmit (self, rmsg, baddr, blen):
+        """
+        Queues the given message to be sent when the socket is
+        writable. If called outside of the reactor thread the
+        loop is woken up to send the message
+        """
+        self.output.put(rmsg.data, rmsg.dataoffset(), blen)
+        if not self.reactor.inloop():
+            self.reactor.wakeup(self)
+        return blen
+
+    def transmitpayload (self, rmsg):
+        """
+        Queues the header and the payload of the given reply
+        to be sent when the socket is writable
+        """
+        rmsg.queue(self.output)
+        if not self.reactor.inloop():
+            self.reactor.wakeup(self)
+        return rmsg.size
+
+    def flush (self):
+        """
+        Sends as much of the queued data as the socket accepts.
+        Returns ``True`` if some data is left to be sent
+        """
+        return self.output.flush()
+
+    def close (self):
+        """
+        Closes the connection
+        """
+        self.closed = True
+        self.sock.close()
+        self.output.clear()
+        self.server.unregister(self)
+        self.debug ("The session is closed, write sizes: %s", sorted(self.output.histogram.items()))
+
+
+class p9reactor (object):
+    """
+    Serves the connections of the given 9P socket in a single
+    ``epoll`` loop
+    """
+    def __init__ (self, p9sock):
+        """
+        Sets up the loop over the listening socket of the given
+        9P socket instance
+        """
+        self.server = p9sock
+        self.dispatch = p9sock.dispatcher.dispatch
+        self.blocking = p9sock.dispatcher.blocking
+        self.connections = {}
+        self.poll = select.epoll()
+        (self.wakefd, self.notifyfd) = os.pipe()
+        nonblocking(self.wakefd)
+        nonblocking(self.notifyfd)
+        nonblocking(p9sock.fd)
+        self.poll.register(p9sock.fd, select.EPOLLIN)
+        self.poll.register(self.wakefd, select.EPOLLIN)
+        self.__pending = set()
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.throttled = set()
+        self.stopped = False
+
+    def inloop (self):
+        """
+        Indicates if called from the thread running the loop
+        """
+        return threading.current_thread() is self.__thread
+
+    def wakeup (self, conn):
+        """
+        Schedules the outbound data of the given connection to
+        be sent by the loop and wakes the loop up. Does nothing
+        once the loop is stopped
+        """
+        self.__lock.acquire()
+        try:
+            if self.stopped or self.__pending:
+                self.__pending.add(conn)
+                return
+            self.__pending.add(conn)
+            try:
+                os.write(self.notifyfd, "w")
+            except OSError as e:
+                if e.errno != EAGAIN:
+                    raise
+        finally:
+            self.__lock.release()
+
+    def accept (self):
+        """
+        Accepts all the pending client connections. Returns False
+        if the connections can't be accepted for the lack of the
+        resources (descriptors or memory) for a while, so the
+        listening socket should not be polled meantime
+        """
+        while True:
+            sa = sockaddr_in()
+            fd = errnolibc.accept(self.server.fd, byref(sa), byref(c_uint32(sizeof(sa))))
+            if fd < 0:
+                errno = get_errno()
+                if errno in (EAGAIN, EWOULDBLOCK) or self.server.draining or self.server.closed:
+                    return True
+                if errno in (EINTR, ECONNABORTED, EPROTO):
+                    continue
+                if errno in (EMFILE, ENFILE, ENOBUFS, ENOMEM):
+                    self.server.debug ("Unable to accept a connection: %s", os.strerror(errno))
+                    return False
+                raise IOError (errno, os.strerror(errno))
+            try:
+                clsock = fromfd(fd, AF_INET, SOCK_STREAM)
+            except socketerror as e:
+                # No descriptor to duplicate the accepted one
+                libc.close(fd)
+                if e.args[0] in (EMFILE, ENFILE, ENOBUFS, ENOMEM):
+                    self.server.debug ("Unable to accept a connection: %s", os.strerror(e.args[0]))
+                    return False
+                raise
+            libc.close(fd)
+            clsock.setblocking(0)
+            clsock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            conn = p9connection(self, self.server, clsock)
+            if not self.server.register(conn):
+                self.server.debug ("Too many sessions, the connection is refused")
+                clsock.close()
+                continue
+            conn.debug ("Start a new session")
+            self.connections[conn.fd] = conn
+            self.poll.register(conn.fd, select.EPOLLIN)
+
+    def update (self, conn):
+        """
+        Sends the queued data of the given connection and waits
+        for the socket to become writable if some data is left.
+        The connection is not read while too much data is queued
+        or while it's throttled
+        """
+        try:
+            more = conn.flush()
+        except IOError:
+            self.drop (conn)
+            return
+        mask = 0
+        if more:
+            mask |= select.EPOLLOUT
+        if conn.output.queued < MAXQUEUED and conn not in self.throttled:
+            mask |= select.EPOLLIN
+        self.poll.modify(conn.fd, mask)
+
+    def drop (self, conn):
+        """
+        Closes the given connection
+        """
+        self.throttled.discard(conn)
+        if self.connections.pop(conn.fd, None) is not None:
+            self.poll.unregister(conn.fd)
+            conn.close()
+
+    def wakeups (self):
+        """
+        Sends the data queued by the queue workers
+        """
+        try:
+            while os.read(self.wakefd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != EAGAIN:
+                raise
+        self.__lock.acquire()
+        pending = self.__pending
+        self.__pending = set()
+        self.__lock.release()
+        for conn in pending:
+            if not conn.closed:
+                self.update (conn)
+
+    def unthrottle (self):
+        """
+        Resumes reading the throttled connections once there is
+        room in the queue
+        """
+        if not self.throttled or self.server.queue.full():
+            return
+        throttled = self.throttled
+        self.throttled = set()
+        for conn in throttled:
+            if not conn.closed:
+                self.update (conn)
+
+    def run (self):
+        """
+        Runs the loop until the server is closed or shut down
+        """
+        self.__thread = threading.current_thread()
+        listening = True
+        resume = None
+        try:
+            while not self.server.closed and not self.server.drained():
+                timeout = POLLTIMEOUT
+                if self.server.draining:
+                    timeout = DRAINTIMEOUT
+                    resume = None
+                    if listening:
+                        self.poll.unregister(self.server.fd)
+                        listening = False
+                elif resume is not None:
+                    # Accepting is paused for the lack of resources
+                    delay = resume - time()
+                    if delay > 0:
+                        timeout = min(timeout, delay)
+                    else:
+                        self.poll.register(self.server.fd, select.EPOLLIN)
+                        listening = True
+                        resume = None
+                try:
+                    events = self.poll.poll(timeout, MAXEVENTS)
+                except IOError as e:
+                    if e.errno == EINTR:
+                        continue
+                    raise
+                for (fd, event) in events:
+                    if fd == self.server.fd:
+                        if listening and not self.accept():
+                            self.poll.unregister(self.server.fd)
+                            listening = False
+                            resume = time() + ACCEPTDELAY
+                    elif fd == self.wakefd:
+                        self.wakeups()
+                    else:
+                        conn = self.connections.get(fd)
+                        if conn is None:
+                            continue
+                        if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                            if not conn.readable():
+                                self.drop (conn)
+                                continue
+                        self.update (conn)
+                self.unthrottle()
+        finally:
+            self.server.abort()
+            for conn in self.connections.values():
+                try:
+                    conn.flush()
+                except IOError:
+                    pass
+                self.drop (conn)
+            self.poll.close()
+            self.__lock.acquire()
+            self.stopped = True
+            os.close(self.wakefd)
+            os.close(self.notifyfd)
+            self.__lock.release()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Loopback benchmark of the Rread data path.
+
+The server answers Tread requests with the data taken from a
+string or from a file. The fid of the request selects the way the
+reply is made:
+
+* 0 -- the data is copied into the message buffer (``basereply``);
+* 1 -- the string is sent as a ``p9payload`` with ``writev()``;
+* 2 -- the file region is sent as a ``p9payload`` with ``sendfile()``.
+
+Each mode is run with the default message size and with a larger one
+negotiated with Tversion to show the effect of the size of the
+transfers.
+"""
+
+from __future__ import print_function
+
+from multiprocessing import Process
+from time import time, sleep
+import tempfile
+import socket
+import struct
+import os
+
+from cxnet.cx9p.messages import *
+from cxnet.cx9p.core import p9socket, p9socketworker, p9payload, basereply
+from cxnet.cx9p.serverbench import run, recvall
+from cxnet.cx9p import codec
+
+PORT = 10903
+
+# The message sizes to compare
+MSIZES = (MAX_MSG_SIZE, 128 * 1024)
+
+# The number of requests sent at once
+DEPTH = 4
+
+# The amount of data transferred per mode
+TRANSFER = 64 * 1024 * 1024
+
+payload = os.urandom(MSIZES[-1] - IOHDRSZ)
+
+class worker (p9socketworker):
+    handlers = dict(p9socketworker.handlers)
+    handlers[Tread._type] = "read"
+
+    datafile = None
+
+    def read (self, session, msg):
+        if msg.fid == 0:
+            return basereply(msg, count = msg.count, data = payload[:msg.count])
+        elif msg.fid == 1:
+            return p9payload(msg, buffer(payload, 0, msg.count))
+        else:
+            return p9payload(msg, (worker.datafile, msg.offset, msg.count))
+
+class server (p9socket):
+    workerclass = worker
+
+def serve ():
+    datafile = tempfile.TemporaryFile()
+    datafile.write(payload)
+    datafile.flush()
+    worker.datafile = datafile.fileno()
+    server('127.0.0.1', PORT).serve()
+
+def connect (msize):
+    """
+    Connects to the server and negotiates the given message size
+    """
+    sock = socket.create_connection(('127.0.0.1', PORT))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    buf = bytearray(NORM_MSG_SIZE)
+    length = codec.encode({"type": Tversion._type, "tag": NOTAG, "msize": msize, "version": VERSION9P}, buf)
+    sock.sendall(bytes(buf[:length]))
+    header = recvall(sock, 4)
+    rmsg = codec.decode(header + recvall(sock, struct.unpack("<I", header)[0] - 4))
+    assert rmsg["msize"] == msize, "Wrong message size negotiated: %d" % rmsg["msize"]
+    return sock
+
+def bench (sock, name, fid, msize, depth = DEPTH):
+    readsize = msize - IOHDRSZ
+    rounds = max(TRANSFER // (readsize * depth), 1)
+    buf = bytearray(NORM_MSG_SIZE * depth)
+    length = 0
+    for tag in range(depth):
+        length += codec.encode({"type": Tread._type, "tag": tag, "fid": fid, "offset": 0, "count": readsize}, buf, length)
+    request = bytes(buf[:length])
+    received = 0
+    start = time()
+    for i in range(rounds):
+        sock.sendall(request)
+        for tag in range(depth):
+            header = recvall(sock, 11)
+            (size, rtype, rtag, count) = struct.unpack("<IBHI", header)
+            data = recvall(sock, size - 11)
+            received += count
+    elapsed = time() - start
+    assert data == payload[:readsize], "Wrong data received"
+    print ("Rread %-8s %6d bytes %10.0f msg/s %8.1f MB/s" % (name, readsize, rounds * depth / elapsed, received / elapsed / 1e6))
+
+if __name__ == "__main__":
+    proc = Process(target = run, args = (serve,))
+    proc.daemon = True
+    proc.start()
+    sleep(0.5)
+    try:
+        for msize in MSIZES:
+            sock = connect(msize)
+            for (name, fid) in (("copy", 0), ("buffer", 1), ("sendfile", 2)):
+                bench (sock, name, fid, msize)
+            sock.close()
+    finally:
+        proc.terminate()
+        proc.join()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Loopback comparison of the 9P server modes: the threaded
+``p9socket``, the ``p9socket`` reactor and the asyncio server.
+
+Each server is run in a separate process. A number of client
+processes connect to it and make the given number of Tversion
+round trips each, sending the given number of pipelined requests
+at a time. The throughput and the latency percentiles are printed
+for every server
+"""
+
+from __future__ import print_function
+
+from multiprocessing import Process, Pool
+from time import time, sleep
+import socket
+import struct
+import sys
+import os
+
+from cxnet.cx9p.messages import *
+from cxnet.cx9p import codec
+
+# The port the servers listen on
+PORT = 10901
+
+# The number of client processes
+NCLIENTS = 4
+
+# The number of round trips made by each client
+ROUNDS = 2000
+
+# The number of requests sent at once
+DEPTH = 1
+
+def threaded ():
+    from cxnet.cx9p.core import p9socket
+    p9socket('127.0.0.1', PORT).serve()
+
+def reactor ():
+    from cxnet.cx9p.core import p9socket
+    p9socket('127.0.0.1', PORT, reactor = True).serve()
+
+def asyncio ():
+    from cxnet.cx9p.aio import p9asyncserver
+    server = p9asyncserver()
+    server.loop.run_until_complete(server.serve('127.0.0.1', PORT))
+    server.loop.run_forever()
+
+def run (server):
+    """
+    Runs the given server function with the output suppressed
+    """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    server()
+
+def recvall (sock, length):
+    """
+    Receives exactly ``length`` bytes
+    """
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise IOError("The connection is closed")
+        data += chunk
+    return data
+
+def client (args):
+    """
+    Makes the given number of round trips sending ``depth``
+    Tversion requests at once. Returns the list of the latencies
+    """
+    (rounds, depth) = args
+    sock = socket.create_connection(('127.0.0.1', PORT))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    buf = bytearray(NORM_MSG_SIZE * depth)
+    latencies = []
+    for i in range(rounds):
+        length = 0
+        for tag in range(depth):
+            length += codec.encode({"type": Tversion._type, "tag": tag, "msize": MAX_MSG_SIZE, "version": VERSION9P}, buf, length)
+        start = time()
+        sock.sendall(bytes(buf[:length]))
+        for tag in range(depth):
+            (size,) = struct.unpack("<I", recvall(sock, 4))
+            recvall(sock, size - 4)
+            latencies.append(time() - start)
+    sock.close()
+    return latencies
+
+def percentile (values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def bench (name, server, nclients = NCLIENTS, rounds = ROUNDS, depth = DEPTH):
+    """
+    Runs the given server and measures it with the clients
+    """
+    proc = Process(target = run, args = (server,))
+    proc.daemon = True
+    proc.start()
+    sleep(0.5)
+    pool = Pool(nclients)
+    try:
+        start = time()
+        results = pool.map(client, [(rounds, depth)] * nclients)
+        elapsed = time() - start
+    finally:
+        pool.terminate()
+        proc.terminate()
+        proc.join()
+    latencies = sorted(sum(results, []))
+    print ("%-10s depth %-3d %10.0f msg/s  p50 %8.1f us  p99 %8.1f us" % (name, depth, len(latencies) / elapsed, percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6))
+
+if __name__ == "__main__":
+    servers = [("threaded", threaded), ("reactor", reactor)]
+    try:
+        import trollius
+    except ImportError:
+        print ("asyncio: the trollius package is not installed", file = sys.stderr)
+    else:
+        servers.append(("asyncio", asyncio))
+    for depth in (1, 8):
+        for (name, server) in servers:
+            bench (name, server, rounds = ROUNDS // depth, depth = depth)
@@ -0,0 +1,272 @@
+"""
+Fair scheduling of the T-messages among the sessions
+
+Each session has its own queue of the T-messages waiting to be
+processed. The sessions having some messages waiting form a ring
+which is served in a round-robin fashion: a worker takes one message
+of the session at the head of the ring, and the session is put back
+to the tail when the message is processed. Thus the messages of a
+session are processed one by one in the order they are received, and
+a chatty client can't delay the others by more than one message per
+turn.
+
+A session may be allowed to have more than one message processed at
+a time (``maxactive``): then the session is put back to the tail of
+the ring as soon as its message is taken, while it has less than
+that number of messages being processed. That lets the pipelined
+requests of a client wait for a slow backend in parallel, but the
+replies may come in any order.
+
+The number of the waiting messages of a session, the number of the
+processed ones and the time they have waited in the queue are
+counted per session. The waiting times of all the messages are also
+counted in the ``waits`` histogram (see the ``metrics`` module).
+"""
+
+#     Copyright (c) 2011 Peter V. Saveliev
+#     Copyright (c) 2011 Paul Wolneykien
+#
+#     This file is part of Connexion project.
+#
+#     Connexion is free software; you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation; either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     Connexion is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with Connexion; if not, write to the Free Software
+#     Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from collections import deque
+from time import time
+import threading
+
+from metrics import histogram
+
+__all__ = ["p9workqueue"]
+
+class sessionqueue (object):
+    """
+    The queue of the messages of a session
+    """
+    def __init__ (self, session):
+        self.session = session
+        self.msgs = deque()
+        self.active = 0
+        self.served = 0
+        self.waited = 0.0
+        self.maxwait = 0.0
+
+    def stats (self):
+        return {
+            "depth": len(self.msgs),
+            "served": self.served,
+            "waited": self.waited,
+            "maxwait": self.maxwait,
+        }
+
+class p9workqueue (object):
+    """
+    A set of the per-session message queues served in turn
+    """
+    def __init__ (self, maxwaiting, grow = None, maxactive = 1):
+        """
+        Sets up the queues holding no more than ``maxwaiting``
+        messages in total. The ``grow`` function is called when a
+        message is queued while no worker is waiting for it. No
+        more than ``maxactive`` messages of a session are processed
+        at a time
+        """
+        self.maxwaiting = maxwaiting
+        self.maxactive = maxactive
+        self.grow = grow
+        self.waiting = 0
+        self.unfinished = 0
+        self.idle = 0
+        self.stopped = False
+        self.waits = histogram()
+        self.__queues = {}
+        self.__ring = deque()
+        self.__lock = threading.Lock()
+        self.__ready = threading.Condition(self.__lock)
+        self.__space = threading.Condition(self.__lock)
+        self.__done = threading.Condition(self.__lock)
+
+    def put (self, session, msg, block = True):
+        """
+        Queues the given message of the given session. Blocks
+        while the total number of the waiting messages reaches
+        the limit. If ``block`` is not set the message is queued
+        at once even over the limit, so the caller should stop
+        producing messages when ``False`` is returned: the limit
+        is reached (see ``full``). Returns ``True`` otherwise
+        """
+        self.__lock.acquire()
+        try:
+            while block and self.waiting >= self.maxwaiting:
+                self.__space.wait()
+            queue = self.__queues.get(session)
+            if queue is None:
+                queue = self.__queues[session] = sessionqueue(session)
+            queue.msgs.append((msg, time()))
+            if queue.active < self.maxactive and len(queue.msgs) == 1:
+                self.__ring.append(queue)
+            self.waiting += 1
+            self.unfinished += 1
+            self.__ready.notify()
+            grow = not self.idle
+            room = self.waiting < self.maxwaiting
+        finally:
+            self.__lock.release()
+        if grow and self.grow is not None:
+            self.grow()
+        return room
+
+    def full (self):
+        """
+        Indicates if the number of the waiting messages reaches
+        the limit
+        """
+        return self.waiting >= self.maxwaiting
+
+    def get (self):
+        """
+        Returns the next (session, msg) tuple to process or
+        (None, None) if the queue is stopped
+        """
+        self.__lock.acquire()
+        try:
+            self.idle += 1
+            while not self.__ring and not self.stopped:
+                self.__ready.wait()
+            self.idle -= 1
+            if not self.__ring:
+                return (None, None)
+            queue = self.__ring.popleft()
+            (msg, queued) = queue.msgs.popleft()
+            queue.active += 1
+            if queue.msgs and queue.active < self.maxactive:
+                self.__ring.append(queue)
+            wait = time() - queued
+            self.waits.add(wait)
+            queue.waited += wait
+            if wait > queue.maxwait:
+                queue.maxwait = wait
+            self.waiting -= 1
+            self.__space.notify()
+            return (queue.session, msg)
+        finally:
+            self.__lock.release()
+
+    def done (self, session):
+        """
+        Marks a message of the given session taken from the
+        queue as processed, so the next one can be taken
+        """
+        self.__lock.acquire()
+        try:
+            self.unfinished -= 1
+            queue = self.__queues.get(session)
+            if queue is not None:
+                queue.served += 1
+                queue.active -= 1
+                if queue.msgs and queue.active == self.maxactive - 1:
+                    self.__ring.append(queue)
+                    self.__ready.notify()
+            if not self.unfinished:
+                self.__done.notify_all()
+        finally:
+            self.__lock.release()
+
+    def forget (self, session):
+        """
+        Discards the waiting messages and the statistics of the
+        given session. Returns the discarded messages
+        """
+        self.__lock.acquire()
+        try:
+            queue = self.__queues.pop(session, None)
+            if queue is None:
+                return []
+            if queue in self.__ring:
+                self.__ring.remove(queue)
+            msgs = [msg for (msg, queued) in queue.msgs]
+            self.waiting -= len(msgs)
+            self.unfinished -= len(msgs)
+            self.__space.notify_all()
+            if not self.unfinished:
+                self.__done.notify_all()
+            return msgs
+        finally:
+            self.__lock.release()
+
+    def join (self, timeout = None):
+        """
+        Waits for all the queued messages to be processed, no
+        longer than the given number of seconds if ``timeout`` is
+        given. Returns ``False`` if some messages are left
+        """
+        self.__lock.acquire()
+        try:
+            if timeout is not None:
+                deadline = time() + timeout
+            while self.unfinished:
+                if timeout is None:
+                    self.__done.wait()
+                else:
+                    left = deadline - time()
+                    if left <= 0:
+                        return False
+                    self.__done.wait(left)
+            return True
+        finally:
+            self.__lock.release()
+
+    def abort (self):
+        """
+        Discards the waiting messages of all the sessions. Returns
+        the list of the discarded (session, msg) tuples
+        """
+        self.__lock.acquire()
+        try:
+            msgs = []
+            for queue in self.__queues.values():
+                msgs.extend([(queue.session, msg) for (msg, queued) in queue.msgs])
+                queue.msgs.clear()
+            self.__ring.clear()
+            self.waiting -= len(msgs)
+            self.unfinished -= len(msgs)
+            self.__space.notify_all()
+            if not self.unfinished:
+                self.__done.notify_all()
+            return msgs
+        finally:
+            self.__lock.release()
+
+    def stop (self):
+        """
+        Makes the workers waiting for messages finish
+        """
+        self.__lock.acquire()
+        self.stopped = True
+        self.__ready.notify_all()
+        self.__lock.release()
+
+    def stats (self):
+        """
+        Returns the dictionary mapping each session to its queue
+        statistics: the number of waiting messages (``depth``),
+        the number of processed ones (``served``), and the total
+        and the maximum time (seconds) the messages have waited
+        in the queue (``waited``, ``maxwait``)
+        """
+        self.__lock.acquire()
+        try:
+            return dict([(session, queue.stats()) for (session, queue) in self.__queues.items()])
+        finally:
+            self.__lock.release()
@@ -1,3 +1,6 @@
-__all__ = ["mempair"]
+__all__ = ["mempair", "build", "recordstream", "bufferpool"]
 
 from mempair import mempair
+from builder import build
+from stream import recordstream
+from pool import bufferpool
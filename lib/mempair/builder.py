@@ -0,0 +1,113 @@
+# coding: utf-8
+
+"""
+The module for constructing a memory block from a set of values in
+one pass.
+
+The block is written sequentially, from the start to the end, the
+same way it is parsed (see the ``mempair`` module). At each step the
+car of the next pair is placed at the current offset, its fields are
+set from the given values and then its ``cdarclass()`` and
+``cdrmap()`` methods are consulted to determine what follows. Thus
+every byte of the block is written exactly once and the total length
+of the written data is known as soon as the last element is written.
+
+The values are given as follows:
+
+* A dictionary maps the names of the car fields and the names of
+  the tail fields listed by ``cdrmap()`` to their values. The fields
+  of the pairs, the class of which is determined by ``cdarclass()``,
+  and of the static ``_tail`` structures are taken from the same
+  dictionary as the fields of the car.
+
+* A list defines the elements of a tail field with the count
+  greater than one. The length of the list should be equal to the
+  count returned by ``cdrmap()``.
+
+* A tuple defines the values of the fields of a structure in the
+  order of their declaration.
+
+* A string (or any object supporting the buffer interface) is
+  copied into an array of bytes. If the car of an element consists
+  of a single field, like the one of a counted string, that field is
+  set to the length of the string and the string is written to the
+  tail.
+
+* A ``ctypes`` object of the same class is copied as is.
+
+The missing values are filled with zeros.
+"""
+
+from ctypes import sizeof, addressof, memmove, memset
+from mempair import mempair
+from layout import layoutof, carat
+
+def build (carclass, values, data, offset = 0):
+	"""
+	Writes the given values into the given memory block starting
+	at the given offset. Returns the tuple (pair, length), where
+	``pair`` is the ``mempair`` object over the written data with
+	the car of the given class and ``length`` is the number of
+	bytes written.
+	"""
+	end = write(carclass, values, data, offset)
+	return (mempair(carclass, data, offset = offset), end - offset)
+
+def write (carclass, value, data, offset):
+	"""
+	Writes an element with the car of the given class and the
+	tail the car is responsible for at the given offset of the
+	memory block. Returns the offset next to the written element.
+	"""
+	while True:
+		car = carat(carclass, data, offset)
+		if isinstance(value, tuple):
+			value = carclass(*value)
+		if isinstance(value, carclass):
+			memmove(addressof(car), addressof(value), sizeof(carclass))
+			value = {}
+		elif isinstance(value, dict) or value is None:
+			memset(addressof(car), 0, sizeof(carclass))
+			if value:
+				for field in getattr(carclass, "_fields_", ()):
+					if field[0] in value:
+						setattr(car, field[0], value[field[0]])
+			else:
+				value = {}
+		else:
+			if not isinstance(value, bytes):
+				value = memoryview(value).tobytes()
+			fields = getattr(carclass, "_fields_", None)
+			if fields is None:
+				# An array of bytes
+				if len(value) > sizeof(carclass):
+					raise ValueError("The value length (%d) exceeds the length of the array (%d)." % (len(value), sizeof(carclass)))
+				memmove(addressof(car), value, len(value))
+				memset(addressof(car) + len(value), 0, sizeof(carclass) - len(value))
+				return offset + sizeof(carclass)
+			elif len(fields) == 1:
+				# A counted string
+				memset(addressof(car), 0, sizeof(carclass))
+				setattr(car, fields[0][0], len(value))
+			else:
+				raise TypeError("Unable to write a string to the '%s' object." % carclass.__name__)
+
+		layout = layoutof(car)
+		offset += layout.carsize
+		if layout.cdrmap is not None:
+			for (fname, ftype, fcount, foff, index) in layout.entries:
+				if fname == "_tail":
+					items = [value]
+				else:
+					items = value.get(fname)
+					if not isinstance(items, list):
+						items = [items] * fcount
+					elif len(items) != fcount:
+						raise ValueError("The number of the '%s' elements (%d) doesn't match the count (%d)." % (fname, len(items), fcount))
+				for item in items:
+					offset = write(ftype, item, data, offset)
+			return offset
+		elif layout.cdarclass is not type(None):
+			carclass = layout.cdarclass
+		else:
+			return offset
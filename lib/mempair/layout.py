@@ -0,0 +1,259 @@
+# coding: utf-8
+
+"""
+Compiled pair layouts.
+
+A layout describes the placement of the parts of a pair within its
+memory block: the static head (car), the class of the car of the next
+pair and the offsets of the named tail fields listed by the
+``cdrmap()`` method of the car object. Since the layout of a pair is
+fully determined by its car class and the values returned by the
+``cdarclass()`` and ``cdrmap()`` methods of the car, it is compiled
+only once for every distinct combination of them. Compiled layouts
+are kept in a bounded LRU cache, so a typical message shape is
+resolved with one dictionary lookup.
+
+The offset of a tail field is known at compile time if all the
+fields before it have a static length (i.e. their classes define
+neither ``cdarclass()`` nor ``cdrmap()``). Otherwise the offset is
+calculated in runtime starting from the nearest static one and
+skipping over the variable length elements with the use of their
+own layouts.
+"""
+
+from ctypes import sizeof
+import itertools
+import threading
+
+# The maximum number of compiled layouts kept in the cache
+MAXLAYOUTS = 1024
+
+class lrucache (object):
+	"""
+	A bounded mapping that discards the least recently used items
+	when the size limit is reached.
+
+	Each item is stamped with the value of a counter when it is
+	accessed, so a lookup costs a single dictionary access. When the
+	cache is full, the oldest quarter of the items is discarded at
+	once.
+	"""
+
+	def __init__ (self, maxsize = MAXLAYOUTS):
+		"""
+		Sets up an empty cache holding up to ``maxsize`` items.
+		"""
+		self.maxsize = maxsize
+		self.hits = 0
+		self.misses = 0
+		self.__items = {}
+		self.__clock = itertools.count()
+		self.__lock = threading.Lock()
+
+	def get (self, key):
+		"""
+		Returns the item stored under the given key marking it as
+		the most recently used one, or ``None`` if there is no
+		such item.
+		"""
+		item = self.__items.get(key)
+		if item is None:
+			self.misses += 1
+			return None
+		item[1] = next(self.__clock)
+		self.hits += 1
+		return item[0]
+
+	def put (self, key, value):
+		"""
+		Stores the given item discarding the least recently used
+		ones if the cache is full.
+		"""
+		self.__lock.acquire()
+		if len(self.__items) >= self.maxsize:
+			items = sorted(self.__items.items(), key = lambda item: item[1][1])
+			for (oldkey, olditem) in items[:max(1, self.maxsize // 4)]:
+				del self.__items[oldkey]
+		self.__items[key] = [value, next(self.__clock)]
+		self.__lock.release()
+
+	def clear (self):
+		"""
+		Discards all the items and resets the statistics.
+		"""
+		self.__lock.acquire()
+		self.__items.clear()
+		self.hits = 0
+		self.misses = 0
+		self.__lock.release()
+
+	def __len__ (self):
+		return len(self.__items)
+
+# The cache of compiled layouts
+layouts = lrucache()
+
+def isstatic (carclass):
+	"""
+	Indicates if the elements of the given class have a static
+	length, i.e. are not followed by a tail they are responsible for.
+	"""
+	return not (hasattr(carclass, "cdarclass") or hasattr(carclass, "cdrmap"))
+
+class layout (object):
+	"""
+	A compiled layout of a pair.
+
+	The ``cdarclass`` attribute holds the class of the car of the
+	next pair or ``type(None)`` if the car is not responsible for
+	the next pair. The ``fields`` dictionary maps each name listed
+	by ``cdrmap()`` to its position in the map, while the
+	``entries`` list holds the ``(fname, ftype, fcount, offset,
+	index)`` tuples in the map order. The ``offset`` is relative to
+	the start of the pair and is ``None`` if it can't be determined
+	statically. The ``index`` is the index of the first element of
+	the field relative to the pair. The ``tailfields`` dictionary
+	maps the names of the fields of a static ``_tail`` structure to
+	the position of that structure in the map.
+	"""
+
+	def __init__ (self, carclass, cdarclass, cdrmap):
+		"""
+		Compiles the layout of a pair with the car of the given
+		class and the given results of its ``cdarclass()`` and
+		``cdrmap()`` methods (the latter is ``None`` if the
+		method is not defined).
+		"""
+		self.carclass = carclass
+		self.carsize = sizeof(carclass)
+		self.cdrmap = cdrmap
+		self.fields = {}
+		self.tailfields = {}
+		self.entries = []
+
+		if cdrmap is None:
+			self.cdarclass = cdarclass
+			return
+
+		if cdrmap:
+			self.cdarclass = cdrmap[0][1]
+		else:
+			self.cdarclass = type(None)
+
+		offset = self.carsize
+		index = 0
+		for (fname, ftype, fcount) in cdrmap:
+			self.fields[fname] = len(self.entries)
+			if fname == "_tail":
+				for field in ftype._fields_:
+					self.tailfields[field[0]] = len(self.entries)
+			self.entries.append((fname, ftype, fcount, offset, index))
+			if offset is not None and isstatic(ftype):
+				offset += sizeof(ftype) * fcount
+			else:
+				offset = None
+			index += fcount
+
+	def offsetof (self, pos, data, offset = 0):
+		"""
+		Returns the offset of the map entry at the given position
+		relative to the start of the given memory block. The
+		``offset`` argument is the offset of the pair within
+		that block.
+		"""
+		start = pos
+		while self.entries[start][3] is None:
+			start -= 1
+		off = offset + self.entries[start][3]
+		for (fname, ftype, fcount, foff, index) in self.entries[start:pos]:
+			off = skip(ftype, fcount, data, off)
+		return off
+
+# The (cdarclass, cdrmap) method pairs of the known car classes
+hooks = {}
+
+def layoutof (car):
+	"""
+	Returns the compiled layout for the given car object.
+	"""
+	carclass = type(car)
+	try:
+		(getcdar, getcdrmap) = hooks[carclass]
+	except KeyError:
+		getcdar = getattr(carclass, "cdarclass", None)
+		getcdrmap = getattr(carclass, "cdrmap", None)
+		hooks[carclass] = (getcdar, getcdrmap)
+
+	if getcdar is not None:
+		cdarclass = getcdar(car)
+	else:
+		cdarclass = type(None)
+	if getcdrmap is not None:
+		cdrmap = tuple(getcdrmap(car))
+	else:
+		cdrmap = None
+
+	key = (carclass, cdarclass, cdrmap)
+	compiled = layouts.get(key)
+	if compiled is None:
+		compiled = layout(carclass, cdarclass, cdrmap)
+		layouts.put(key, compiled)
+	return compiled
+
+def buflen (data):
+	"""
+	Returns the length of the given memory block which is either
+	a ``ctypes`` object or an object supporting the buffer interface.
+	"""
+	if isinstance(data, bytearray):
+		return len(data)
+	try:
+		return sizeof(data)
+	except TypeError:
+		view = memoryview(data)
+		return len(view) * view.itemsize
+
+def carat (carclass, data, offset):
+	"""
+	Returns the car object of the given class placed at the given
+	offset of the memory block.
+	"""
+	if offset + sizeof(carclass) > buflen(data):
+		raise OverflowError("The length of memory block (%d) is less than the length of the static head (%d)." % (buflen(data) - offset, sizeof(carclass)))
+	return carclass.from_buffer(data, offset)
+
+def extent (carclass, data, offset = 0):
+	"""
+	Returns the number of bytes occupied by the element with the
+	car of the given class placed at the given offset, including
+	the tail it is responsible for.
+	"""
+	return skip(carclass, 1, data, offset) - offset
+
+def skip (carclass, count, data, offset):
+	"""
+	Returns the offset next to the ``count`` elements with the car
+	of the given class placed at the given offset.
+
+	The elements are walked iteratively with the use of a stack of
+	the pending (class, count) items, so the depth of the nesting
+	is not limited by the recursion limit.
+	"""
+	pending = [(carclass, count)]
+	while pending:
+		(carclass, count) = pending.pop()
+		if isstatic(carclass):
+			offset += sizeof(carclass) * count
+			continue
+		if count > 1:
+			pending.append((carclass, count - 1))
+		elif count < 1:
+			continue
+		compiled = layoutof(carat(carclass, data, offset))
+		offset += compiled.carsize
+		if compiled.cdrmap is not None:
+			for entry in reversed(compiled.entries):
+				pending.append((entry[1], entry[2]))
+		elif compiled.cdarclass is not type(None):
+			pending.append((compiled.cdarclass, 1))
+	return offset
@@ -55,36 +55,109 @@ value is incremented for each defined pair starting with 0.
   some limit then the ``IndexError`` should be raised. In that case,
   as when no ``cdarclass()`` method is defined for a car object at all,
   the call is transferred to the parent object.
+
+4. Compiled layouts
+===================
+
+The attributes of the tail of a pair are located with the use of the
+compiled layouts (see the ``layout`` module) instead of walking the
+chain of pairs: the class of the next car and the offsets of the
+named tail fields are computed once for each distinct combination of
+the car class and the values returned by its ``cdarclass()`` and
+``cdrmap()`` methods.
 """
 
-from ctypes import c_ubyte, pointer, POINTER, cast, sizeof, byref
+from ctypes import sizeof, byref, c_ubyte
+from layout import layoutof, isstatic, extent, buflen
 
 # Memory pairs
 
 class mempair (object):
 	"""
 	A memory pair.
+
+	All the pairs parsed from a memory block share that single block
+	and only differ in their offsets. The block may be a ``ctypes``
+	object (an array of bytes, for instance) or any other object
+	supporting the writable buffer interface, like ``bytearray``.
+	The car objects are placed over the block with ``from_buffer()``,
+	so no data is copied and no intermediate ``ctypes`` types are
+	created when the tails are parsed.
+
+	The pair objects have a fixed set of slots. Optionally, they may
+	be reused: a pair returned by the ``release()`` method is put to
+	the free-list and is then taken from it instead of creating a new
+	object. The length of the free-list is limited by the ``maxfree``
+	class attribute, which is 0 (the free-list is disabled) by
+	default.
 	"""
 
-	def __init__ (self, carclass, data, parent = None, index = 0):
+	__slots__ = ("parent", "index", "carclass", "data", "__offset", "carobj", "__state", "__tails", "__offsets", "__extent")
+
+	# The maximum number of released pairs kept for reuse
+	maxfree = 0
+
+	# The released pairs
+	__free = []
+
+	def __init__ (self, carclass, data, parent = None, index = 0, offset = 0):
 		"""
 		Sets up the pair object.
 
 		The ``carclass`` argument defines the class of the car
 		object and should be ``ctypes``-compatible. The
 		``data`` argument defines the memory block being
-		parsed. The other arguments are optional and reserved
-		for module internal use.
-		"""
-		if sizeof(data) >= sizeof(carclass):
-			self.parent = parent
-			self.index = index
-			self.carclass = carclass
-			self.data = data
-			self.carobj = cast(data, POINTER(carclass)).contents
+		parsed. The ``offset`` argument defines the start of the
+		pair within the block. The other arguments are optional
+		and reserved for module internal use.
+		"""
+		self.__setup (carclass, data, parent, index, offset)
+		object.__setattr__ (self, "_mempair__tails", {})
+
+	def __setup (self, carclass, data, parent, index, offset):
+		"""
+		Initializes the slots of a new or a reused pair object.
+		"""
+		size = buflen(data) - offset
+		if size < sizeof(carclass):
+			raise OverflowError("The length of memory block (%d) is less than the length of the static head (%d)." % (size, sizeof(carclass)))
+		init = object.__setattr__
+		init (self, "parent", parent)
+		init (self, "index", index)
+		init (self, "carclass", carclass)
+		init (self, "data", data)
+		init (self, "_mempair__offset", offset)
+		if parent is None:
+			init (self, "_mempair__state", [0])
 		else:
-			raise OverflowError("The length of memory block (%d) is less than the length of the static head (%d)." % (sizeof(data), sizeof(carclass)))
-	
+			init (self, "_mempair__state", parent.__state)
+		init (self, "_mempair__offsets", None)
+		init (self, "_mempair__extent", None)
+		init (self, "carobj", carclass.from_buffer(data, offset))
+
+	def release (self):
+		"""
+		Releases this pair, the pairs that head its tail fields
+		and the array elements obtained from it breaking the
+		references between them. If the
+		free-list is enabled the pairs are put to it for reuse.
+		Neither the released pairs nor any pairs obtained from
+		them may be used after that.
+		"""
+		free = mempair.__free
+		pending = [self]
+		while pending:
+			pair = pending.pop()
+			for (gen, layout, tail) in pair.__tails.values():
+				pending.append(tail)
+			pair.__tails.clear()
+			init = object.__setattr__
+			init (pair, "parent", None)
+			init (pair, "data", None)
+			init (pair, "carobj", None)
+			if len(free) < pair.maxfree:
+				free.append(pair)
+
 	def car (self):
 		"""
 		Returns the static head of this pair.
@@ -94,27 +167,55 @@ class mempair (object):
 	def buf (self):
 		"""
 		Returns the (address, length) tuple of the pair occupied
-		memory buffer.
+		memory buffer, i.e. the static head and the tail this
+		pair is responsible for. The length is calculated once
+		and is kept until the memory block is modified via any
+		of the pairs.
 		"""
-		(addr, size) = self.carbuf()
-		cdr = self.cdr()
-		if cdr:
-			(cdraddr, cdrsize) = cdr.buf()
-			size += cdrsize
-		return (addr, size)
+		gen = self.__state[0]
+		if self.__extent is None or self.__extent[0] != gen:
+			object.__setattr__ (self, "_mempair__extent", (gen, extent(self.carclass, self.data, self.__offset)))
+		return (self.__addr(), self.__extent[1])
 
 	def databuf (self):
 		"""
 		Returns the (address, length) tuple of the pair
 		available memory buffer.
 		"""
-		return (byref(self.data), sizeof(self.data))
+		return (self.__addr(), buflen(self.data) - self.__offset)
+
+	def dataoffset (self):
+		"""
+		Returns the offset of the pair within its memory block.
+		"""
+		return self.__offset
 
 	def carbuf (self):
 		"""
 		Returns (address, length) tuple of the pair static head bufer.
 		"""
-		return (byref(self.data), sizeof(self.carclass))
+		return (self.__addr(), sizeof(self.carclass))
+
+	def view (self, length = None):
+		"""
+		Returns a ``memoryview`` object over the available memory
+		of this pair or over the first ``length`` bytes of it.
+		"""
+		if length is None:
+			end = buflen(self.data)
+		else:
+			end = self.__offset + length
+		return memoryview(self.data)[self.__offset:end]
+
+	def __addr (self):
+		"""
+		Returns the address of the start of the pair suitable
+		for passing to foreign functions.
+		"""
+		try:
+			return byref(self.data, self.__offset)
+		except TypeError:
+			return byref(c_ubyte.from_buffer(self.data, self.__offset))
 
 	def cdr (self):
 		"""
@@ -138,12 +239,20 @@ class mempair (object):
 				index = parent.index  + 1
 				parent = parent.parent
 		
-		if cdarclass != type(None):
-			cdrbuf = cast(cast(self.data, POINTER(c_ubyte * 1))[sizeof(self.carclass)], POINTER(c_ubyte * (sizeof(self.data) - sizeof(self.carclass)))).contents
-			return type(self)(cdarclass, cdrbuf, parent, index)
-		else:
+		if cdarclass == type(None):
 			return None
 
+		gen = self.__state[0]
+		try:
+			(tgen, tclass, tail) = self.__tails["cdr"]
+			if tgen == gen and tclass is cdarclass:
+				return tail
+		except KeyError:
+			pass
+		tail = self.__at (sizeof(self.carclass), cdarclass, parent, index)
+		self.__tails["cdr"] = (gen, cdarclass, tail)
+		return tail
+
 	def cdarclass (self, key = 0):
 		try:
 			pos = 0
@@ -171,80 +280,164 @@ class mempair (object):
 		try:
 			return getattr (self.car(), name)
 		except AttributeError:
-			tail = self.cdr()
-			if tail:
-				try:
-					for (fname, ftype, fcount) in self.car().cdrmap():
-						if name == fname:
-							return tail
-						elif fname == "_tail":
-							return getattr (tail, name)
-						else:
-							tail = tail.__skip (fcount)
-				except AttributeError:
-					try:
-						if self.cdarclass (1):
-							pass
-					except IndexError:
-						return getattr (tail, name)
-
-			raise AttributeError ("'%s' object has no attribute '%s'" % (self.carclass, name))
+			(target, attr) = self.__locate (name)
+			if attr is None:
+				return target
+			return getattr (target, attr)
 
 	def __setattr__ (self, name, value):
-		try:
-			carobj = object.__getattribute__ (self, "carobj")
-		except AttributeError:
-			# Object is not initialized yet
-			object.__setattr__ (self, name, value)
-			return
+		carobj = self.carobj
 		try:
 			object.__getattribute__ (carobj, name)
-			object.__setattr__ (carobj, name, value)
 		except AttributeError:
-			tail = self.cdr()
-			if tail:
-				try:
-					for (fname, ftype, fcount) in self.car().cdrmap():
-						if fname == "_tail":
-							setattr (tail, name, value)
-							return
-						else:
-							tail = tail.__skip (fcount)
-				except AttributeError:
-					try:
-						if self.cdarclass (1):
-							pass
-					except IndexError:
-						setattr (tail, name, value)
-						return
-			object.__setattr__ (self, name, value)
-
-	def __skip (self, count):
-		if not count:
-			return self
-		cdarclass = self.cdarclass()
-		if cdarclass is type(None):
-			# Good, a static length element
-			tail = cast(cast(self.data, POINTER(c_ubyte * 1))[sizeof(self.carclass) * count], POINTER(c_ubyte * (sizeof(self.data) - sizeof(self.carclass) * count))).contents
-			return type(self)(self.carclass, tail, self.parent, self.index + count)
+			(target, attr) = self.__locate (name)
+			if attr is None:
+				raise AttributeError ("Unable to replace the '%s' tail field" % name)
+			setattr (target, attr, value)
 		else:
-			# A variable length element — walk the list :/
-			cdr = self
-			for i in range (count):
-				cdr = cdr.cdr()
-			return cdr
+			object.__setattr__ (carobj, name, value)
+			# The layout of the tails may have changed
+			self.__state[0] += 1
+
+	def __locate (self, name):
+		"""
+		Locates the given attribute in the tail of this pair with
+		the use of the compiled layout. Returns the tuple
+		(pair, None) if the name is a name of a tail field or the
+		tuple (pair, name) if the attribute should be looked up
+		in the returned pair.
+		"""
+		layout = layoutof (self.car())
+		if layout.cdrmap is not None:
+			if name in layout.fields:
+				return (self.__tail (layout, layout.fields[name]), None)
+			elif name in layout.tailfields:
+				return (self.__tail (layout, layout.tailfields[name]), name)
+		elif layout.cdarclass is not type(None):
+			return (self.__tail (layout, -1), name)
+
+		raise AttributeError ("'%s' object has no attribute '%s'" % (self.carclass, name))
+
+	def __tail (self, layout, pos):
+		"""
+		Returns the pair that heads the tail field at the given
+		position of the compiled layout or the next pair if the
+		position is negative. The pairs are memoized until the
+		memory block is modified via any of the pairs.
+		"""
+		gen = self.__state[0]
+		try:
+			(tgen, tlayout, tail) = self.__tails[pos]
+			if tgen == gen and tlayout is layout:
+				return tail
+		except KeyError:
+			pass
+
+		if pos < 0:
+			tail = self.__at (layout.carsize, layout.cdarclass, self, 0)
+		else:
+			(fname, ftype, fcount, offset, index) = layout.entries[pos]
+			if offset is None:
+				offset = layout.offsetof (pos, self.data, self.__offset) - self.__offset
+			tail = self.__at (offset, ftype, self, index)
+		self.__tails[pos] = (gen, layout, tail)
+		return tail
+
+	def __at (self, offset, carclass, parent, index):
+		"""
+		Returns the pair with the car of the given class placed
+		at the given offset relative to the start of this pair.
+		"""
+		try:
+			pair = mempair.__free.pop()
+		except IndexError:
+			return type(self)(carclass, self.data, parent, index, self.__offset + offset)
+		if type(pair) is not type(self):
+			mempair.__free.append(pair)
+			return type(self)(carclass, self.data, parent, index, self.__offset + offset)
+		pair.__setup (carclass, self.data, parent, index, self.__offset + offset)
+		return pair
 
 	def __gethead (self):
-		head = self.parent.cdr()
-		pos = 0
-		for (fname, ftype, fcount) in self.parent.car().cdrmap():
-			hlen = fcount
-			if (pos + fcount) <= self.index:
-				pos = pos + fcount
-				head = head.__skip (fcount)
-			else:
+		"""
+		Returns the tuple (head, count) where ``head`` is the
+		first pair of the array this pair is an element of and
+		``count`` is the number of elements in that array.
+		"""
+		if self.parent is None:
+			raise AttributeError ("The pair is not an array element")
+		layout = layoutof (self.parent.car())
+		if layout.cdrmap is None:
+			raise AttributeError ("The pair is not an array element")
+		found = None
+		for (pos, entry) in enumerate(layout.entries):
+			(fname, ftype, fcount, offset, index) = entry
+			if index <= self.index < index + fcount:
+				found = (pos, index, fcount)
 				break
-		return (head, hlen)
+			elif index == self.index and found is None:
+				# An empty array
+				found = (pos, index, fcount)
+		if found is None:
+			raise AttributeError ("The pair is not an array element")
+		(pos, index, fcount) = found
+		if index == self.index:
+			return (self, fcount)
+		else:
+			return (self.parent.__tail (layout, pos), fcount)
+
+	def __offsetindex (self, count):
+		"""
+		Returns the list of offsets of the ``count`` elements of
+		the array headed by this pair relative to this pair or
+		``None`` if the elements have a static length. The index
+		is built the first time it is needed and is kept until
+		the memory block is modified via any of the pairs.
+		"""
+		if isstatic(self.carclass):
+			return None
+		gen = self.__state[0]
+		if self.__offsets is not None and self.__offsets[0] == gen:
+			return self.__offsets[1]
+		offsets = []
+		offset = self.__offset
+		for i in range (count):
+			offsets.append(offset - self.__offset)
+			offset += extent(self.carclass, self.data, offset)
+		object.__setattr__ (self, "_mempair__offsets", (gen, offsets))
+		return offsets
+
+	def __element (self, i, offsets):
+		"""
+		Returns the element at the given index of the array headed
+		by this pair.
+		"""
+		if offsets is None:
+			offset = sizeof(self.carclass) * i
+		else:
+			offset = offsets[i]
+		return self.__item (i, offset)
+
+	def __item (self, i, offset):
+		"""
+		Returns the element at the given index and offset of the
+		array headed by this pair. The elements are memoized in
+		the same way as the tails, so they are released together
+		with this pair.
+		"""
+		if not i:
+			return self
+		gen = self.__state[0]
+		key = (i,)
+		try:
+			(tgen, toffset, item) = self.__tails[key]
+			if tgen == gen and toffset == offset:
+				return item
+		except KeyError:
+			pass
+		item = self.__at (offset, self.carclass, self.parent, self.index + i)
+		self.__tails[key] = (gen, offset, item)
+		return item
 
 	def __nonzero__ (self):
 		try:
@@ -258,4 +451,27 @@ class mempair (object):
 
 	def __getitem__ (self, index):
 		(head, hlen) = self.__gethead()
-		return head.__skip (index)
+		if isinstance(index, slice):
+			offsets = head.__offsetindex (hlen)
+			return [head.__element (i, offsets) for i in range(*index.indices(hlen))]
+		if index < 0:
+			index += hlen
+		if index < 0 or index >= hlen:
+			raise IndexError ("Index out of bounds: %s" % index)
+		if not index:
+			return head
+		return head.__element (index, head.__offsetindex (hlen))
+
+	def __iter__ (self):
+		# The offset of each next element is calculated after the
+		# previous one is processed, so the elements can be
+		# filled in while iterating.
+		(head, hlen) = self.__gethead()
+		static = isstatic(head.carclass)
+		offset = 0
+		for i in range (hlen):
+			yield head.__item (i, offset)
+			if static:
+				offset += sizeof(head.carclass)
+			else:
+				offset += extent(head.carclass, head.data, head.__offset + offset)
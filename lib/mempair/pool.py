@@ -0,0 +1,158 @@
+# coding: utf-8
+
+"""
+The module for reusing memory blocks of a few fixed sizes.
+
+The blocks (``bytearray`` objects) are sorted into size classes. A
+request for a block is served with a free block of the smallest
+class that fits, which is allocated only if there is no free block
+of that class. The blocks are returned to the pool when they are no
+longer needed. The requests exceeding the largest class are served
+with the blocks of the exact size, which are never pooled.
+
+The pooled blocks are ``poolblock`` objects (a subclass of
+``bytearray``) marked with the pool they belong to and whether they
+are handed out: the blocks not got from the pool and the blocks
+returned twice are ignored, so they are never handed out to another
+user. The marks live in the blocks themselves, so the blocks that
+are never returned are simply left to the garbage collector.
+
+The reused blocks are not zeroed, so the data should be written
+before it's read, as ``build()`` does. The amount of memory kept by
+the free blocks is limited; the blocks returned over the limit are
+left to the garbage collector.
+"""
+
+import bisect
+import threading
+
+# The default limit of the memory kept by the free blocks
+MAXMEMORY = 4 * 1024 * 1024
+
+class poolblock (bytearray):
+	"""
+	A memory block of a pool.
+	"""
+
+	__slots__ = ("pool", "issued")
+
+class sizeclass (object):
+	"""
+	The statistics and the free blocks of a size class.
+	"""
+
+	def __init__ (self, size):
+		self.size = size
+		self.free = []
+		self.hits = 0
+		self.misses = 0
+		self.used = 0
+		self.highwater = 0
+
+	def stats (self):
+		return {
+			"size": self.size,
+			"free": len(self.free),
+			"hits": self.hits,
+			"misses": self.misses,
+			"used": self.used,
+			"highwater": self.highwater,
+		}
+
+class bufferpool (object):
+	"""
+	A pool of memory blocks of the given size classes.
+	"""
+
+	def __init__ (self, sizes, maxmemory = MAXMEMORY):
+		"""
+		Sets up the pool of the blocks of the given sizes keeping
+		no more than ``maxmemory`` bytes in the free blocks.
+		"""
+		self.sizes = sorted(sizes)
+		self.maxmemory = maxmemory
+		self.memory = 0
+		self.oversize = 0
+		self.dropped = 0
+		self.ignored = 0
+		self.__classes = dict([(size, sizeclass(size)) for size in self.sizes])
+		self.__lock = threading.Lock()
+
+	def get (self, size):
+		"""
+		Returns a block of at least the given size.
+		"""
+		i = bisect.bisect_left(self.sizes, size)
+		if i == len(self.sizes):
+			self.__lock.acquire()
+			try:
+				self.oversize += 1
+			finally:
+				self.__lock.release()
+			return bytearray(size)
+		cls = self.__classes[self.sizes[i]]
+		self.__lock.acquire()
+		try:
+			cls.used += 1
+			if cls.used > cls.highwater:
+				cls.highwater = cls.used
+			if cls.free:
+				cls.hits += 1
+				self.memory -= cls.size
+				data = cls.free.pop()
+			else:
+				cls.misses += 1
+				data = poolblock(cls.size)
+				data.pool = self
+			data.issued = True
+			return data
+		finally:
+			self.__lock.release()
+
+	def put (self, data):
+		"""
+		Returns the given block to the pool. The blocks not of
+		a pool size class are ignored, as well as the blocks not
+		got from the pool or returned already.
+		"""
+		if not isinstance(data, bytearray):
+			return
+		cls = self.__classes.get(len(data))
+		if cls is None:
+			return
+		self.__lock.acquire()
+		try:
+			if type(data) is not poolblock or data.pool is not self or not data.issued:
+				self.ignored += 1
+				return
+			data.issued = False
+			cls.used -= 1
+			if self.memory + cls.size > self.maxmemory:
+				self.dropped += 1
+				return
+			self.memory += cls.size
+			cls.free.append(data)
+		finally:
+			self.__lock.release()
+
+	def stats (self):
+		"""
+		Returns the dictionary of the pool statistics: the memory
+		kept in the free blocks, the numbers of the oversize, the
+		dropped and the ignored blocks and the list of the per-class
+		statistics (the numbers of the free and the used blocks,
+		the maximum number of the used blocks, the numbers of the
+		requests served with a free and a new block).
+		"""
+		self.__lock.acquire()
+		try:
+			return {
+				"memory": self.memory,
+				"maxmemory": self.maxmemory,
+				"oversize": self.oversize,
+				"dropped": self.dropped,
+				"ignored": self.ignored,
+				"classes": [self.__classes[size].stats() for size in self.sizes],
+			}
+		finally:
+			self.__lock.release()
@@ -0,0 +1,128 @@
+# coding: utf-8
+
+"""
+The module for parsing a stream of size-prefixed records, like 9P
+or netlink messages, received into a contiguous memory block.
+
+The records are read into a large buffer as they arrive, many of
+them at once, and are returned as ``mempair`` objects placed at the
+corresponding offsets of that buffer, so no data is copied. If the
+last record in the buffer is incomplete it is left pending until
+more data is received.
+
+When the free space at the end of the buffer is exhausted, a new
+buffer is allocated and only the pending incomplete record is copied
+to its start. The old buffer is not reused: it is kept alive by the
+records parsed from it and is released as soon as all of them are
+released. Thus a record stays valid for as long as it is referenced,
+regardless of the subsequent reads.
+"""
+
+from ctypes import sizeof, byref, c_ubyte
+from mempair import mempair
+
+# The default size of the receive buffer
+BUFSIZE = 65536
+
+# The minimal amount of free space offered for a read
+MINREAD = 4096
+
+class recordstream (object):
+	"""
+	A stream of size-prefixed records.
+	"""
+
+	def __init__ (self, carclass, sizefield = "size", align = 1, maxsize = None, bufsize = BUFSIZE, minread = MINREAD, alloc = bytearray):
+		"""
+		Sets up the stream of records with the head of the given
+		class. The ``sizefield`` argument names the field of the
+		head that holds the full length of the record including
+		the head itself. The records are aligned to the given
+		number of bytes. The records longer than ``maxsize`` bytes
+		are rejected, if it is set. The ``alloc`` callable is
+		used to get a new buffer of the given size.
+		"""
+		self.carclass = carclass
+		self.sizefield = sizefield
+		self.align = align
+		self.maxsize = maxsize
+		self.bufsize = bufsize
+		self.minread = minread
+		self.alloc = alloc
+		self.data = None
+		self.start = 0
+		self.end = 0
+		self.needed = sizeof(carclass)
+
+	def pending (self):
+		"""
+		Returns the number of received bytes that don't form a
+		complete record yet.
+		"""
+		return self.end - self.start
+
+	def __reserve (self):
+		"""
+		Makes sure there is enough free space at the end of the
+		buffer to receive the rest of the pending record or at
+		least ``minread`` bytes.
+		"""
+		pending = self.end - self.start
+		wanted = max(self.needed - pending, self.minread)
+		if self.data is not None and len(self.data) - self.end >= wanted:
+			return
+		data = self.alloc(max(self.bufsize, pending + wanted))
+		if pending:
+			data[:pending] = self.data[self.start:self.end]
+		self.data = data
+		self.start = 0
+		self.end = pending
+
+	def space (self):
+		"""
+		Returns the (address, length) tuple of the free space
+		at the end of the buffer to receive the data into. The
+		address is suitable for passing to foreign functions.
+		"""
+		self.__reserve()
+		return (byref(c_ubyte.from_buffer(self.data, self.end)), len(self.data) - self.end)
+
+	def view (self):
+		"""
+		Returns a ``memoryview`` object over the free space at the
+		end of the buffer to receive the data into.
+		"""
+		self.__reserve()
+		return memoryview(self.data)[self.end:]
+
+	def feed (self, length):
+		"""
+		Accounts the given number of bytes received into the free
+		space returned by ``space()`` or ``view()``.
+		"""
+		if length < 0 or self.end + length > len(self.data):
+			raise ValueError("Invalid length of the received data: %d" % length)
+		self.end += length
+
+	def records (self):
+		"""
+		Yields the complete records received so far as the
+		``mempair`` objects with the car of the stream head class.
+		"""
+		hsize = sizeof(self.carclass)
+		while self.end - self.start >= hsize:
+			car = self.carclass.from_buffer(self.data, self.start)
+			size = getattr(car, self.sizefield)
+			if size < hsize or (self.maxsize is not None and size > self.maxsize):
+				raise ValueError("Invalid record length: %d" % size)
+			if self.end - self.start < size:
+				self.needed = size
+				return
+			record = mempair(self.carclass, self.data, offset = self.start)
+			self.start = min(self.start + (size + self.align - 1) // self.align * self.align, self.end)
+			self.needed = hsize
+			yield record
+		self.needed = hsize
+
+	def __iter__ (self):
+		return self.records()